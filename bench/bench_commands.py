@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# toro2 start, status, switch, stop, naked & install end to end against
+# stand-ins (bench/standins.py): iptables with an in-memory ruleset,
+# systemctl, chattr, sudo and a tor printing its bootstrap & answering on
+# its control port. Per verb: wall time (median & min), processes forked
+# and how many of them through sudo, checked against bench/baseline.json:
+# more forks or sudo calls than the baseline fails the run (exit 1), so
+# does a daemon-served start or stop not answering with what its steps
+# printed. Wall times are noisy: the min of the rounds over the baseline's
+# by more than --tolerance is a warning, an error with --strict-wall; a
+# verb run once (install (first)) has its counts checked only.
+#
+# Hermetic: no root, no network, nothing outside a scratch directory.
+# toro2 runs with the stand-ins alone in PATH, every other path of
+# toro2.conf (toro2_homedir, install_root, resolv_conf, pidfile, ...) in
+# the scratch directory, and an audit hook refusing (PermissionError) any
+# program that isn't a stand-in, any write outside the scratch directory
+# and any signal to a process that isn't a stand-in.
+#
+#   python3 bench/bench_commands.py [--rounds N] [--bootstrap-ms ms] [--tolerance 0.5]
+#                                   [--strict-wall] [--update-baseline] [-v]
+
+import argparse
+import ctypes
+import json
+import os
+import pwd
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(REPO, 'toro2'))
+
+import standins  # noqa: E402
+import sysops  # noqa: E402
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# verbs in the order a round runs them: each leaves the state the next one starts from
+ROUND = ['start', 'status', 'switch', 'stop', 'naked', 'install']
+
+# run in toro2's process before toro2 is imported: counts what it forks
+# & keeps it inside the scratch directory
+LAUNCHER = '''
+import errno, json, os, sys
+SCRATCH, BINDIR, OUT = {scratch!r}, {bindir!r}, {out!r}
+spawned = []
+
+def inside(path):
+    if isinstance(path, int):
+        return True
+    path = os.path.abspath(os.fsdecode(path))
+    return path == '/dev/null' or path == SCRATCH or path.startswith(SCRATCH + os.sep)
+
+def refuse(what):
+    raise PermissionError(errno.EPERM, f'bench: {{what}} refused (not hermetic)')
+
+FS_IOC_SETFLAGS = 0x40086602
+WRITES = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+PATH_EVENTS = ('os.remove', 'os.rmdir', 'os.mkdir', 'os.chmod', 'os.chown', 'os.truncate', 'os.utime',
+               'shutil.rmtree', 'os.chflags')
+
+def hook(event, args):
+    if event == 'subprocess.Popen':
+        executable, argv = args[0], args[1]
+        argv = [os.fsdecode(a) for a in ([argv] if isinstance(argv, (str, bytes)) else argv)]
+        prog = os.fsdecode(executable) if executable else argv[0]
+        if '/' in prog and not (prog.startswith(BINDIR + os.sep) or prog == sys.executable):
+            refuse(f'running {{prog}}')
+        spawned.append(argv)
+    elif event in ('os.system', 'os.posix_spawn', 'os.fork', 'os.exec'):
+        refuse(event)
+    elif event == 'open':
+        path, mode, flags = args
+        writing = any(c in mode for c in 'wax+') if isinstance(mode, str) else bool(flags & WRITES)
+        if writing and path is not None and not inside(path):
+            refuse(f'writing {{path}}')
+    elif event in PATH_EVENTS:
+        if not inside(args[0]):
+            refuse(f'{{event}} {{args[0]}}')
+    elif event in ('os.rename', 'os.link', 'os.symlink'):
+        if not inside(args[0]) or not inside(args[1]):
+            refuse(f'{{event}} {{args[1]}}')
+    elif event == 'fcntl.ioctl' and args[1] == FS_IOC_SETFLAGS:
+        # chattr in-process: the file is opened read-only
+        if not inside(os.readlink(f'/proc/self/fd/{{args[0]}}')):
+            refuse(f'chattr {{os.readlink(f"/proc/self/fd/{{args[0]}}")}}')
+    elif event == 'os.kill' and args[1] != 0:
+        try:
+            with open(f'/proc/{{args[0]}}/cmdline', 'rb') as f:
+                cmdline = f.read().decode('utf-8', 'replace')
+        except OSError:
+            return
+        if BINDIR not in cmdline:
+            refuse(f'signalling pid {{args[0]}}')
+
+def report():
+    with open(OUT, 'w') as f:
+        json.dump(spawned, f)
+
+import atexit
+atexit.register(report)
+sys.addaudithook(hook)
+
+sys.path.insert(0, {moddir!r})
+sys.argv[0] = 'toro2'
+import toro2
+toro2.main()
+'''
+
+
+def become_subreaper():
+    # tor, detached by start, is reparented to us rather than to init: stop
+    # kills it & it is reaped here (a zombie would still show in pidof)
+    PR_SET_CHILD_SUBREAPER = 36
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+        print(f'prctl(PR_SET_CHILD_SUBREAPER): {os.strerror(ctypes.get_errno())}')
+
+
+def reap():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_root(tmp, bootstrap_ms):
+    # => (env, paths): stand-ins, a toro2.conf & toro2.torrc pointing at them & at tmp
+    bindir = os.path.join(tmp, 'bin')
+    state = os.path.join(tmp, 'state')
+    root = os.path.join(tmp, 'root')
+    homedir = os.path.join(root, 'etc', 'toro2')
+    run = os.path.join(tmp, 'run')
+    bins = standins.write_bin(bindir, state, bootstrap_ms=bootstrap_ms)
+
+    for d in (os.path.join(homedir, 'toro2'), run, os.path.join(root, 'usr', 'bin')):
+        os.makedirs(d)
+    resolv = os.path.join(root, 'etc', 'resolv.conf')
+    with open(resolv, 'w') as f:
+        f.write('nameserver 127.0.0.53\n')
+
+    stampfile = os.path.join(run, 'toro2.newnym')
+    ports = {'SocksPort': free_port(), 'ControlPort': free_port(), 'TransPort': free_port(), 'DNSPort': free_port()}
+    with open(os.path.join(REPO, 'toro2', 'toro2.torrc')) as f, \
+            open(os.path.join(homedir, 'toro2', 'toro2.torrc'), 'w') as out:
+        for line in f:
+            key = line.split(' ', 1)[0]
+            out.write(f'{key} {ports[key]}\n' if key in ports else line)
+
+    overrides = {
+        'toro2_homedir': homedir,
+        'toro2_binary': os.path.join(root, 'usr', 'bin', 'toro2'),
+        'toro2_stuff_homedir': os.path.join(root, 'var', 'lib', 'toro2'),
+        'install_root': root,
+        'resolv_conf': resolv,
+        'username': pwd.getpwuid(os.getuid()).pw_name,
+        'pidfile': os.path.join(run, 'toro2.pid'),
+        'daemon_socket': os.path.join(run, 'toro2.sock'),
+        'newnym_stampfile': stampfile,
+        'tor_stdout_log': os.path.join(run, 'tor.log'),
+        'tor_bin': bins['tor'],
+        'systemctl': bins['systemctl'],
+        'chattr': bins['chattr'],
+        'control_port': ports['ControlPort'],
+        'tor_trans_port': ports['TransPort'],
+        'dnscrypt_proxy_toml': os.path.join(root, 'etc', 'dnscrypt-proxy', 'dnscrypt-proxy.toml'),
+        'dns_cache_file': os.path.join(root, 'var', 'lib', 'toro2-dns', 'cache.json'),
+        'firewall_backend': 'iptables',
+    }
+    for name in standins.IPTABLES:
+        overrides[name.replace('-', '_')] = bins[name]
+
+    with open(os.path.join(REPO, 'toro2', 'toro2.conf')) as f, \
+            open(os.path.join(homedir, 'toro2', 'toro2.conf'), 'w') as out:
+        for line in f:
+            key = line.split('=', 1)[0]
+            out.write(f'{key}={overrides.pop(key)}\n' if key in overrides else line)
+        for key, value in overrides.items():
+            out.write(f'{key}={value}\n')
+
+    env = {'PATH': bindir, 'HOME': tmp, 'TMPDIR': tmp, 'LANG': 'C.UTF-8', 'TORO2_NO_DAEMON': '1',
+           'TORO2_HOMEDIR': homedir}
+    return env, {'bindir': bindir, 'state': state, 'homedir': homedir, 'stampfile': stampfile}
+
+
+def run_verb(verb, env, paths, tmp, verbose=False):
+    # => {'wall', 'forks', 'sudo', 'code', 'calls'}
+    if verb == 'switch':
+        # NEWNYM is rate limited (10s): not what is measured
+        sysops.remove(paths['stampfile'])
+
+    out = os.path.join(tmp, 'spawned.json')
+    # install is run from the source tree (it copies it), the other verbs
+    # as the launcher runs them: the installed toro2, precompiled
+    if verb == 'install':
+        cwd, moddir = REPO, os.path.join(REPO, 'toro2')
+    else:
+        cwd, moddir = tmp, os.path.join(paths['homedir'], 'toro2')
+    launcher = LAUNCHER.format(scratch=tmp, bindir=paths['bindir'], out=out, moddir=moddir)
+
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', launcher, verb], env=env, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    wall = time.perf_counter() - t0
+    reap()
+
+    with open(out) as f:
+        spawned = json.load(f)
+    calls = standins.read_calls(paths['state'])
+    if verbose:
+        print(proc.stdout.decode('utf-8', 'replace'))
+        for c in calls:
+            print(f'      {c["prog"]:<18} {" ".join(c["argv"])[:90]}')
+    refused = [line for line in proc.stdout.decode('utf-8', 'replace').splitlines() if 'not hermetic' in line]
+    return {'wall': wall, 'forks': len(spawned), 'sudo': sum(os.path.basename(a[0]) == 'sudo' for a in spawned),
+            'code': proc.returncode, 'refused': refused}
+
+
+def check_daemon(env, paths, tmp):
+    # => [problem]: start & stop served by 'toro2 daemon' (from the launcher
+    # too) must come back with what their steps printed, worker threads included
+    socket_path = os.path.join(tmp, 'run', 'toro2.sock')
+    client_env = {k: v for k, v in env.items() if k != 'TORO2_NO_DAEMON'}
+    client_env['TORO2_SOCKET'] = socket_path
+    launcher = LAUNCHER.format(scratch=tmp, bindir=paths['bindir'], out=os.path.join(tmp, 'daemon.json'),
+                               moddir=os.path.join(paths['homedir'], 'toro2'))
+    daemon = subprocess.Popen([sys.executable, '-c', launcher, 'daemon'], env=env, cwd=tmp,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+    problems = []
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        else:
+            return ['daemon: socket never showed up']
+
+        launcher = LAUNCHER.format(scratch=tmp, bindir=paths['bindir'], out=os.path.join(tmp, 'spawned.json'),
+                                   moddir=os.path.join(paths['homedir'], 'toro2'))
+        # step output: the firewall step, the tor step & its bootstrap report
+        for verb, wanted in (('start', ['Adding rules', 'start', 'bootstrapped in']),
+                             ('stop', ['Deleting rules', 'stop'])):
+            proc = subprocess.run([sys.executable, '-c', launcher, verb], env=client_env, cwd=tmp,
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            out = proc.stdout.decode('utf-8', 'replace')
+            missing = [w for w in wanted if w not in out]
+            if proc.returncode != 0 or missing:
+                problems.append(f'daemon {verb}: exit {proc.returncode}, missing {missing} from its output')
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=10)
+        reap()
+    return problems
+
+
+def stop_standins(state):
+    # stand-in tors still running (a failed stop)
+    for name in os.listdir(state):
+        if name.startswith('tor.') and name.endswith('.pid'):
+            try:
+                os.kill(int(name[4:-4]), 15)
+            except (OSError, ValueError):
+                pass
+    time.sleep(0.1)
+    reap()
+
+
+def check(results, baseline, tolerance):
+    # => ([regression], [slower]): fork & sudo counts are deterministic,
+    # wall times (min of the rounds) are not
+    regressions, slower = [], []
+    for verb, r in results.items():
+        base = baseline.get(verb)
+        if base is None:
+            continue
+        if r['forks'] > base['forks']:
+            regressions.append(f'{verb}: {r["forks"]} forks (baseline {base["forks"]})')
+        if r['sudo'] > base['sudo']:
+            regressions.append(f'{verb}: {r["sudo"]} sudo calls (baseline {base["sudo"]})')
+        if 'min_ms' not in r or 'min_ms' not in base:
+            continue
+        allowed = base['min_ms'] * (1 + tolerance)
+        if r['min_ms'] > allowed:
+            slower.append(f'{verb}: min {r["min_ms"]:.1f} ms (baseline {base["min_ms"]:.1f} ms, '
+                          f'allowed {allowed:.1f} ms)')
+    return regressions, slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--bootstrap-ms', type=int, default=100, help='ms the stand-in tor takes to bootstrap')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='min wall time allowed over the baseline (0.5: +50%%)')
+    parser.add_argument('--strict-wall', action='store_true', help='wall times over the tolerance fail the run')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print toro2 output & stand-in calls')
+    args = parser.parse_args()
+
+    become_subreaper()
+    tmp = tempfile.mkdtemp(prefix='toro2-bench-')
+    try:
+        env, paths = make_root(tmp, args.bootstrap_ms)
+
+        # first install: everything copied & compiled
+        first = run_verb('install', env, paths, tmp, args.verbose)
+        samples = {'install (first)': [first]}
+        for _ in range(args.rounds):
+            for verb in ROUND:
+                samples.setdefault(verb, []).append(run_verb(verb, env, paths, tmp, args.verbose))
+        daemon_problems = check_daemon(env, paths, tmp)
+        stop_standins(paths['state'])
+
+    finally:
+        # start leaves resolv.conf immutable when it can (root)
+        try:
+            sysops.set_immutable(os.path.join(tmp, 'root', 'etc', 'resolv.conf'), False)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    results = {}
+    print(f'{"":<16} {"median ms":>10} {"min ms":>9} {"forks":>6} {"sudo":>5}')
+    for verb, runs in samples.items():
+        walls = [r['wall'] * 1000 for r in runs]
+        results[verb] = {'forks': max(r['forks'] for r in runs), 'sudo': max(r['sudo'] for r in runs)}
+        if len(runs) > 1:
+            results[verb]['min_ms'] = round(min(walls), 1)
+        failed = sum(r['code'] != 0 for r in runs)
+        print(f'toro2 {verb:<16} {statistics.median(walls):10.1f} {min(walls):9.1f} {results[verb]["forks"]:6d} '
+              f'{results[verb]["sudo"]:5d}' + (f'   exit != 0 in {failed} run(s)' if failed else ''))
+
+    refused = sorted({line for runs in samples.values() for r in runs for line in r['refused']})
+    for line in refused:
+        print(f'refused: {line.strip()}')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'bootstrap_ms': args.bootstrap_ms, 'verbs': results}, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print(f'baseline written to {args.baseline}')
+        return
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f'no baseline ({args.baseline}): run with --update-baseline')
+        return
+    if baseline.get('bootstrap_ms') != args.bootstrap_ms:
+        print(f'baseline taken with --bootstrap-ms {baseline.get("bootstrap_ms")}: wall times not compared')
+        baseline = {verb: {k: v for k, v in b.items() if k != 'min_ms'} for verb, b in baseline['verbs'].items()}
+    else:
+        baseline = baseline['verbs']
+
+    regressions, slower = check(results, baseline, args.tolerance)
+    if args.strict_wall:
+        regressions, slower = regressions + slower, []
+    regressions += daemon_problems
+    for r in slower:
+        print(f'SLOWER {r}')
+    for r in regressions:
+        print(f'REGRESSION {r}')
+    if regressions or refused:
+        exit(1)
+    print('within baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Timing comparison: toro2.iptablesA (one iptables fork per rule) against the
+# compiled ruleset loaded with a single iptables-restore per address family.
+#
+# iptables binaries are replaced by stand-ins counting their invocations,
+# so this runs without root and measures the process/transaction overhead only.
+#
+#   python3 bench/bench_firewall.py [rounds]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TORO2_DIR = os.path.join(os.path.dirname(HERE), 'toro2')
+sys.path.insert(0, TORO2_DIR)
+
+import firewall  # noqa: E402
+
+
+STUB = '''#!/bin/sh
+echo "$0" >> "{calls}"
+[ "$(basename "$0")" = "iptables-restore" ] || [ "$(basename "$0")" = "ip6tables-restore" ] && cat > /dev/null
+exit 0
+'''
+
+
+def make_stubs(stubdir, calls):
+    for name in ('iptables', 'iptables-save', 'iptables-restore', 'ip6tables', 'ip6tables-save',
+                 'ip6tables-restore'):
+        path = os.path.join(stubdir, name)
+        with open(path, 'w') as f:
+            f.write(STUB.format(calls=calls))
+        os.chmod(path, 0o755)
+
+
+def count_calls(calls):
+    if not os.path.exists(calls):
+        return 0
+    with open(calls) as f:
+        n = len(f.readlines())
+    os.remove(calls)
+    return n
+
+
+def run_shell(stubdir, workdir):
+    env = dict(os.environ, PATH=f'{stubdir}:{os.environ.get("PATH", "")}')
+    subprocess.run(['bash', os.path.join(TORO2_DIR, 'toro2.iptablesA')], cwd=workdir, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_compiled(stubdir, spec):
+    dump = subprocess.run([os.path.join(stubdir, 'iptables-save')], capture_output=True).stdout.decode()
+    ruleset = firewall.ipv4_ruleset(spec, firewall.parse_save(dump))
+    subprocess.run([os.path.join(stubdir, 'iptables-restore'), '--noflush'], input=ruleset.encode())
+    subprocess.run([os.path.join(stubdir, 'ip6tables-restore'), '--noflush'], input=firewall.ipv6_ruleset().encode())
+
+
+def bench(label, func, rounds, calls):
+    times = []
+    forks = 0
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+        forks = count_calls(calls)
+    times.sort()
+    print(f'{label:<28} median {times[len(times) // 2] * 1000:8.2f} ms   '
+          f'min {times[0] * 1000:8.2f} ms   iptables* execs {forks}')
+    return times[len(times) // 2]
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    spec = firewall.FirewallSpec(
+        tor_uid=1001, trans_port=9040, dns_port=5353,
+        ignore_tor=['192.168.100.0/24', '192.168.88.0/24', '192.168.1.0/24', '192.168.0.0/24'],
+        resv_iana=['0.0.0.0/8', '100.64.0.0/10', '169.254.0.0/16', '172.17.0.0/16', '173.17.0.0/16',
+                   '174.17.0.0/16', '192.0.0.0/24', '192.0.2.0/24', '192.88.99.0/24', '198.18.0.0/15',
+                   '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4', '255.255.255.255/32'],
+        out_ifaces=['enp3s0', 'wlp5s0', 'ppp0', 'wg0', 'vboxnet0', 'wlp0s20f3', 'tun0', 'tun1'],
+        vpn_iface='tun0', vpn_up=False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        calls = os.path.join(tmp, 'calls')
+        make_stubs(tmp, calls)
+
+        shell = bench('toro2.iptablesA (shell)', lambda: run_shell(tmp, tmp), rounds, calls)
+        compiled = bench('compiled iptables-restore', lambda: run_compiled(tmp, spec), rounds, calls)
+
+    print(f'speedup x{shell / compiled:.1f}')
+
+
+if __name__ == '__main__':
+    main()
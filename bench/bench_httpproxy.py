@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# The built-in HTTP proxy (toro2 http-proxy) against a local stand-in
+# origin, reached through a stand-in for tor's SocksPort that takes
+# --stream-delay ms to open each stream (what building a stream to the
+# exit costs). Measures:
+#   latency     small GETs one after the other on one client connection,
+#               with the upstream pool (keepalive) and without it
+#   throughput  one large plain HTTP GET & the same through CONNECT, next
+#               to reading it through SOCKS directly
+#   parallel    requests/s of --clients clients at once
+# No tor, no network, no root.
+#
+#   python3 bench/bench_httpproxy.py [--requests N] [--size MiB] [--clients N] [--stream-delay ms]
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'toro2'))
+
+import httpproxy  # noqa: E402
+
+CHUNK = b'\0' * 65536
+
+
+async def _origin(reader, writer):
+    # GET /<bytes> => that many bytes, keep-alive
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            size = int(head.split(b' ', 2)[1].lstrip(b'/') or 0)
+            writer.write(f'HTTP/1.1 200 OK\r\nContent-Length: {size}\r\n\r\n'.encode())
+            while size:
+                n = min(size, len(CHUNK))
+                writer.write(CHUNK[:n])
+                await writer.drain()
+                size -= n
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _relay(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+def _socks(origin, delay):
+    # SOCKS5 that sends every CONNECT to origin, `delay` s after being asked
+    async def handle(reader, writer):
+        up_writer = None
+        try:
+            _, nmethods = await reader.readexactly(2)
+            methods = await reader.readexactly(nmethods)
+            if 2 in methods:
+                writer.write(b'\x05\x02')
+                _, ulen = await reader.readexactly(2)
+                await reader.readexactly(ulen)
+                await reader.readexactly((await reader.readexactly(1))[0])
+                writer.write(b'\x01\x00')
+            else:
+                writer.write(b'\x05\x00')
+            _, _, _, atyp = await reader.readexactly(4)
+            await reader.readexactly((await reader.readexactly(1))[0] + 2 if atyp == 3 else
+                                     4 + 2 if atyp == 1 else 16 + 2)
+            await asyncio.sleep(delay)
+            up_reader, up_writer = await asyncio.open_connection(*origin)
+            writer.write(b'\x05\x00\x00\x01' + b'\0' * 6)
+            await asyncio.gather(_relay(reader, up_writer), _relay(up_reader, writer))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            if up_writer is not None:
+                up_writer.close()
+
+    return handle
+
+
+class Standins:
+    # origin & SOCKS server on a loop of their own
+    def __init__(self, delay):
+        self.delay = delay
+        self.loop = asyncio.new_event_loop()
+        self.tasks = set()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _tracked(self, handle):
+        # connection tasks, cancelled by close()
+        async def tracked(reader, writer):
+            task = asyncio.current_task()
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            try:
+                await handle(reader, writer)
+            except asyncio.CancelledError:
+                # closing: end quietly, start_server logs cancelled handlers
+                pass
+
+        return tracked
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.origin_server = self.loop.run_until_complete(
+            asyncio.start_server(self._tracked(_origin), '127.0.0.1', 0))
+        self.origin = self.origin_server.sockets[0].getsockname()[:2]
+        self.socks_server = self.loop.run_until_complete(
+            asyncio.start_server(self._tracked(_socks(self.origin, self.delay)), '127.0.0.1', 0))
+        self.socks = self.socks_server.sockets[0].getsockname()[:2]
+        ready.set()
+        self.loop.run_forever()
+
+    async def _close(self):
+        # no new connections, then the open ones cancelled & awaited
+        for server in (self.socks_server, self.origin_server):
+            server.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # the transports closed by the handlers go away on the next round
+        await asyncio.sleep(0)
+        for server in (self.socks_server, self.origin_server):
+            await server.wait_closed()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def start_proxy(socks, keepalive):
+    # => (proxy, the thread serving it)
+    proxy = httpproxy.HttpProxy(listen=('127.0.0.1', 0), socks=socks, keepalive=keepalive)
+    ready = threading.Event()
+    thread = threading.Thread(target=asyncio.run, args=(proxy.serve(ready),), daemon=True)
+    thread.start()
+    ready.wait()
+    return proxy, thread
+
+
+def _read_response(sock, buf):
+    # => body size, having read headers & body
+    head = b''
+    while b'\r\n\r\n' not in head:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise OSError('closed')
+        head += chunk
+    head, _, body = head.partition(b'\r\n\r\n')
+    length = int([line.split(b':')[1] for line in head.split(b'\r\n') if line.lower().startswith(b'content-length')][0])
+    got = len(body)
+    view = memoryview(buf)
+    while got < length:
+        n = sock.recv_into(view)
+        if not n:
+            raise OSError('closed')
+        got += n
+    return length
+
+
+def get(proxy, path, sock=None):
+    if sock is None:
+        sock = socket.create_connection(proxy.address)
+    sock.sendall(f'GET http://origin.test{path} HTTP/1.1\r\nHost: origin.test\r\n\r\n'.encode())
+    return sock
+
+
+def bench_latency(proxy, requests):
+    buf = bytearray(65536)
+    sock = socket.create_connection(proxy.address)
+    times = []
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        get(proxy, '/512', sock)
+        _read_response(sock, buf)
+        times.append(time.perf_counter() - t0)
+    sock.close()
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.95) - 1]
+
+
+def _throughput(sock, size, buf):
+    t0 = time.perf_counter()
+    _read_response(sock, buf)
+    return size / (time.perf_counter() - t0)
+
+
+def bench_throughput(proxy, socks, size):
+    buf = bytearray(1 << 20)
+    out = {}
+
+    sock = get(proxy, f'/{size}')
+    out['plain HTTP'] = _throughput(sock, size, buf)
+    sock.close()
+
+    sock = socket.create_connection(proxy.address)
+    sock.sendall(b'CONNECT origin.test:80 HTTP/1.1\r\nHost: origin.test:80\r\n\r\n')
+    reply = b''
+    while b'\r\n\r\n' not in reply:
+        reply += sock.recv(4096)
+    sock.sendall(f'GET /{size} HTTP/1.1\r\nHost: origin.test\r\n\r\n'.encode())
+    out['CONNECT'] = _throughput(sock, size, buf)
+    sock.close()
+
+    sock = socket.create_connection(socks)
+    sock.sendall(b'\x05\x01\x00\x05\x01\x00\x03\x0borigin.test' + struct.pack('!H', 80))
+    reply = b''
+    while len(reply) < 12:
+        reply += sock.recv(12 - len(reply))
+    sock.sendall(f'GET /{size} HTTP/1.1\r\nHost: origin.test\r\n\r\n'.encode())
+    out['SOCKS, no proxy'] = _throughput(sock, size, buf)
+    sock.close()
+    return out
+
+
+def bench_parallel(proxy, clients, requests):
+    def client():
+        buf = bytearray(65536)
+        sock = socket.create_connection(proxy.address)
+        for _ in range(requests):
+            get(proxy, '/4096', sock)
+            _read_response(sock, buf)
+        sock.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return clients * requests / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64, help='MiB read in the throughput runs')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--stream-delay', type=float, default=20, help='ms the stand-in tor takes per stream')
+    args = parser.parse_args()
+
+    standins = Standins(args.stream_delay / 1000)
+    proxies = []
+    try:
+        proxies.append(start_proxy(standins.socks, keepalive=5))
+        proxies.append(start_proxy(standins.socks, keepalive=0))
+        (pooled, _), (unpooled, _) = proxies
+
+        print(f'stand-in tor: {args.stream_delay:g} ms per stream')
+        for name, proxy in (('pool', pooled), ('no pool', unpooled)):
+            median, p95 = bench_latency(proxy, args.requests)
+            print(f'latency {name:<10} median {median * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms')
+
+        for name, rate in bench_throughput(pooled, standins.socks, args.size << 20).items():
+            print(f'throughput {name:<16} {rate / (1 << 20):8.1f} MiB/s')
+
+        rate = bench_parallel(pooled, args.clients, max(1, args.requests // 4))
+        print(f'parallel {args.clients} clients      {rate:8.0f} req/s')
+        print(f'proxy stats: {pooled.stats}')
+
+    finally:
+        # the proxies first: their pooled upstreams are SOCKS connections
+        for proxy, thread in proxies:
+            proxy.close()
+            thread.join()
+        standins.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# Metrics exporter under load: a synthetic busy tor (BW every second, circuits
+# launched/built/closed, streams opening & closing, CIRC_BW, some failures &
+# NEWNYMs) fed to metrics.TorMetrics, reporting events/s and the memory held
+# after each slice of the run, which must stay flat however long it goes. Then
+# the same stream over a stand-in control port through metrics.Collector,
+# with /metrics scraped while it runs. No tor & no network needed.
+#
+#   python3 bench/bench_metrics.py [events]
+
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'toro2'))
+
+import metrics  # noqa: E402
+import torcontrol  # noqa: E402
+
+SLICES = 5
+
+
+def events(n, seed=1):
+    # a tor with ~500 streams & ~60 circuits open at any time, ids always new
+    rnd = random.Random(seed)
+    circs, streams = [], []
+    next_id = 1
+    now = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+    for i in range(n):
+        r = rnd.random()
+        if i % 50 == 0:
+            yield f'BW {rnd.randrange(1 << 20)} {rnd.randrange(1 << 18)}'
+        elif r < 0.05 or not circs:
+            cid = str(next_id)
+            next_id += 1
+            yield f'CIRC {cid} LAUNCHED BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED={now}.000000'
+            if rnd.random() < 0.1:
+                yield f'CIRC {cid} FAILED BUILD_FLAGS=NEED_CAPACITY REASON={rnd.choice(["TIMEOUT", "DESTROYED"])}'
+                yield f'CIRC {cid} CLOSED REASON=FINISHED'
+            else:
+                yield (f'CIRC {cid} BUILT $A~a,$B~b,$C~c BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL '
+                       f'TIME_CREATED={now}.{rnd.randrange(1000000):06d}')
+                circs.append(cid)
+            if len(circs) > 60:
+                yield f'CIRC {circs.pop(0)} CLOSED $A~a,$B~b,$C~c REASON=FINISHED'
+        elif r < 0.45:
+            sid = str(next_id)
+            next_id += 1
+            cid = rnd.choice(circs)
+            yield f'STREAM {sid} NEW 0 example.com:443 SOURCE_ADDR=127.0.0.1:{rnd.randrange(1024, 65535)}'
+            yield f'STREAM {sid} SENTCONNECT {cid} example.com:443'
+            if rnd.random() < 0.03:
+                yield f'STREAM {sid} FAILED {cid} example.com:443 REASON=TIMEOUT'
+            else:
+                yield f'STREAM {sid} SUCCEEDED {cid} example.com:443'
+                streams.append(sid)
+            if len(streams) > 500:
+                yield f'STREAM {streams.pop(0)} CLOSED {cid} example.com:443 REASON=DONE'
+        elif r < 0.999:
+            yield f'CIRC_BW ID={rnd.choice(circs)} READ={rnd.randrange(1 << 16)} WRITTEN={rnd.randrange(1 << 12)}'
+        else:
+            yield 'SIGNAL NEWNYM'
+
+
+def in_process(n):
+    stream = list(events(n))
+    per_slice = len(stream) // SLICES
+    slices = [stream[s * per_slice:(s + 1) * per_slice] for s in range(SLICES)]
+    print(f'{len(stream)} events, in process')
+
+    # speed untraced, then memory held (tracemalloc slows everything down)
+    tor = metrics.TorMetrics()
+    rates = []
+    for chunk in slices:
+        t0 = time.perf_counter()
+        for e in chunk:
+            tor.on_event(e)
+        rates.append(len(chunk) / (time.perf_counter() - t0))
+
+    tracemalloc.start()
+    tor = metrics.TorMetrics()
+    for s, chunk in enumerate(slices):
+        for e in chunk:
+            tor.on_event(e)
+        held, _ = tracemalloc.get_traced_memory()
+        print(f'  slice {s + 1}: {rates[s]:10.0f} events/s   {len(tor._circuits):4} circuits '
+              f'{len(tor._streams):4} streams open   {held / 1024:8.1f} KiB held')
+    tracemalloc.stop()
+
+    t0 = time.perf_counter()
+    text = metrics.render([tor])
+    print(f'  render: {(time.perf_counter() - t0) * 1000:.2f} ms, {len(text.splitlines())} lines')
+    return stream
+
+
+class StandinControl(socketserver.ThreadingTCPServer):
+    # answers what Collector asks, then pushes the stream as 650 events
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stream):
+        super().__init__(('127.0.0.1', 0), StandinControl.Handler)
+        self.stream = stream
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                words = line.decode().split()
+                cmd = words[0].upper() if words else ''
+                if cmd == 'PROTOCOLINFO':
+                    self.wfile.write(b'250-PROTOCOLINFO 1\r\n250-AUTH METHODS=NULL\r\n250 OK\r\n')
+                elif cmd == 'GETINFO' and words[1] == 'status/bootstrap-phase':
+                    self.wfile.write(b'250-status/bootstrap-phase=NOTICE BOOTSTRAP PROGRESS=100 TAG=done '
+                                     b'SUMMARY="Done"\r\n250 OK\r\n')
+                elif cmd == 'GETINFO':
+                    self.wfile.write(f'250+{words[1]}=\r\n.\r\n250 OK\r\n'.encode())
+                elif cmd == 'SETEVENTS':
+                    self.wfile.write(b'250 OK\r\n')
+                    self.wfile.write(''.join(f'650 {e}\r\n' for e in self.server.stream).encode())
+                    self.wfile.flush()
+                elif cmd == 'QUIT':
+                    return
+                else:
+                    self.wfile.write(b'250 OK\r\n')
+
+
+def over_the_wire(stream):
+    control = StandinControl(stream)
+    threading.Thread(target=control.serve_forever, daemon=True).start()
+
+    tor = metrics.TorMetrics()
+    server = metrics.serve(('127.0.0.1', 0), [tor])
+    url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+
+    done = threading.Event()
+    collector = metrics.Collector(lambda: torcontrol.TorController(port=control.server_address[1]), tor)
+    t0 = time.perf_counter()
+    threading.Thread(target=collector.run, args=(done.is_set,), daemon=True).start()
+
+    scrapes = []
+    while True:
+        loaded = tor.events < len(stream)
+        s0 = time.perf_counter()
+        with urllib.request.urlopen(url) as r:
+            body = r.read()
+        scrapes.append(time.perf_counter() - s0)
+        if not loaded:
+            break
+        time.sleep(0.05)
+    took = time.perf_counter() - t0
+    done.set()
+
+    print(f'{len(stream)} events over the control port: {len(stream) / took:.0f} events/s, '
+          f'{len(scrapes)} scrapes, slowest {max(scrapes) * 1000:.1f} ms')
+    wanted = [b'toro2_tor_up{instance="tor"} 1', b'toro2_tor_bootstrap_percent{instance="tor"} 100',
+              f'toro2_tor_events_total{{instance="tor"}} {len(stream)}'.encode()]
+    missing = [w.decode() for w in wanted if w not in body]
+    if missing:
+        print(f'missing from /metrics: {missing}')
+        return False
+
+    server.shutdown()
+    control.shutdown()
+    return True
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    stream = in_process(n)
+    if not over_the_wire(stream[:min(len(stream), 200000)]):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
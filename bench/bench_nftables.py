@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Per-packet rule traversal: iptables TORO2CHAIN_OUTPUT (nat + filter) against
+# the nftables backend where bypass/reserved networks are interval sets and
+# output interfaces a verdict map.
+#
+# Both rulesets, as firewall.py generates them (iptables rules & the nft
+# table text), are compiled to a small in-process model and evaluated over
+# synthetic new connections, counting the rules each packet is matched
+# against before it gets a verdict. No root & no netfilter needed.
+#
+#   python3 bench/bench_nftables.py [packets]
+
+import bisect
+import ipaddress
+import os
+import random
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'toro2'))
+
+import firewall  # noqa: E402
+
+
+class Packet:
+    def __init__(self, daddr, oif, proto, dport, uid, state='NEW', syn=True):
+        self.daddr = ipaddress.ip_address(daddr)
+        self.oif = oif
+        self.proto = proto
+        self.dport = dport
+        self.uid = uid
+        self.state = state
+        self.syn = syn
+
+
+def compile_iptables_rule(spec):
+    # just enough of the iptables match syntax used by firewall.py
+    tokens = spec.split()
+    checks = []
+    verdict = None
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        if t == '-d':
+            net = ipaddress.ip_network(tokens[i + 1])
+            checks.append(lambda p, net=net: p.daddr in net)
+            i += 2
+        elif t == '-o':
+            oif = tokens[i + 1]
+            checks.append(lambda p, oif=oif: p.oif == oif)
+            i += 2
+        elif t == '-p':
+            proto = tokens[i + 1]
+            checks.append(lambda p, proto=proto: p.proto == proto)
+            i += 2
+        elif t == '--dport':
+            port = int(tokens[i + 1])
+            checks.append(lambda p, port=port: p.dport == port)
+            i += 2
+        elif t == '--uid-owner':
+            uid = int(tokens[i + 1])
+            checks.append(lambda p, uid=uid: p.uid == uid)
+            i += 2
+        elif t == '--state':
+            states = tokens[i + 1].split(',')
+            checks.append(lambda p, states=states: p.state in states)
+            i += 2
+        elif t == '--tcp-flags':
+            checks.append(lambda p: p.syn)
+            i += 3
+        elif t == '--icmp-type':
+            checks.append(lambda p: False)
+            i += 2
+        elif t == '-j':
+            verdict = tokens[i + 1]
+            break
+        else:
+            i += 1
+
+    return lambda p: all(c(p) for c in checks), verdict
+
+
+def iptables_chain(rules):
+    return [compile_iptables_rule(r) for _, r in rules]
+
+
+def walk_chain(chain, packet):
+    n = 0
+    for match, verdict in chain:
+        n += 1
+        if match(packet):
+            return n, verdict
+    return n, 'POLICY'
+
+
+class IntervalSet:
+    # nft interval set lookup: one binary search over merged ranges
+    def __init__(self, nets):
+        ranges = sorted((int(n.network_address), int(n.broadcast_address))
+                        for n in map(ipaddress.ip_network, nets))
+        self.starts = [r[0] for r in ranges]
+        self.ends = [r[1] for r in ranges]
+
+    def __contains__(self, addr):
+        a = int(addr)
+        i = bisect.bisect_right(self.starts, a) - 1
+        return i >= 0 and a <= self.ends[i]
+
+
+def _nft_value(tokens, i):
+    # => (values, next index): one word, or an anonymous set { a, b }
+    if tokens[i] != '{':
+        return [tokens[i].strip('"')], i + 1
+    j = tokens.index('}', i)
+    return [t.strip(',"') for t in tokens[i + 1:j] if t.strip(',')], j + 1
+
+
+def compile_nft_rule(line, sets, maps):
+    # just enough of the nft syntax firewall.nft_ruleset() writes
+    tokens = line.split()
+    checks = []
+    verdict = None
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        if t == 'meta' and tokens[i + 1] == 'nfproto':
+            # the packets are IPv4
+            checks.append(lambda p, fam=tokens[i + 2]: fam == 'ipv4')
+            i += 3
+        elif t == 'meta' and tokens[i + 1] == 'l4proto':
+            protos, i = _nft_value(tokens, i + 2)
+            checks.append(lambda p, protos=protos: p.proto in protos)
+        elif t == 'meta' and tokens[i + 1] == 'skuid':
+            checks.append(lambda p, uid=int(tokens[i + 2]): p.uid == uid)
+            i += 3
+        elif t == 'ip' and tokens[i + 1] == 'daddr':
+            target = tokens[i + 2]
+            if target.startswith('@'):
+                checks.append(lambda p, s=sets[target[1:]]: p.daddr in s)
+            else:
+                checks.append(lambda p, net=ipaddress.ip_network(target): p.daddr in net)
+            i += 3
+        elif t in ('tcp', 'udp', 'th') and tokens[i + 1] == 'dport':
+            ports, i = _nft_value(tokens, i + 2)
+            ports = [int(port) for port in ports]
+            checks.append(lambda p, proto=t, ports=ports: (proto == 'th' or p.proto == proto) and p.dport in ports)
+        elif t == 'tcp' and tokens[i + 1] == 'flags':
+            # tcp flags & (fin|syn|rst|ack) == syn
+            checks.append(lambda p: p.proto == 'tcp' and p.syn)
+            i += 6
+        elif t == 'icmp':
+            checks.append(lambda p: p.proto == 'icmp')
+            i += 3
+        elif t == 'ct' and tokens[i + 1] == 'state':
+            states = tokens[i + 2].upper().split(',')
+            checks.append(lambda p, states=states: p.state in states)
+            i += 3
+        elif t == 'oifname' and tokens[i + 1] == 'vmap':
+            # verdict looked up by interface, no match when it isn't in the map
+            vmap = maps[tokens[i + 2][1:]]
+            checks.append(lambda p, vmap=vmap: p.oif in vmap)
+            verdict = '/'.join(sorted(set(vmap.values()))).upper() or 'NONE'
+            break
+        elif t in ('oifname', 'iifname'):
+            target = tokens[i + 1]
+            names = sets[target[1:]] if target.startswith('@') else {target.strip('"')}
+            checks.append(lambda p, names=names: p.oif in names)
+            i += 2
+        elif t in ('accept', 'drop', 'return', 'redirect'):
+            verdict = t.upper()
+            break
+        else:
+            raise ValueError(f'bench model does not know nft syntax {t!r}: {line}')
+
+    if verdict is None:
+        raise ValueError(f'no verdict in nft rule: {line}')
+    return lambda p: all(c(p) for c in checks), verdict
+
+
+def nft_chains(spec):
+    # nat_output & output of the table firewall.nft_ruleset() generates:
+    # interval sets looked up by binary search, the verdict map by name
+    text = firewall.nft_ruleset(spec)
+    sets, maps, chains = {}, {}, {}
+    for m in re.finditer(r'^\s*set (\w+) \{ type (\w+);.*?(?:elements = \{ (.*?) \};)? \}$', text, re.M):
+        name, stype, elements = m.group(1), m.group(2), (m.group(3) or '').split(', ')
+        elements = [e.strip('"') for e in elements if e]
+        sets[name] = IntervalSet(elements) if stype == 'ipv4_addr' else set(elements)
+    for m in re.finditer(r'^\s*map (\w+) \{ type [^;]*;(?: elements = \{ (.*?) \};)? \}$', text, re.M):
+        pairs = [e.split(' : ') for e in (m.group(2) or '').split(', ') if e]
+        maps[m.group(1)] = {k.strip('"'): v for k, v in pairs}
+    for m in re.finditer(r'^\s*chain (\w+) \{\n(.*?)^\s*\}$', text, re.M | re.S):
+        rules = [line.strip() for line in m.group(2).splitlines()[1:] if line.strip()]
+        chains[m.group(1)] = [compile_nft_rule(line, sets, maps) for line in rules]
+    return chains['nat_output'], chains['output']
+
+
+def traffic(spec, n, seed=4):
+    rnd = random.Random(seed)
+    lan = [str(ipaddress.ip_network(net)[5]) for net in spec.ignore_tor] or ['192.168.1.5']
+    out = []
+    for _ in range(n):
+        kind = rnd.random()
+        if kind < 0.6:
+            # generic internet traffic -> redirected to TransPort, then accepted on lo
+            out.append(Packet(f'{rnd.randint(11, 99)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.7',
+                              rnd.choice(spec.out_ifaces), 'tcp', 443, 1000))
+        elif kind < 0.8:
+            # tor itself reaching relays
+            out.append(Packet(f'{rnd.randint(11, 99)}.1.2.3', rnd.choice(spec.out_ifaces), 'tcp', 9001,
+                              spec.tor_uid))
+        else:
+            out.append(Packet(rnd.choice(lan), rnd.choice(spec.out_ifaces), 'tcp', 22, 1000))
+    return out
+
+
+def run(label, nat, filt, packets):
+    visited = 0
+    t0 = time.perf_counter()
+    for p in packets:
+        n, _ = walk_chain(nat, p)
+        visited += n
+        n, _ = walk_chain(filt, p)
+        visited += n
+    dt = time.perf_counter() - t0
+    print(f'{label:<10} rules/packet {visited / len(packets):6.2f}   model {dt / len(packets) * 1e6:6.2f} us/packet')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    spec = firewall.FirewallSpec(
+        tor_uid=1001, trans_port=9040, dns_port=5353,
+        ignore_tor=['192.168.100.0/24', '192.168.88.0/24', '192.168.1.0/24', '192.168.0.0/24'],
+        resv_iana=['0.0.0.0/8', '100.64.0.0/10', '169.254.0.0/16', '172.17.0.0/16', '173.17.0.0/16',
+                   '174.17.0.0/16', '192.0.0.0/24', '192.0.2.0/24', '192.88.99.0/24', '198.18.0.0/15',
+                   '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4', '255.255.255.255/32'],
+        out_ifaces=['enp3s0', 'wlp5s0', 'ppp0', 'wg0', 'vboxnet0', 'wlp0s20f3', 'tun0', 'tun1'],
+        vpn_iface='tun0', vpn_up=False)
+    packets = traffic(spec, n)
+
+    ipt_filter = iptables_chain([r for r in firewall.filter_rules(spec) if r[0] == 'TORO2CHAIN_OUTPUT'])
+    ipt_nat = iptables_chain(firewall.nat_rules(spec))
+    run('iptables', ipt_nat, ipt_filter, packets)
+
+    nft_nat, nft_filter = nft_chains(spec)
+    run('nftables', nft_nat, nft_filter, packets)
+
+
+if __name__ == '__main__':
+    main()
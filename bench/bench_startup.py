@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Cold start of the toro2 CLI, per verb, the way the launcher runs it (toro2
+# imported from its precompiled __pycache__), against a time budget on top
+# of a bare interpreter start. Exits 1 when a verb goes over its budget.
+#
+# Runs from a scratch copy of the config: systemctl, sudo & iptables are
+# stand-ins, no root needed, the running system is not looked at.
+#
+#   python3 bench/bench_startup.py [rounds]
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TORO2_DIR = os.path.join(os.path.dirname(HERE), 'toro2')
+
+# ms allowed above `python3 -c pass`
+BUDGET_MS = {
+    'version': 50,
+    'help': 50,
+    'status': 80,
+    'isnaked': 80,
+}
+
+LAUNCHER = ('import sys; sys.path.insert(0, {dir!r}); sys.argv[0] = "toro2"; '
+            'import toro2; toro2.main()')
+
+STUBS = {
+    'systemctl': '''#!/bin/sh
+[ "$1" = show ] || exit 0
+shift 3
+for u in "$@"; do printf 'ActiveState=active\\nSubState=running\\nMainPID=1\\n\\n'; done
+''',
+    'sudo': '#!/bin/sh\nexec "$@"\n',
+    'iptables': '#!/bin/sh\necho "Chain OUTPUT (policy DROP)"\n',
+    'ip6tables': '#!/bin/sh\necho "Chain OUTPUT (policy DROP)"\n',
+}
+
+
+def make_home(tmp):
+    bindir = os.path.join(tmp, 'bin')
+    os.makedirs(bindir)
+    for name, body in STUBS.items():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write(body)
+        os.chmod(path, 0o755)
+
+    home = os.path.join(tmp, 'home')
+    os.makedirs(os.path.join(home, 'toro2'))
+    shutil.copy(os.path.join(TORO2_DIR, 'toro2.torrc'), os.path.join(home, 'toro2'))
+
+    overrides = {
+        'toro2_homedir': home,
+        'systemctl': os.path.join(bindir, 'systemctl'),
+        'iptables': os.path.join(bindir, 'iptables'),
+        'ip6tables': os.path.join(bindir, 'ip6tables'),
+        'pidfile': os.path.join(tmp, 'toro2.pid'),
+        'daemon_socket': os.path.join(tmp, 'toro2.sock'),
+    }
+    with open(os.path.join(TORO2_DIR, 'toro2.conf')) as f, \
+            open(os.path.join(home, 'toro2', 'toro2.conf'), 'w') as out:
+        for line in f:
+            key = line.split('=', 1)[0]
+            out.write(f'{key}={overrides.pop(key)}\n' if key in overrides else line)
+
+    return bindir, home
+
+
+def run(cmd, env, cwd):
+    t0 = time.perf_counter()
+    subprocess.run(cmd, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+def median(times):
+    times = sorted(times)
+    return times[len(times) // 2]
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bindir, home = make_home(tmp)
+        env = dict(os.environ, PATH=f'{bindir}:{os.environ.get("PATH", "")}', TMPDIR=tmp,
+                   PYTHONPYCACHEPREFIX=os.path.join(tmp, 'pycache'), TORO2_NO_DAEMON='1')
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        cmd = [sys.executable, '-c', LAUNCHER.format(dir=TORO2_DIR)]
+
+        # no /etc/toro2: toro2.conf is looked up in ./toro2/
+        # pyc files & config snapshot written once, as after install
+        run(cmd + ['status'], env, home)
+
+        bare = median([run([sys.executable, '-c', 'pass'], env, tmp) for _ in range(rounds)])
+        print(f'{"python3 -c pass":<24} median {bare * 1000:8.2f} ms')
+
+        over = []
+        for verb, budget in BUDGET_MS.items():
+            took = median([run(cmd + [verb], env, home) for _ in range(rounds)]) - bare
+            ok = took * 1000 <= budget
+            if not ok:
+                over.append(verb)
+            print(f'toro2 {verb:<18} +{took * 1000:8.2f} ms   budget +{budget} ms   {"ok" if ok else "OVER"}')
+
+        # what the config snapshot saves: parse toro2.conf & toro2.torrc every time
+        cache = os.path.join(tmp, f'toro2-{os.getuid()}.conf.cache')
+        cold = []
+        for _ in range(rounds):
+            os.remove(cache)
+            cold.append(run(cmd + ['status'], env, home))
+        print(f'{"status, no snapshot":<24} +{(median(cold) - bare) * 1000:8.2f} ms')
+
+    if over:
+        print(f'over budget: {", ".join(over)}')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
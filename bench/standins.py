@@ -0,0 +1,512 @@
+# Stand-ins for the binaries toro2 runs (the iptables family, systemctl,
+# chattr, sudo, tor), for bench/bench_commands.py. write_bin() puts them
+# in a directory as small executables running main(); every call is
+# appended to <state>/calls.jsonl, state lives in <state>/*.json:
+#   iptables*    in-memory ruleset per family (iptables.json, ip6tables.json):
+#                -L/-P, iptables-save [-c] [-f], iptables-restore [--noflush]
+#                [--counters] with per-table COMMIT as the real one
+#   systemctl    unit states (units.json): start/stop/restart/..., is-active, show
+#   chattr       no-op (setting the flag needs CAP_LINUX_IMMUTABLE)
+#   sudo         runs the command (sh: not one more interpreter start)
+#   tor          prints bootstrap lines & serves a control port (NULL auth,
+#                PROTOCOLINFO/GETINFO/SETEVENTS/SIGNAL/EXTENDCIRCUIT)
+
+import fcntl
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+# builtin chains & policies of a fresh ruleset
+TABLES = {
+    'filter': ['INPUT', 'FORWARD', 'OUTPUT'],
+    'nat': ['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'],
+    'mangle': ['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING'],
+    'raw': ['PREROUTING', 'OUTPUT'],
+}
+
+IPTABLES = {
+    'iptables': ('iptables', 'cli'), 'iptables-save': ('iptables', 'save'), 'iptables-restore': ('iptables', 'restore'),
+    'ip6tables': ('ip6tables', 'cli'), 'ip6tables-save': ('ip6tables', 'save'),
+    'ip6tables-restore': ('ip6tables', 'restore'),
+}
+
+SUDO = '''#!/bin/sh
+printf '{"prog": "sudo", "argv": ["%s"], "pid": %d}\\n' "$1" $$ >> {calls}
+exec "$@"
+'''
+
+SCRIPT = '''#!{python} -S
+import sys
+sys.path.insert(0, {bench!r})
+import standins
+standins.main({name!r}, {state!r})
+'''
+
+BOOTSTRAP = [(0, 'starting', 'Starting'), (5, 'conn', 'Connecting to a relay'),
+             (10, 'conn_done', 'Connected to a relay'), (14, 'handshake', 'Handshaking with a relay'),
+             (15, 'handshake_done', 'Handshake with a relay done'),
+             (75, 'enough_dirinfo', 'Loaded enough directory info to build circuits'),
+             (90, 'ap_handshake_done', 'Handshake finished with a relay to build circuits'),
+             (95, 'circuit_create', 'Establishing a Tor circuit'), (100, 'done', 'Done')]
+
+
+def write_bin(bindir, state, bootstrap_ms=100):
+    # => {name: path} of the stand-ins written to bindir
+    os.makedirs(bindir, exist_ok=True)
+    os.makedirs(state, exist_ok=True)
+    with open(os.path.join(state, 'config.json'), 'w') as f:
+        json.dump({'bootstrap_ms': bootstrap_ms}, f)
+
+    paths = {}
+    bench = os.path.dirname(os.path.abspath(__file__))
+    for name in [*IPTABLES, 'systemctl', 'chattr', 'tor', 'sudo']:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            if name == 'sudo':
+                f.write(SUDO.replace('{calls}', os.path.join(state, 'calls.jsonl')))
+            else:
+                f.write(SCRIPT.format(python=sys.executable, bench=bench, name=name, state=state))
+        os.chmod(path, 0o755)
+        paths[name] = path
+    return paths
+
+
+def read_calls(state):
+    # => [call], clearing the log
+    path = os.path.join(state, 'calls.jsonl')
+    try:
+        with open(path) as f:
+            calls = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+    os.remove(path)
+    return calls
+
+
+class _State:
+    # a JSON file read & written under an exclusive lock
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+
+    def __enter__(self):
+        self._lock = open(f'{self.path}.lock', 'w')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = self.default()
+        return self
+
+    def save(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+    def __exit__(self, *exc):
+        self._lock.close()
+
+
+class RestoreError(Exception):
+    pass
+
+
+def _fresh_ruleset():
+    return {table: _fresh_table(table) for table in ('filter', 'nat')}
+
+
+def _fresh_table(table):
+    return {chain: {'policy': 'ACCEPT', 'rules': []} for chain in TABLES.get(table, [])}
+
+
+def _references(table, chain):
+    return any(re.search(rf'(^|\s)-[jg] {re.escape(chain)}(\s|$)', spec)
+               for c in table.values() for spec, _ in c['rules'])
+
+
+def _chain(table, name, lineno):
+    if name not in table:
+        raise RestoreError(f'line {lineno}: chain {name} does not exist')
+    return table[name]
+
+
+def _position(chain, arg, lineno, insert=False):
+    try:
+        pos = int(arg)
+    except ValueError:
+        raise RestoreError(f'line {lineno}: bad rule number {arg!r}')
+    if pos < 1 or pos > len(chain['rules']) + (1 if insert else 0):
+        raise RestoreError(f'line {lineno}: index of {"insertion" if insert else "rule"} too big')
+    return pos - 1
+
+
+def apply_command(table, args, lineno, counters=(0, 0)):
+    # one rule command of a restore file (or the command line) on table
+    op, name, rest = args[0], args[1] if len(args) > 1 else None, args[2:]
+    if op == '-A':
+        _chain(table, name, lineno)['rules'].append([' '.join(rest), list(counters)])
+    elif op == '-I':
+        chain = _chain(table, name, lineno)
+        pos = 0
+        if rest and rest[0].isdigit():
+            pos = _position(chain, rest[0], lineno, insert=True)
+            rest = rest[1:]
+        chain['rules'].insert(pos, [' '.join(rest), list(counters)])
+    elif op == '-R':
+        chain = _chain(table, name, lineno)
+        chain['rules'][_position(chain, rest[0], lineno)] = [' '.join(rest[1:]), list(counters)]
+    elif op == '-D':
+        chain = _chain(table, name, lineno)
+        if len(rest) == 1 and rest[0].isdigit():
+            del chain['rules'][_position(chain, rest[0], lineno)]
+        else:
+            spec = ' '.join(rest)
+            for i, (s, _) in enumerate(chain['rules']):
+                if s == spec:
+                    del chain['rules'][i]
+                    break
+            else:
+                raise RestoreError(f'line {lineno}: bad rule (does a matching rule exist in that chain?)')
+    elif op == '-F':
+        for chain in [_chain(table, name, lineno)] if name else table.values():
+            chain['rules'] = []
+    elif op == '-N':
+        if name in table:
+            raise RestoreError(f'line {lineno}: chain {name} already exists')
+        table[name] = {'policy': '-', 'rules': []}
+    elif op == '-X':
+        names = [name] if name else [n for n, c in table.items() if c['policy'] == '-']
+        for n in names:
+            chain = _chain(table, n, lineno)
+            if chain['policy'] != '-':
+                raise RestoreError(f'line {lineno}: can\'t delete built-in chain {n}')
+            if chain['rules'] or _references(table, n):
+                raise RestoreError(f'line {lineno}: chain {n} is not empty or still referenced')
+            del table[n]
+    elif op == '-P':
+        chain = _chain(table, name, lineno)
+        if chain['policy'] == '-' or not rest or rest[0] not in ('ACCEPT', 'DROP'):
+            raise RestoreError(f'line {lineno}: bad policy')
+        chain['policy'] = rest[0]
+    elif op == '-Z':
+        for chain in [_chain(table, name, lineno)] if name else table.values():
+            for rule in chain['rules']:
+                rule[1] = [0, 0]
+    else:
+        raise RestoreError(f'line {lineno}: unknown command {op}')
+
+
+_counters_re = re.compile(r'^\[(\d+):(\d+)\]\s+')
+
+
+def restore(ruleset, text, noflush=False, counters=False):
+    # iptables-restore: each table's changes go in at its COMMIT, or none of them
+    table_name, table = None, None
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('*'):
+            table_name = line[1:]
+            table = json.loads(json.dumps(ruleset.get(table_name) or _fresh_table(table_name)))
+            if not noflush:
+                table = {n: {'policy': c['policy'], 'rules': []} for n, c in table.items() if c['policy'] != '-'}
+        elif table is None:
+            raise RestoreError(f'line {lineno}: no table given')
+        elif line == 'COMMIT':
+            ruleset[table_name] = table
+            table_name, table = None, None
+        elif line.startswith(':'):
+            name, policy = line[1:].split()[:2]
+            if policy == '-':
+                # declaring a chain flushes it
+                table[name] = {'policy': '-', 'rules': []}
+            elif name in table and table[name]['policy'] != '-':
+                table[name]['policy'] = policy
+            else:
+                raise RestoreError(f'line {lineno}: {name} is not a built-in chain')
+        else:
+            rule_counters = (0, 0)
+            m = _counters_re.match(line)
+            if m:
+                rule_counters = (int(m.group(1)), int(m.group(2))) if counters else (0, 0)
+                line = line[m.end():]
+            apply_command(table, line.split(), lineno, rule_counters)
+
+    if table is not None:
+        raise RestoreError(f'table {table_name}: no COMMIT')
+
+
+def save(ruleset, counters=False, only=None):
+    out = [f'# Generated by iptables-save stand-in on {time.ctime()}']
+    for table_name, table in ruleset.items():
+        if only and table_name != only:
+            continue
+        out.append(f'*{table_name}')
+        out += [f':{n} {c["policy"]} [0:0]' for n, c in table.items()]
+        for n, c in table.items():
+            for spec, (pkts, nbytes) in c['rules']:
+                out.append(f'[{pkts}:{nbytes}] -A {n} {spec}' if counters else f'-A {n} {spec}')
+        out.append('COMMIT')
+    out.append('# Completed')
+    return '\n'.join(out) + '\n'
+
+
+def _option(args, *names):
+    for i, a in enumerate(args):
+        if a in names and i + 1 < len(args):
+            return args[i + 1]
+    return None
+
+
+def iptables(family, mode, args, state):
+    with _State(os.path.join(state, f'{family}.json'), _fresh_ruleset) as st:
+        if mode == 'save':
+            text = save(st.data, counters='-c' in args or '--counters' in args, only=_option(args, '-t', '--table'))
+            path = _option(args, '-f', '--file')
+            if path:
+                with open(path, 'w') as f:
+                    f.write(text)
+            else:
+                sys.stdout.write(text)
+            return 0
+
+        if mode == 'restore':
+            try:
+                restore(st.data, sys.stdin.read(), noflush='-n' in args or '--noflush' in args,
+                        counters='-c' in args or '--counters' in args)
+            except RestoreError as e:
+                print(f'{family}-restore: {e}', file=sys.stderr)
+                # what was committed before the failing table stays, as with the real one
+                st.save()
+                return 1
+            st.save()
+            return 0
+
+        args = [a for a in args if a not in ('-n', '-w', '-v', '--numeric', '--wait')]
+        table_name = _option(args, '-t', '--table') or 'filter'
+        if '-t' in args or '--table' in args:
+            i = args.index('-t') if '-t' in args else args.index('--table')
+            args = args[:i] + args[i + 2:]
+        table = st.data.setdefault(table_name, _fresh_table(table_name))
+
+        if args[:1] == ['-L']:
+            for name in args[1:2] or list(table):
+                chain = table.get(name)
+                if chain is None:
+                    print(f'{family}: No chain/target/match by that name.', file=sys.stderr)
+                    return 1
+                policy = f'policy {chain["policy"]}' if chain['policy'] != '-' else \
+                    f'{int(_references(table, name))} references'
+                print(f'Chain {name} ({policy})')
+                print('target     prot opt source               destination')
+                for spec, _ in chain['rules']:
+                    print(spec)
+            return 0
+
+        try:
+            apply_command(table, args, 0)
+        except (RestoreError, IndexError) as e:
+            print(f'{family}: {e}', file=sys.stderr)
+            return 1
+        st.save()
+        return 0
+
+
+def systemctl(args, state):
+    args = [a for a in args if not a.startswith('--') or a in ('--quiet',)]
+    quiet = '--quiet' in args
+    args = [a for a in args if a != '--quiet']
+    verb, units = args[0], args[1:]
+
+    with _State(os.path.join(state, 'units.json'), dict) as st:
+        if verb == 'show':
+            props = units[1].split(',') if units[:1] == ['-p'] else ['ActiveState', 'SubState', 'MainPID']
+            if units[:1] == ['-p']:
+                units = units[2:]
+            for unit in units:
+                active = st.data.get(unit, {}).get('active', False)
+                values = {'ActiveState': 'active' if active else 'inactive',
+                          'SubState': 'running' if active else 'dead',
+                          'MainPID': st.data.get(unit, {}).get('pid', 0) if active else 0}
+                print('\n'.join(f'{p}={values.get(p, "")}' for p in props) + '\n')
+            return 0
+
+        if verb == 'is-active':
+            active = [st.data.get(u, {}).get('active', False) for u in units]
+            if not quiet:
+                print('\n'.join('active' if a else 'inactive' for a in active))
+            return 0 if all(active) else 3
+
+        if verb == 'daemon-reload':
+            return 0
+
+        for unit in units:
+            unit_state = st.data.setdefault(unit, {'active': False, 'enabled': False})
+            if verb in ('start', 'restart', 'reload-or-restart'):
+                unit_state.update(active=True, pid=os.getpid())
+            elif verb == 'stop':
+                unit_state['active'] = False
+            elif verb == 'enable':
+                unit_state['enabled'] = True
+            elif verb == 'disable':
+                unit_state['enabled'] = False
+            elif verb != 'reload':
+                print(f'systemctl: unknown command {verb}', file=sys.stderr)
+                return 1
+        st.save()
+        return 0
+
+
+# tor
+
+def _torrc_ports(args):
+    torrc = _option(args, '-f')
+    ports = {}
+    with open(torrc) as f:
+        for line in f:
+            m = re.match(r'\s*(ControlPort|SocksPort)\s+(?:[\d.]+:)?(\d+)', line)
+            if m:
+                ports.setdefault(m.group(1), int(m.group(2)))
+    return ports
+
+
+class _Tor:
+    def __init__(self, bootstrap_ms):
+        self.bootstrap_ms = bootstrap_ms
+        self.phase = BOOTSTRAP[0]
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.circ = 0
+
+    def log(self, msg):
+        print(time.strftime('%b %d %H:%M:%S.000') + f' [notice] {msg}', flush=True)
+
+    def bootstrap(self):
+        for phase in BOOTSTRAP:
+            time.sleep(self.bootstrap_ms / 1000 / len(BOOTSTRAP))
+            with self.lock:
+                self.phase = phase
+                listeners = list(self.listeners)
+            self.log(f'Bootstrapped {phase[0]}% ({phase[1]}): {phase[2]}')
+            for send in listeners:
+                send(f'650 STATUS_CLIENT NOTICE BOOTSTRAP {self._phase_kv(phase)}\r\n')
+
+    @staticmethod
+    def _phase_kv(phase):
+        return f'PROGRESS={phase[0]} TAG={phase[1]} SUMMARY="{phase[2]}"'
+
+    def control(self, conn):
+        lock = threading.Lock()
+
+        def send(data):
+            with lock:
+                try:
+                    conn.sendall(data.encode())
+                except OSError:
+                    pass
+
+        events = set()
+        f = conn.makefile('r', newline='\r\n')
+        try:
+            for line in f:
+                words = line.strip().split()
+                if not words:
+                    continue
+                cmd = words[0].upper()
+                if cmd == 'PROTOCOLINFO':
+                    send('250-PROTOCOLINFO 1\r\n250-AUTH METHODS=NULL\r\n250-VERSION Tor="0.4.8.0-standin"\r\n'
+                         '250 OK\r\n')
+                elif cmd in ('AUTHENTICATE', 'SETCONF', 'RESETCONF'):
+                    send('250 OK\r\n')
+                elif cmd == 'SETEVENTS':
+                    events = set(words[1:])
+                    with self.lock:
+                        if 'STATUS_CLIENT' in events and send not in self.listeners:
+                            self.listeners.append(send)
+                        elif 'STATUS_CLIENT' not in events and send in self.listeners:
+                            self.listeners.remove(send)
+                    send('250 OK\r\n')
+                elif cmd == 'GETINFO':
+                    with self.lock:
+                        phase = self.phase
+                    known = {'status/bootstrap-phase': f'NOTICE BOOTSTRAP {self._phase_kv(phase)}',
+                             'version': '0.4.8.0-standin', 'status/circuit-established': str(int(phase[0] == 100))}
+                    missing = [k for k in words[1:] if k not in known]
+                    if missing:
+                        send(f'552 Unrecognized key "{missing[0]}"\r\n')
+                    else:
+                        send(''.join(f'250-{k}={known[k]}\r\n' for k in words[1:]) + '250 OK\r\n')
+                elif cmd == 'SIGNAL':
+                    send('250 OK\r\n')
+                    self.log(f'Received {words[1] if len(words) > 1 else "?"} signal')
+                elif cmd == 'EXTENDCIRCUIT':
+                    with self.lock:
+                        self.circ += 1
+                        circ = self.circ
+                    send(f'250 EXTENDED {circ}\r\n')
+                    if 'CIRC' in events:
+                        send(f'650 CIRC {circ} LAUNCHED\r\n650 CIRC {circ} BUILT\r\n')
+                elif cmd == 'QUIT':
+                    send('250 closing connection\r\n')
+                    break
+                else:
+                    send(f'510 Unrecognized command "{words[0]}"\r\n')
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if send in self.listeners:
+                    self.listeners.remove(send)
+            conn.close()
+
+
+def tor(args, state):
+    import signal
+
+    with open(os.path.join(state, 'config.json')) as f:
+        config = json.load(f)
+    ports = _torrc_ports(args)
+    t = _Tor(config['bootstrap_ms'])
+    t.log('Tor 0.4.8.0-standin running on Linux.')
+
+    # SIGHUP is a reload for tor, not an exit
+    signal.signal(signal.SIGHUP, lambda *_: t.log('Received reload signal (hup). Reloading config.'))
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(('127.0.0.1', ports.get('ControlPort', 9051)))
+    srv.listen(16)
+    t.log(f'Opened Control listener connection (ready) on 127.0.0.1:{srv.getsockname()[1]}')
+    threading.Thread(target=t.bootstrap, daemon=True).start()
+
+    with open(os.path.join(state, f'tor.{os.getpid()}.pid'), 'w') as f:
+        f.write(str(os.getpid()))
+    while True:
+        conn, _ = srv.accept()
+        threading.Thread(target=t.control, args=(conn,), daemon=True).start()
+
+
+def main(name, state):
+    args = sys.argv[1:]
+    with open(os.path.join(state, 'calls.jsonl'), 'a') as f:
+        f.write(json.dumps({'prog': name, 'argv': args, 'pid': os.getpid()}) + '\n')
+
+    if name in IPTABLES:
+        code = iptables(*IPTABLES[name], args, state)
+    elif name == 'systemctl':
+        code = systemctl(args, state)
+    elif name == 'tor':
+        code = tor(args, state)
+    else:
+        # chattr
+        code = 0
+    sys.stdout.flush()
+    os._exit(code)
@@ -266,6 +266,7 @@ configure_linux() {
   # sed -i "s~ExecStart=/usr/bin/dnscrypt-proxy~ExecStart=$(which dnscrypt-proxy 2>/dev/null) --config ~g" /usr/lib/systemd/system/dnscrypt-proxy.service ;
   # sed -i "s~ExecStart=/usr/bin/privoxy~ExecStart=$(which privoxy 2>/dev/null)~g" toro2/usr/lib/systemd/system/privoxy.service ;
   sed -i "s/OUT_IFACES=.*/OUT_IFACES=\"$(netstat -i | awk 'NR >2 {print $1}' | grep -v lo | paste -s -d ' ') $OUT_IFACES_DEFAULT\"/"  $TORO2_HOMEDIR/toro2/toro2.iptablesA ;
+  sed -i "s/^out_ifaces=.*/out_ifaces=[$(for oi in $(netstat -i | awk 'NR >2 {print $1}' | grep -v lo) $OUT_IFACES_DEFAULT; do echo -n "\"$oi\", "; done | sed 's/, $//')]/" $TORO2_HOMEDIR/toro2/toro2.conf ;
 
   # toro2 dns port setup
   local dns_port=$(cat toro2/toro2.conf |grep -i "dnscrypt_proxy_port"|awk -F '=' '{print $2}') ;
@@ -0,0 +1,47 @@
+import json
+import os
+import socket
+
+
+# the CLI side of 'toro2 daemon': only what a thin client needs, so that
+# status/switch/... don't pay for importing the rest of toro2
+
+DEFAULT_SOCKET = '/tmp/toro2.sock'
+
+# one JSON object per line both ways:
+#   -> {"cmd": "status", "args": {}}
+#   <- {"ok": true, "code": 0, "result": ..., "output": "what the command printed"}
+
+
+def socket_path(conf_files=()):
+    # clients only need this one key: scan for it instead of loading the whole config
+    if os.getenv('TORO2_SOCKET'):
+        return os.getenv('TORO2_SOCKET')
+
+    for conf in conf_files:
+        try:
+            with open(conf) as f:
+                for line in f:
+                    if line.startswith('daemon_socket='):
+                        return line.split('=', 1)[1].strip() or DEFAULT_SOCKET
+            return DEFAULT_SOCKET
+        except OSError:
+            continue
+
+    return DEFAULT_SOCKET
+
+
+def request(path, cmd, args=None, timeout=None):
+    # => reply dict; OSError if no daemon listens on path
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps({'cmd': cmd, 'args': args or {}}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+        if not line:
+            raise OSError(f'{path}: daemon closed the connection')
+        return json.loads(line)
+    finally:
+        sock.close()
@@ -0,0 +1,55 @@
+import marshal
+import os
+
+
+# Parsed toro2.conf (+ what toro2.torrc says) kept between commands, valid
+# as long as none of the source files changed (mtime, size, inode).
+# marshal: builtin, nothing to import, and the values are plain data.
+
+
+def cache_file():
+    return os.path.join(os.getenv('TMPDIR') or '/tmp', f'toro2-{os.getuid()}.conf.cache')
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def load(sources):
+    # => cached snapshot or None (missing, stale, or not trustworthy)
+    try:
+        with open(cache_file(), 'rb') as f:
+            st = os.fstat(f.fileno())
+            # /tmp is shared: only a file of ours nobody else can write is trusted
+            if st.st_uid != os.getuid() or st.st_mode & 0o022:
+                return None
+            entry = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if not isinstance(entry, dict) or entry.get('sources') != list(sources):
+        return None
+    if entry.get('stamps') != [_stamp(p) for p in sources]:
+        return None
+    return entry.get('snapshot')
+
+
+def store(sources, snapshot):
+    path = cache_file()
+    tmp = f'{path}.{os.getpid()}'
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump({'sources': list(sources), 'stamps': [_stamp(p) for p in sources],
+                          'snapshot': snapshot}, f)
+        os.replace(tmp, path)
+    except (OSError, ValueError):
+        # no cache, just slower next time
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
@@ -0,0 +1,188 @@
+import contextvars
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import client
+
+
+# the reply buffer of the request being run: a context variable, so the
+# orchestrator's worker threads (run in a copy of the requester's context)
+# write to it too
+_reply_buf = contextvars.ContextVar('reply_buf', default=None)
+
+
+class _ThreadStdout:
+    # sys.stdout replacement: what a command prints goes to the reply of the
+    # request running it, everything else to the real stdout
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        buf = _reply_buf.get()
+        if buf is None:
+            return self.stream.write(s)
+        buf.append(s)
+        return len(s)
+
+    def flush(self):
+        if _reply_buf.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def begin(self):
+        _reply_buf.set([])
+
+    def end(self):
+        out = ''.join(_reply_buf.get())
+        _reply_buf.set(None)
+        return out
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            self._reply({'ok': False, 'code': 1, 'error': 'permission denied'})
+            return
+
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+            except ValueError:
+                self._reply({'ok': False, 'code': 1, 'error': 'bad request'})
+                return
+            self._reply(self.server.daemon.dispatch(req.get('cmd'), req.get('args') or {}))
+
+    def _reply(self, reply):
+        try:
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+        except OSError:
+            # client went away
+            pass
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def peer_allowed(self, sock):
+        # same user as the daemon or root
+        try:
+            _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                             struct.calcsize('3i')))
+        except OSError:
+            return False
+        return uid in (0, os.getuid())
+
+
+class Daemon:
+    # Serves commands over a Unix socket from one long-lived process.
+    # commands: {name: (fn(args), mutating)}; state() -> snapshot dict,
+    # refreshed every `refresh` seconds and right after every mutating
+    # command. Mutating commands and refreshes run one at a time; reading
+    # the snapshot never waits for them.
+
+    def __init__(self, path, commands, state, refresh=2, log=None):
+        self.path = path
+        self.commands = commands
+        self._state_fn = state
+        self.refresh = float(refresh)
+        self.log = log or (lambda msg: None)
+        self.state = {}
+        self.lock = threading.RLock()
+        self._stop = threading.Event()
+        self._server = None
+
+    def update_state(self):
+        with self.lock:
+            try:
+                state = self._state_fn()
+            except Exception as e:
+                self.log(f'state refresh failed: {e}')
+                return self.state
+            state['updated'] = time.time()
+            self.state = state
+            return state
+
+    def dispatch(self, cmd, args):
+        if cmd == 'ping':
+            return {'ok': True, 'code': 0, 'result': os.getpid(), 'output': ''}
+        if cmd not in self.commands:
+            return {'ok': False, 'code': 1, 'error': f'unknown command {cmd!r}', 'output': ''}
+
+        fn, mutating = self.commands[cmd]
+        code, result, error = 0, None, None
+
+        sys.stdout.begin()
+        try:
+            if mutating:
+                with self.lock:
+                    result = fn(args)
+            else:
+                result = fn(args)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            code, error = 1, str(e)
+            self.log(f'{cmd} failed: {traceback.format_exc()}')
+        finally:
+            output = sys.stdout.end()
+
+        if mutating:
+            self.update_state()
+
+        try:
+            json.dumps(result)
+        except (TypeError, ValueError):
+            result = str(result)
+
+        return {'ok': code == 0 and error is None, 'code': code, 'result': result, 'error': error,
+                'output': output}
+
+    def _refresher(self):
+        while not self._stop.wait(self.refresh):
+            self.update_state()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            try:
+                client.request(self.path, 'ping', timeout=1)
+                raise OSError(f'a daemon already listens on {self.path}')
+            except (ConnectionError, FileNotFoundError, socket.timeout):
+                # stale socket of a dead daemon
+                os.unlink(self.path)
+
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.path, _Handler)
+        finally:
+            os.umask(old_umask)
+        self._server.daemon = self
+
+        self.update_state()
+        threading.Thread(target=self._refresher, daemon=True).start()
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop.set()
+            self._server.server_close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
@@ -0,0 +1,474 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import signal
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+
+# Caching DNS stub in front of tor's DNSPort: every answer tor gave is
+# kept (LRU, for as long as its TTL says, NXDOMAIN & empty answers too), so
+# only names not asked for lately cost a round trip through tor.
+#   - concurrent queries for the same name wait for the one sent to tor
+#   - a name asked for again when its TTL is nearly over is fetched anew
+#     in the background: popular names never go cold
+#   - the cache is written to a file when the stub stops & read back when
+#     it starts: a restart doesn't start from nothing
+#   - counters (hit rate, ...) answer `dig @127.0.0.1 -p PORT CH TXT stats.toro2`
+# Answers are kept as tor sent them; served from the cache, they get the
+# asker's id & question (same name, in its case) & TTLs counted down.
+
+CLASS_IN = 1
+CLASS_CH = 3
+TYPE_SOA = 6
+TYPE_TXT = 16
+TYPE_OPT = 41
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+STATS_NAME = b'stats.toro2'
+
+# a hit within the last PREFETCH_RATIO of an answer's TTL refreshes it
+PREFETCH_RATIO = 0.1
+
+_header = struct.Struct('!HHHHHH')
+_rr = struct.Struct('!HHIH')
+
+
+def parse_question(msg):
+    # => (name lowercased, type, class, offset after the question)
+    off = 12
+    labels = []
+    while True:
+        n = msg[off]
+        if n == 0:
+            off += 1
+            break
+        if n & 0xC0:
+            raise ValueError('compressed name in question')
+        labels.append(bytes(msg[off + 1:off + 1 + n]))
+        off += 1 + n
+    qtype, qclass = struct.unpack_from('!HH', msg, off)
+    return b'.'.join(labels).lower(), qtype, qclass, off + 4
+
+
+def _skip_name(msg, off):
+    while True:
+        n = msg[off]
+        if n == 0:
+            return off + 1
+        if n & 0xC0 == 0xC0:
+            return off + 2
+        off += 1 + n
+
+
+def records(msg, qend):
+    # => [(section, type, ttl, offset of the ttl, rdata offset)] of
+    # answer, authority & additional sections
+    _, _, _, an, ns, ar = _header.unpack_from(msg)
+    off = qend
+    out = []
+    for section, count in (('an', an), ('ns', ns), ('ar', ar)):
+        for _ in range(count):
+            off = _skip_name(msg, off)
+            rtype, _, ttl, rdlen = _rr.unpack_from(msg, off)
+            out.append((section, rtype, ttl, off + 4, off + _rr.size))
+            off += _rr.size + rdlen
+    if off > len(msg):
+        raise ValueError('truncated message')
+    return out
+
+
+def _negative_ttl(msg, rrs):
+    # RFC 2308: the SOA of the authority section, min(its TTL, its MINIMUM)
+    for section, rtype, ttl, _, rdata in rrs:
+        if section == 'ns' and rtype == TYPE_SOA:
+            off = _skip_name(msg, _skip_name(msg, rdata))
+            return min(ttl, struct.unpack_from('!5I', msg, off)[4])
+    return None
+
+
+def error_response(query, qend, rcode):
+    # the question & an rcode (SERVFAIL when tor doesn't answer, ...)
+    qid, flags = struct.unpack_from('!HH', query)
+    return _header.pack(qid, FLAG_QR | FLAG_RA | (flags & FLAG_RD) | rcode, 1 if qend > 12 else 0, 0, 0, 0) + \
+        bytes(query[12:qend])
+
+
+def txt_response(query, qend, texts):
+    qid, flags = struct.unpack_from('!HH', query)
+    rdata = b''.join(bytes([len(t)]) + t for t in texts)
+    return _header.pack(qid, FLAG_QR | FLAG_AA | (flags & FLAG_RD), 1, 1, 0, 0) + bytes(query[12:qend]) + \
+        b'\xc0\x0c' + _rr.pack(TYPE_TXT, CLASS_CH, 0, len(rdata)) + rdata
+
+
+class CacheEntry:
+    def __init__(self, data, ttl_offsets, ttls, expires, hits=0, lifetime=None):
+        self.data = data
+        self.ttl_offsets = ttl_offsets
+        self.ttls = ttls
+        # time.time(): comparable across restarts
+        self.expires = expires
+        # the TTL it was cached with, kept when the cache is saved & loaded
+        self.lifetime = lifetime if lifetime is not None else max(1.0, expires - time.time())
+        self.hits = hits
+
+    def answer(self, query, qend, now):
+        # cached response => response to query
+        out = bytearray(self.data)
+        out[0:2] = query[0:2]
+        out[12:qend] = query[12:qend]
+        remaining = max(0, int(self.expires - now))
+        for off, ttl in zip(self.ttl_offsets, self.ttls):
+            struct.pack_into('!I', out, off, min(ttl, remaining))
+        return bytes(out)
+
+    def to_json(self, key):
+        name, qtype, qclass = key
+        return {'name': name.decode('latin-1'), 'type': qtype, 'class': qclass,
+                'data': base64.b64encode(self.data).decode(), 'ttl_offsets': self.ttl_offsets,
+                'ttls': self.ttls, 'expires': self.expires, 'lifetime': self.lifetime, 'hits': self.hits}
+
+    @classmethod
+    def from_json(cls, d):
+        key = (d['name'].encode('latin-1'), d['type'], d['class'])
+        return key, cls(base64.b64decode(d['data']), d['ttl_offsets'], d['ttls'], d['expires'], d.get('hits', 0),
+                        d.get('lifetime'))
+
+
+class _Upstream(asyncio.DatagramProtocol):
+    # queries to tor over one UDP socket, matched to their answers by id & question
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        waiting = self.pending.get(struct.unpack_from('!H', data)[0])
+        if waiting is None:
+            return
+        fut, question = waiting
+        if bytes(data[12:12 + len(question)]).lower() == question and not fut.done():
+            fut.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP unreachable: tor not up, the query times out
+        pass
+
+    async def query(self, query, qend, timeout):
+        qid = random.getrandbits(16)
+        while qid in self.pending:
+            qid = random.getrandbits(16)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[qid] = (fut, bytes(query[12:qend]).lower())
+        try:
+            self.transport.sendto(struct.pack('!H', qid) + bytes(query[2:]))
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self.pending.pop(qid, None)
+
+
+class _UdpServer(asyncio.DatagramProtocol):
+    def __init__(self, stub):
+        self.stub = stub
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.stub._spawn(self._reply(data, addr))
+
+    async def _reply(self, data, addr):
+        response = await self.stub.handle(data)
+        if response is None:
+            return
+        # no EDNS: 512 bytes at most over UDP, the client retries over TCP
+        limit = 512 if len(data) >= 12 and _header.unpack_from(data)[5] == 0 else 4096
+        if len(response) > limit:
+            qend = len(response)
+            try:
+                qend = parse_question(response)[3]
+            except (ValueError, IndexError, struct.error):
+                pass
+            qid, flags = struct.unpack_from('!HH', response)
+            response = _header.pack(qid, flags | FLAG_TC, 1, 0, 0, 0) + response[12:qend]
+        self.transport.sendto(response, addr)
+
+
+class DnsStub:
+    def __init__(self, listen=('127.0.0.1', 5353), upstream=('127.0.0.1', 9053), size=4096, min_ttl=60,
+                 max_ttl=86400, neg_ttl=60, prefetch=True, timeout=5, cache_file=None, log=None):
+        self.listen = listen
+        self.upstream = upstream
+        self.size = int(size)
+        self.min_ttl = int(min_ttl)
+        self.max_ttl = int(max_ttl)
+        self.neg_ttl = int(neg_ttl)
+        self.prefetch = prefetch
+        self.timeout = float(timeout)
+        self.cache_file = cache_file
+        self.log = log or (lambda msg: None)
+        self.stats = {'queries': 0, 'hits': 0, 'negative_hits': 0, 'misses': 0, 'collapsed': 0,
+                      'prefetches': 0, 'upstream_errors': 0}
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._tasks = set()
+        self._upstream = None
+        self._loop = None
+        self._stop = None
+
+    # cache
+
+    def _get(self, key, now):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= now:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+    def _put(self, key, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def _entry(self, response, qend):
+        # tor's response => CacheEntry, None when it isn't to be kept
+        _, flags, _, an, _, _ = _header.unpack_from(response)
+        rcode = flags & 0xF
+        if flags & FLAG_TC or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            return None
+        rrs = records(response, qend)
+        answers = [ttl for section, _, ttl, _, _ in rrs if section == 'an']
+        if rcode == RCODE_NOERROR and an and answers:
+            ttl = min(max(min(answers), self.min_ttl), self.max_ttl)
+        else:
+            negative = _negative_ttl(response, rrs)
+            ttl = min(negative, self.max_ttl) if negative is not None else self.neg_ttl
+        ttl_rrs = [(off, t) for _, rtype, t, off, _ in rrs if rtype != TYPE_OPT]
+        return CacheEntry(bytes(response), [off for off, _ in ttl_rrs], [t for _, t in ttl_rrs], time.time() + ttl)
+
+    def save(self):
+        # => entries written
+        if not self.cache_file:
+            return 0
+        now = time.time()
+        entries = [e.to_json(k) for k, e in self._cache.items() if e.expires > now]
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        tmp = f'{self.cache_file}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump({'saved': now, 'entries': entries}, f)
+        os.replace(tmp, self.cache_file)
+        return len(entries)
+
+    def load(self):
+        # => entries still valid read back (least recently used first, as saved)
+        if not self.cache_file:
+            return 0
+        try:
+            with open(self.cache_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        now = time.time()
+        for d in saved.get('entries', []):
+            try:
+                key, entry = CacheEntry.from_json(d)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if entry.expires > now:
+                self._put(key, entry)
+        return len(self._cache)
+
+    # queries
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _fetch(self, query, qend, key):
+        # => tor's response, cached when it can be
+        try:
+            response = await self._upstream.query(query, qend, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['upstream_errors'] += 1
+            raise
+        try:
+            entry = self._entry(response, qend)
+        except (ValueError, IndexError, struct.error):
+            entry = None
+        if entry is not None:
+            self._put(key, entry)
+        return response
+
+    def _fetch_once(self, query, qend, key):
+        # one query to tor per name at a time: later askers wait for it
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.stats['collapsed'] += 1
+            return fut
+        fut = self._spawn(self._fetch(query, qend, key))
+        self._inflight[key] = fut
+        fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return fut
+
+    def stats_texts(self):
+        looked_up = self.stats['hits'] + self.stats['misses']
+        texts = [f'{k}={v}' for k, v in self.stats.items()]
+        texts += [f'entries={len(self._cache)}',
+                  f'hit_rate={self.stats["hits"] / looked_up if looked_up else 0:.3f}']
+        return [t.encode() for t in texts]
+
+    async def handle(self, query):
+        # query => response (None: not worth one)
+        try:
+            _, flags, _, _, _, _ = _header.unpack_from(query)
+            if flags & FLAG_QR:
+                return None
+            name, qtype, qclass, qend = parse_question(query)
+        except (ValueError, IndexError, struct.error):
+            return error_response(query, 12, RCODE_FORMERR) if len(query) >= 12 else None
+
+        if qclass == CLASS_CH and qtype == TYPE_TXT and name == STATS_NAME:
+            return txt_response(query, qend, self.stats_texts())
+
+        self.stats['queries'] += 1
+        key = (name, qtype, qclass)
+        now = time.time()
+        entry = self._get(key, now)
+        if entry is not None:
+            self.stats['hits'] += 1
+            if entry.data[3] & 0xF == RCODE_NXDOMAIN or not _header.unpack_from(entry.data)[3]:
+                self.stats['negative_hits'] += 1
+            entry.hits += 1
+            # asked for more than once & about to expire: fetched again meanwhile
+            if self.prefetch and entry.hits > 1 and entry.expires - now < entry.lifetime * PREFETCH_RATIO \
+                    and key not in self._inflight:
+                self.stats['prefetches'] += 1
+                self._fetch_once(query, qend, key).add_done_callback(lambda f: f.cancelled() or f.exception())
+            return entry.answer(query, qend, now)
+
+        self.stats['misses'] += 1
+        try:
+            response = await asyncio.shield(self._fetch_once(query, qend, key))
+        except (asyncio.TimeoutError, OSError) as e:
+            self.log(f'{name.decode("latin-1")}: no answer from {self.upstream[0]}:{self.upstream[1]} ({e!r})')
+            return error_response(query, qend, RCODE_SERVFAIL)
+
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry.answer(query, qend, time.time())
+        # not cached (SERVFAIL, truncated, ...): as tor sent it
+        out = bytearray(response)
+        out[0:2] = query[0:2]
+        return bytes(out)
+
+    async def _tcp_client(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), 10))[0]
+                response = await self.handle(await reader.readexactly(length))
+                if response is None:
+                    break
+                writer.write(struct.pack('!H', len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        # until close(); `ready` (threading.Event) is set once listening
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        loaded = self.load()
+        if loaded:
+            self.log(f'{loaded} cached answers read back from {self.cache_file}')
+
+        family = socket.AF_INET6 if ':' in self.listen[0] else socket.AF_INET
+        udp, _ = await self._loop.create_datagram_endpoint(lambda: _UdpServer(self), local_addr=self.listen,
+                                                           family=family)
+        # port 0: TCP on the port UDP got
+        self.listen = udp.get_extra_info('sockname')[:2]
+        tcp = await asyncio.start_server(self._tcp_client, self.listen[0], self.listen[1], family=family)
+        upstream_family = socket.AF_INET6 if ':' in self.upstream[0] else socket.AF_INET
+        up, self._upstream = await self._loop.create_datagram_endpoint(_Upstream, remote_addr=self.upstream,
+                                                                       family=upstream_family)
+        if ready is not None:
+            ready.set()
+        try:
+            await self._stop.wait()
+        finally:
+            udp.close()
+            tcp.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            up.close()
+            saved = self.save()
+            if saved:
+                self.log(f'{saved} cached answers written to {self.cache_file}')
+
+    def close(self):
+        # from any thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def run(self):
+        # in the foreground until SIGINT/SIGTERM
+        async def main():
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.close)
+            await self.serve()
+
+        asyncio.run(main())
+
+
+def query_stats(addr, timeout=2):
+    # => {counter: value} of the stub at addr
+    query = _header.pack(random.getrandbits(16), 0, 1, 0, 0, 0) + \
+        b''.join(bytes([len(p)]) + p for p in STATS_NAME.split(b'.')) + b'\0' + struct.pack('!HH', TYPE_TXT, CLASS_CH)
+    family = socket.AF_INET6 if ':' in addr[0] else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(query, addr)
+        response = sock.recv(4096)
+
+    qend = parse_question(response)[3]
+    out = {}
+    for section, rtype, _, off, rdata in records(response, qend):
+        if rtype != TYPE_TXT:
+            continue
+        rdlen = struct.unpack_from('!H', response, off + 4)[0]
+        pos = rdata
+        while pos < rdata + rdlen:
+            text = response[pos + 1:pos + 1 + response[pos]].decode()
+            pos += 1 + response[pos]
+            k, _, v = text.partition('=')
+            out[k] = v
+    return out
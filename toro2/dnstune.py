@@ -0,0 +1,434 @@
+import base64
+import hashlib
+import marshal
+import os
+import random
+import re
+import socketserver
+import ssl
+import statistics
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from exittune import socks5_connect, _recv_exact
+
+
+# Picks dnscrypt-proxy's server_names: the resolvers of public-resolvers.md
+# (sdns:// stamps) that meet the toml's require_* & *_servers settings are
+# asked a real query through tor, several at once, and the fastest ones
+# are written to server_names.
+#   DNSCrypt  certificate query (TXT 2.dnscrypt-cert.<provider>, plain DNS
+#             over TCP on the resolver's port): no crypto needed
+#   DoH       GET <path>?dns=<query> over TLS
+# Parsing thousands of lines is done once: the resolvers are kept in an
+# index file, valid as long as public-resolvers.md doesn't change.
+
+PROTO_PLAIN = 0x00
+PROTO_DNSCRYPT = 0x01
+PROTO_DOH = 0x02
+PROTO_DOT = 0x03
+PROTO_DOQ = 0x04
+PROTO_ODOH = 0x05
+PROTO_RELAY = 0x81
+PROTO_ODOH_RELAY = 0x85
+
+PROTO_NAMES = {PROTO_PLAIN: 'dns', PROTO_DNSCRYPT: 'dnscrypt', PROTO_DOH: 'doh', PROTO_DOT: 'dot',
+               PROTO_DOQ: 'doq', PROTO_ODOH: 'odoh', PROTO_RELAY: 'relay', PROTO_ODOH_RELAY: 'odoh-relay'}
+
+PROP_DNSSEC = 1
+PROP_NOLOG = 2
+PROP_NOFILTER = 4
+
+DEFAULT_PORTS = {PROTO_DNSCRYPT: 443, PROTO_DOH: 443, PROTO_DOT: 853, PROTO_PLAIN: 53}
+
+# bumped when what the index holds changes
+INDEX_VERSION = 1
+
+PROBE_USER = 'toro2-dns'
+
+
+def _lp(data, off):
+    n = data[off]
+    return data[off + 1:off + 1 + n], off + 1 + n
+
+
+def _vlp(data, off):
+    # set of length-prefixed items, 0x80 in the length: more follow
+    items = []
+    while True:
+        n = data[off]
+        items.append(data[off + 1:off + 1 + (n & 0x7F)])
+        off += 1 + (n & 0x7F)
+        if not n & 0x80:
+            return items, off
+
+
+def _split_addr(addr, default_port):
+    # "1.2.3.4", "1.2.3.4:5443", "[::1]", "[::1]:443" => (host, port)
+    if addr.startswith('['):
+        host, _, rest = addr[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else default_port
+    host, _, port = addr.partition(':')
+    return host, int(port) if port else default_port
+
+
+def decode_stamp(stamp):
+    # sdns://... => resolver dict (no name), ValueError if not a stamp
+    if not stamp.startswith('sdns://'):
+        raise ValueError('not an sdns:// stamp')
+    b64 = stamp[len('sdns://'):]
+    try:
+        data = base64.urlsafe_b64decode(b64 + '=' * (-len(b64) % 4))
+        proto = data[0]
+        if proto in (PROTO_RELAY, PROTO_ODOH_RELAY):
+            return {'proto': proto, 'props': 0, 'stamp': stamp}
+
+        props = struct.unpack_from('<Q', data, 1)[0]
+        addr, off = _lp(data, 9)
+        resolver = {'proto': proto, 'props': props, 'addr': addr.decode(), 'stamp': stamp}
+
+        if proto == PROTO_DNSCRYPT:
+            _, off = _lp(data, off)
+            provider, off = _lp(data, off)
+            resolver['provider'] = provider.decode()
+        elif proto in (PROTO_DOH, PROTO_DOT, PROTO_DOQ, PROTO_ODOH):
+            if proto != PROTO_ODOH:
+                _, off = _vlp(data, off)
+            hostname, off = _lp(data, off)
+            resolver['hostname'] = hostname.decode()
+            if proto in (PROTO_DOH, PROTO_ODOH):
+                path, off = _lp(data, off)
+                resolver['path'] = path.decode() or '/dns-query'
+    except (IndexError, struct.error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'bad stamp: {e}')
+
+    default_port = DEFAULT_PORTS.get(proto, 443)
+    if 'hostname' in resolver:
+        # "dns9.quad9.net:443": the name alone goes to SNI & Host
+        hostname, default_port = _split_addr(resolver['hostname'], default_port)
+        resolver['hostname'] = hostname
+    host, port = _split_addr(resolver['addr'], default_port) if resolver['addr'] else (hostname, default_port)
+    resolver.update(host=host, port=port, ipv6=':' in host)
+    return resolver
+
+
+def parse_resolvers(text):
+    # public-resolvers.md => {name: resolver}, the first stamp of each "## name"
+    resolvers = {}
+    name = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('## '):
+            name = line[3:].strip()
+        elif line.startswith('sdns://') and name and name not in resolvers:
+            try:
+                resolvers[name] = dict(decode_stamp(line), name=name)
+            except ValueError:
+                continue
+    return resolvers
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def load_index(md_path, index_path=None):
+    # => {name: resolver}, from index_path while md_path hasn't changed
+    stamp = _stamp(md_path)
+    if index_path:
+        try:
+            with open(index_path, 'rb') as f:
+                index = marshal.load(f)
+            if index.get('version') == INDEX_VERSION and index.get('source') == [md_path, stamp]:
+                return index['resolvers']
+        except (OSError, EOFError, ValueError, TypeError, AttributeError):
+            pass
+
+    with open(md_path, encoding='utf-8', errors='replace') as f:
+        resolvers = parse_resolvers(f.read())
+
+    if index_path:
+        tmp = f'{index_path}.{os.getpid()}'
+        try:
+            os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+            with open(tmp, 'wb') as f:
+                marshal.dump({'version': INDEX_VERSION, 'source': [md_path, stamp], 'resolvers': resolvers}, f)
+            os.replace(tmp, index_path)
+        except OSError:
+            # no index, parsed again next time
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+    return resolvers
+
+
+# dnscrypt-proxy.toml: top-level settings looked at & the list rewritten
+
+REQUIREMENTS = {'require_dnssec': False, 'require_nolog': False, 'require_nofilter': False,
+                'ipv4_servers': True, 'ipv6_servers': False, 'dnscrypt_servers': True, 'doh_servers': True}
+
+_SERVER_NAMES = re.compile(r'^[ \t]*server_names[ \t]*=.*$', re.M)
+
+
+def _top_level(toml_text):
+    # what comes before the first [section]
+    m = re.search(r'^\s*\[', toml_text, re.M)
+    return toml_text[:m.start()] if m else toml_text
+
+
+def read_requirements(toml_text):
+    req = dict(REQUIREMENTS)
+    for key in req:
+        m = re.search(rf'^\s*{key}\s*=\s*(true|false)\b', _top_level(toml_text), re.M)
+        if m:
+            req[key] = m.group(1) == 'true'
+    return req
+
+
+def read_server_names(toml_text):
+    m = re.search(r'^\s*server_names\s*=\s*\[(.*?)\]', _top_level(toml_text), re.M)
+    return re.findall(r"['\"]([^'\"]+)['\"]", m.group(1)) if m else []
+
+
+def write_server_names(toml_text, names):
+    line = 'server_names = [' + ', '.join(f"'{n}'" for n in names) + ']'
+    m = _SERVER_NAMES.search(_top_level(toml_text))
+    if m:
+        return toml_text[:m.start()] + line + toml_text[m.end():]
+    return line + '\n' + toml_text
+
+
+def eligible(resolvers, req):
+    # => names of the resolvers dnscrypt-proxy would accept with these settings
+    protos = set()
+    if req['dnscrypt_servers']:
+        protos.add(PROTO_DNSCRYPT)
+    if req['doh_servers']:
+        protos.add(PROTO_DOH)
+    wanted = (PROP_DNSSEC if req['require_dnssec'] else 0) | (PROP_NOLOG if req['require_nolog'] else 0) | \
+        (PROP_NOFILTER if req['require_nofilter'] else 0)
+
+    out = []
+    for name, r in resolvers.items():
+        if r['proto'] not in protos or r['props'] & wanted != wanted:
+            continue
+        if r['ipv6'] and not req['ipv6_servers'] or not r['ipv6'] and not req['ipv4_servers']:
+            continue
+        out.append(name)
+    return out
+
+
+# probes
+
+def dns_query(name, qtype, qid=None):
+    qid = random.getrandbits(16) if qid is None else qid
+    return struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + \
+        b''.join(bytes([len(p)]) + p for p in name.encode('idna').split(b'.') if p) + b'\0' + \
+        struct.pack('!HH', qtype, 1)
+
+
+def _answered(response, qid):
+    # NOERROR & at least one answer
+    if len(response) < 12:
+        return False
+    rid, flags, _, an = struct.unpack_from('!HHHH', response)
+    return rid == qid and flags & 0x8000 and flags & 0xF == 0 and an > 0
+
+
+class ResolverCandidate:
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.name = resolver['name']
+        self.rtts = []
+        self.error = None
+
+    @property
+    def proto(self):
+        return PROTO_NAMES.get(self.resolver['proto'], '?')
+
+    @property
+    def rtt(self):
+        return statistics.median(self.rtts) if self.rtts else None
+
+    def rank_key(self):
+        # unreachable resolvers last, then lowest RTT
+        return (self.rtt is None, self.rtt or 0.0)
+
+
+def probe_once(socks_addr, resolver, tls=True, timeout=15):
+    # => seconds for a connection through tor & one answered query
+    r = resolver
+    t0 = time.perf_counter()
+    sock = socks5_connect(socks_addr, r['host'], r['port'], username=f'{PROBE_USER}-{r["name"]}',
+                          timeout=timeout)
+    try:
+        if r['proto'] == PROTO_DNSCRYPT:
+            query = dns_query(r['provider'], 16)
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            length = struct.unpack('!H', _recv_exact(sock, 2))[0]
+            response = _recv_exact(sock, length)
+        elif r['proto'] == PROTO_DOH:
+            hostname = r.get('hostname') or r['host']
+            if tls:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=hostname)
+            query = dns_query('example.com', 1, qid=0)
+            b64 = base64.urlsafe_b64encode(query).rstrip(b'=').decode()
+            sock.sendall(f'GET {r["path"]}?dns={b64} HTTP/1.1\r\nHost: {hostname}\r\n'
+                         f'Accept: application/dns-message\r\nConnection: close\r\n\r\n'.encode())
+            reply = b''
+            while b'\r\n\r\n' not in reply:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise OSError('connection closed')
+                reply += chunk
+            status = reply.split(b'\r\n', 1)[0].split(b' ')
+            if len(status) < 2 or status[1] != b'200':
+                raise OSError(f'HTTP {b" ".join(status[1:]).decode(errors="replace")}')
+            response, qid = reply.partition(b'\r\n\r\n')[2], 0
+            query = None
+        else:
+            raise OSError(f'{PROTO_NAMES.get(r["proto"], r["proto"])} resolvers are not probed')
+
+        if query is not None:
+            qid = struct.unpack_from('!H', query)[0]
+        # a DoH body may come in several packets
+        while r['proto'] == PROTO_DOH and len(response) < 12:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        if not _answered(response, qid):
+            raise OSError('no answer')
+    finally:
+        sock.close()
+    return time.perf_counter() - t0
+
+
+class DnsTuner:
+    # Probes candidates `parallel` at a time, each `probes` times, every
+    # resolver on a circuit of its own (SOCKS username)
+
+    def __init__(self, socks_addr, probes=2, parallel=16, timeout=15, tls=True, log=None):
+        self.socks_addr = socks_addr
+        self.probes = int(probes)
+        self.parallel = int(parallel)
+        self.timeout = timeout
+        self.tls = tls
+        self.log = log or (lambda msg: None)
+        self._log_lock = threading.Lock()
+
+    def probe(self, cand):
+        try:
+            for _ in range(self.probes):
+                cand.rtts.append(probe_once(self.socks_addr, cand.resolver, tls=self.tls, timeout=self.timeout))
+        except (OSError, ssl.SSLError, ValueError) as e:
+            cand.error = str(e) or e.__class__.__name__
+        self._report(cand)
+        return cand
+
+    def run(self, candidates):
+        # => candidates ranked, best first
+        with ThreadPoolExecutor(max_workers=max(1, self.parallel)) as pool:
+            list(pool.map(self.probe, candidates))
+        return sorted(candidates, key=ResolverCandidate.rank_key)
+
+    def _report(self, cand):
+        # probes end on several threads: one line at a time
+        with self._log_lock:
+            if cand.error and not cand.rtts:
+                self.log(f'{cand.name:<32} {cand.proto:<8} failed: {cand.error}')
+            else:
+                self.log(f'{cand.name:<32} {cand.proto:<8} rtt {cand.rtt * 1000:7.1f}ms')
+
+
+def pick_candidates(resolvers, names, current=(), count=40, seed=None):
+    # the resolvers in use first (are they still the best?), then others at random
+    current = [n for n in current if n in names]
+    others = [n for n in names if n not in current]
+    random.Random(seed).shuffle(others)
+    return [ResolverCandidate(resolvers[n]) for n in (current + others)[:int(count)]]
+
+
+class _StandinHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        try:
+            _, nmethods = _recv_exact(sock, 2)
+            _recv_exact(sock, nmethods)
+            sock.sendall(b'\x05\x02')
+            _, ulen = _recv_exact(sock, 2)
+            username = _recv_exact(sock, ulen).decode()
+            _recv_exact(sock, _recv_exact(sock, 1)[0])
+            sock.sendall(b'\x01\x00')
+
+            _, _, _, atyp = _recv_exact(sock, 4)
+            _recv_exact(sock, (_recv_exact(sock, 1)[0] if atyp == 3 else 4 if atyp == 1 else 16) + 2)
+
+            latency, failing = self.server.profile(username)
+            time.sleep(latency)
+            if failing:
+                sock.sendall(b'\x05\x04\x00\x01' + b'\x00' * 6)
+                return
+            sock.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+
+            head = _recv_exact(sock, 2)
+            if head == b'GE':
+                # DoH, in clear: the stand-in has no certificate
+                request = head
+                while b'\r\n\r\n' not in request:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        return
+                    request += chunk
+                time.sleep(latency)
+                body = self.server.answer(dns_query('example.com', 1, qid=0))
+                sock.sendall(f'HTTP/1.1 200 OK\r\nContent-Type: application/dns-message\r\n'
+                             f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            else:
+                query = _recv_exact(sock, struct.unpack('!H', head)[0])
+                time.sleep(latency)
+                body = self.server.answer(query)
+                sock.sendall(struct.pack('!H', len(body)) + body)
+
+        except OSError:
+            pass
+
+
+class StandinResolvers(socketserver.ThreadingTCPServer):
+    # Local stand-in for tor + the resolvers: a SOCKS5 server on 127.0.0.1
+    # answering DNSCrypt certificate queries & (unencrypted) DoH GETs, the
+    # latency of each resolver derived from its name in the SOCKS
+    # username, one in ten unreachable. Lets tune-dns run end to end with
+    # no tor and no network.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, parallel=16):
+        # every probe of a round may connect at once: room for all of them
+        self.request_queue_size = max(parallel, socketserver.TCPServer.request_queue_size)
+        super().__init__(('127.0.0.1', 0), _StandinHandler)
+
+    @staticmethod
+    def profile(username):
+        # => (latency 5..150ms per round trip, unreachable)
+        h = int(hashlib.sha1(username.encode()).hexdigest(), 16)
+        return 0.005 + (h % 146) / 1000, (h >> 8) % 10 == 0
+
+    @staticmethod
+    def answer(query):
+        qid = struct.unpack_from('!H', query)[0]
+        rdata = b'\x04stub'
+        return struct.pack('!HHHHHH', qid, 0x8180, 1, 1, 0, 0) + query[12:] + \
+            b'\xc0\x0c' + struct.pack('!HHIH', 16, 1, 60, len(rdata)) + rdata
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,379 @@
+import base64
+import binascii
+import hashlib
+import random
+import socket
+import socketserver
+import statistics
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+import torcontrol
+
+
+PROBE_USER = 'toro2-probe'
+
+
+class ExitCandidate:
+    def __init__(self, fingerprint, nickname='', bandwidth=0, flags=()):
+        self.fingerprint = fingerprint
+        self.nickname = nickname
+        self.bandwidth = int(bandwidth)
+        self.flags = set(flags)
+        self.rtts = []
+        self.throughputs = []
+        self.error = None
+
+    @property
+    def rtt(self):
+        return statistics.median(self.rtts) if self.rtts else None
+
+    @property
+    def throughput(self):
+        return statistics.median(self.throughputs) if self.throughputs else 0.0
+
+    def rank_key(self):
+        # unreachable exits last, then lowest RTT, then highest throughput
+        return (self.rtt is None, self.rtt or 0.0, -self.throughput)
+
+
+def parse_ns(text):
+    # 'GETINFO ns/all' router status entries => [ExitCandidate]
+    relays = []
+    for line in text.splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == 'r' and len(parts) >= 3:
+            identity = parts[2] + '=' * (-len(parts[2]) % 4)
+            try:
+                fp = binascii.hexlify(base64.b64decode(identity)).decode().upper()
+            except (binascii.Error, ValueError):
+                continue
+            relays.append(ExitCandidate(fp, nickname=parts[1]))
+        elif parts[0] == 's' and relays:
+            relays[-1].flags = set(parts[1:])
+        elif parts[0] == 'w' and relays:
+            bw = torcontrol.parse_kv(line).get('Bandwidth', '0')
+            relays[-1].bandwidth = int(bw) if bw.isdigit() else 0
+    return relays
+
+
+def pick_exits(relays, count):
+    # the fastest exits by consensus weight are the ones worth measuring
+    usable = [r for r in relays if {'Exit', 'Fast', 'Running', 'Valid'} <= r.flags and 'BadExit' not in r.flags]
+    return sorted(usable, key=lambda r: r.bandwidth, reverse=True)[:int(count)]
+
+
+def pick_middle(relays, exclude=()):
+    middles = [r for r in relays if {'Fast', 'Stable', 'Running', 'Valid'} <= r.flags
+               and 'Exit' not in r.flags and r.fingerprint not in exclude]
+    if not middles:
+        raise torcontrol.TorControlError('no usable middle relay in the consensus')
+    return random.choices(middles, weights=[max(1, r.bandwidth) for r in middles])[0]
+
+
+def socks5_connect(socks_addr, host, port, username=None, password=None, timeout=30):
+    sock = socket.create_connection(socks_addr, timeout=timeout)
+    try:
+        if username:
+            sock.sendall(b'\x05\x01\x02')
+        else:
+            sock.sendall(b'\x05\x01\x00')
+        ver, method = _recv_exact(sock, 2)
+        if method == 0x02:
+            user, pwd = username.encode(), (password or 'x').encode()
+            sock.sendall(b'\x01' + bytes([len(user)]) + user + bytes([len(pwd)]) + pwd)
+            if _recv_exact(sock, 2)[1] != 0:
+                raise OSError('SOCKS5 authentication refused')
+        elif method != 0x00:
+            raise OSError(f'SOCKS5 method {method} not supported')
+
+        name = host.encode('idna')
+        sock.sendall(b'\x05\x01\x00\x03' + bytes([len(name)]) + name + struct.pack('!H', int(port)))
+        reply = _recv_exact(sock, 4)
+        if reply[1] != 0:
+            raise OSError(f'SOCKS5 CONNECT failed (reply {reply[1]})')
+        # bound address, unused
+        atyp = reply[3]
+        _recv_exact(sock, 4 + 2 if atyp == 1 else 16 + 2 if atyp == 4 else _recv_exact(sock, 1)[0] + 2)
+        return sock
+
+    except Exception:
+        sock.close()
+        raise
+
+
+def _recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise OSError('connection closed')
+        data += chunk
+    return data
+
+
+def probe_once(socks_addr, url, max_bytes, username=None, timeout=30):
+    # => (rtt: SOCKS CONNECT through the exit to the target, throughput B/s)
+    u = urlsplit(url)
+    port = u.port or (443 if u.scheme == 'https' else 80)
+
+    t0 = time.perf_counter()
+    sock = socks5_connect(socks_addr, u.hostname, port, username=username, timeout=timeout)
+    rtt = time.perf_counter() - t0
+
+    try:
+        sock.sendall(f'GET {u.path or "/"}{"?" + u.query if u.query else ""} HTTP/1.0\r\n'
+                     f'Host: {u.hostname}\r\nConnection: close\r\n\r\n'.encode())
+        received = 0
+        t1 = time.perf_counter()
+        while received < max_bytes:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            received += len(chunk)
+        took = time.perf_counter() - t1
+    finally:
+        sock.close()
+
+    return rtt, received / took if took > 0 else 0.0
+
+
+class ExitTuner:
+    # Measures candidate exits one at a time: a 3 hop circuit guard ->
+    # random middle -> exit is built over the control port and the probe
+    # streams are attached to it by hand (__LeaveStreamsUnattached); every
+    # other stream opened meanwhile is handed back to tor (ATTACHSTREAM 0).
+    # Without a controller (stand-in mode) the SOCKS username selects the exit.
+
+    def __init__(self, ctl, socks_addr, url, probes=3, max_bytes=262144, timeout=30, log=None):
+        self.ctl = ctl
+        self.socks_addr = socks_addr
+        self.url = url
+        self.probes = int(probes)
+        self.max_bytes = int(max_bytes)
+        self.timeout = timeout
+        self.log = log or (lambda msg: None)
+        self.relays = []
+        self._circs = {}
+        self._probe_circ = None
+
+    def candidates(self, count):
+        self.relays = parse_ns(self.ctl.getinfo('ns/all').get('ns/all', ''))
+        return pick_exits(self.relays, count)
+
+    def _guard(self):
+        # first usable entry guard: "$FP~nick up" / "$FP=nick up"
+        guards = self.ctl.getinfo('entry-guards').get('entry-guards', '')
+        for line in guards.splitlines():
+            parts = line.split()
+            if len(parts) >= 2 and parts[1] == 'up':
+                return parts[0].lstrip('$').split('~')[0].split('=')[0]
+        raise torcontrol.TorControlError('no entry guard up')
+
+    def _on_event(self, event):
+        parts = event.split()
+        if len(parts) < 3:
+            return
+
+        if parts[0] == 'CIRC':
+            self._circs[parts[1]] = parts[2]
+
+        elif parts[0] == 'STREAM' and parts[2] in ('NEW', 'NEWRESOLVE'):
+            kv = torcontrol.parse_kv(event)
+            ours = self._probe_circ is not None and kv.get('SOCKS_USERNAME', '').startswith(PROBE_USER)
+            try:
+                self.ctl.attach_stream(parts[1], self._probe_circ if ours else 0)
+            except torcontrol.TorControlError:
+                # stream already gone
+                pass
+
+    def _pump(self, done, timeout):
+        deadline = time.monotonic() + timeout
+        while not done():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            event = self.ctl.read_event(timeout=min(left, 0.2))
+            if event:
+                self._on_event(event)
+        return True
+
+    def _measure(self, cand):
+        for _ in range(self.probes):
+            rtt, throughput = probe_once(self.socks_addr, self.url, self.max_bytes,
+                                         username=f'{PROBE_USER}-{cand.fingerprint}', timeout=self.timeout)
+            cand.rtts.append(rtt)
+            cand.throughputs.append(throughput)
+
+    def probe(self, cand, guard=None):
+        if self.ctl is None:
+            try:
+                self._measure(cand)
+            except OSError as e:
+                cand.error = str(e)
+            return cand
+
+        middle = pick_middle(self.relays, exclude=(guard, cand.fingerprint))
+        circ_id = None
+        try:
+            circ_id = self.ctl.extend_circuit([guard, middle.fingerprint, cand.fingerprint])
+            if not self._pump(lambda: self._circs.get(circ_id) in ('BUILT', 'FAILED', 'CLOSED'), self.timeout):
+                raise torcontrol.TorControlError(f'circuit not built within {self.timeout}s')
+            if self._circs[circ_id] != 'BUILT':
+                raise torcontrol.TorControlError(f'circuit {self._circs[circ_id].lower()}')
+
+            # the probe runs in a thread, this one keeps attaching streams
+            self._probe_circ = circ_id
+            result = {}
+
+            def measure():
+                try:
+                    self._measure(cand)
+                except OSError as e:
+                    result['error'] = e
+
+            t = threading.Thread(target=measure, daemon=True)
+            t.start()
+            self._pump(lambda: not t.is_alive(), self.timeout * self.probes + 5)
+            if 'error' in result:
+                cand.error = str(result['error'])
+
+        except torcontrol.TorControlError as e:
+            cand.error = str(e)
+
+        finally:
+            self._probe_circ = None
+            if circ_id is not None:
+                try:
+                    self.ctl.close_circuit(circ_id)
+                except torcontrol.TorControlError:
+                    pass
+
+        return cand
+
+    def run(self, candidates):
+        # => candidates ranked, best first
+        if self.ctl is None:
+            for cand in candidates:
+                self._report(self.probe(cand))
+            return sorted(candidates, key=ExitCandidate.rank_key)
+
+        guard = self._guard()
+        self.ctl.setconf({'__LeaveStreamsUnattached': '1'})
+        try:
+            self.ctl.setevents('CIRC', 'STREAM')
+            for cand in candidates:
+                self._report(self.probe(cand, guard))
+        finally:
+            self.ctl.resetconf('__LeaveStreamsUnattached')
+            # streams opened before the reset still wait for a circuit
+            event = self.ctl.read_event(timeout=0)
+            while event:
+                self._on_event(event)
+                event = self.ctl.read_event(timeout=0)
+            self.ctl.setevents()
+
+        return sorted(candidates, key=ExitCandidate.rank_key)
+
+    def _report(self, cand):
+        if cand.error:
+            self.log(f'{cand.nickname or cand.fingerprint[:8]:<20} {cand.fingerprint[:8]}  failed: {cand.error}')
+        else:
+            self.log(f'{cand.nickname or cand.fingerprint[:8]:<20} {cand.fingerprint[:8]}  '
+                     f'rtt {cand.rtt * 1000:7.1f}ms  {cand.throughput / 1024:8.1f} KiB/s')
+
+
+def exits_torrc(candidates, strict=False):
+    fps = ','.join(f'${c.fingerprint}' for c in candidates)
+    return (f"# written by 'toro2 tune-exits' {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"ExitNodes {fps}\n"
+            f"StrictNodes {1 if strict else 0}\n")
+
+
+def torrc_args(path):
+    # overlay torrc => tor command line options (they override the torrc)
+    args = []
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, _, value = line.partition(' ')
+                args += [f'--{key}', value.strip()]
+    except OSError:
+        pass
+    return args
+
+
+class _StandinHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        try:
+            _, nmethods = _recv_exact(sock, 2)
+            _recv_exact(sock, nmethods)
+            sock.sendall(b'\x05\x02')
+            _, ulen = _recv_exact(sock, 2)
+            username = _recv_exact(sock, ulen).decode()
+            _recv_exact(sock, _recv_exact(sock, 1)[0])
+            sock.sendall(b'\x01\x00')
+
+            _, _, _, atyp = _recv_exact(sock, 4)
+            _recv_exact(sock, (_recv_exact(sock, 1)[0] if atyp == 3 else 4 if atyp == 1 else 16) + 2)
+
+            latency, rate = self.server.profile(username.rsplit('-', 1)[-1])
+            time.sleep(latency)
+            sock.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+
+            request = b''
+            while b'\r\n\r\n' not in request:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+
+            sock.sendall(f'HTTP/1.0 200 OK\r\nContent-Length: {self.server.payload}\r\n\r\n'.encode())
+            chunk = b'\x00' * 16384
+            sent = 0
+            while sent < self.server.payload:
+                sock.sendall(chunk)
+                sent += len(chunk)
+                time.sleep(len(chunk) / rate)
+
+        except OSError:
+            # prober hung up once it had enough
+            pass
+
+
+class StandinExits(socketserver.ThreadingTCPServer):
+    # Local stand-in for tor + exits + target: a SOCKS5 server on 127.0.0.1
+    # serving an HTTP payload, the latency and bandwidth of each "exit"
+    # derived from the fingerprint in the SOCKS username. Lets tune-exits
+    # run end to end with no tor and no network.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, count=10, payload=1048576):
+        super().__init__(('127.0.0.1', 0), _StandinHandler)
+        self.payload = payload
+        self.exits = [ExitCandidate(hashlib.sha1(f'standin{i}'.encode()).hexdigest().upper(),
+                                    nickname=f'standin{i}', flags={'Exit', 'Fast', 'Running', 'Valid'})
+                      for i in range(int(count))]
+
+    @staticmethod
+    def profile(fingerprint):
+        # => (latency 10..200ms, rate 256KiB..4MiB/s)
+        h = int(hashlib.sha1(fingerprint.encode()).hexdigest(), 16)
+        return 0.01 + (h % 191) / 1000, 262144 + (h >> 8) % (4194304 - 262144)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
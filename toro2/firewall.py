@@ -0,0 +1,582 @@
+import ipaddress
+import os
+import re
+
+
+# TORO2CHAIN_* chains per table and the built-in chains jumping to them
+TORO2_CHAINS = {
+    'filter': ['TORO2CHAIN_INPUT', 'TORO2CHAIN_OUTPUT'],
+    'nat': ['TORO2CHAIN_OUTPUT', 'TORO2CHAIN_PREROUTING', 'TORO2CHAIN_POSTROUTING'],
+}
+
+TORO2_JUMPS = {
+    'filter': [('INPUT', 'TORO2CHAIN_INPUT'), ('OUTPUT', 'TORO2CHAIN_OUTPUT')],
+    'nat': [('OUTPUT', 'TORO2CHAIN_OUTPUT'), ('PREROUTING', 'TORO2CHAIN_PREROUTING'),
+            ('POSTROUTING', 'TORO2CHAIN_POSTROUTING')],
+}
+
+# Loopback & private ranges always allowed next to ignore_tor
+LOCAL_NETS = ['127.0.0.1/8', '10.0.0.0/8', '172.16.0.0/12']
+
+# Rules below are written the way iptables-save prints them back,
+# so a compiled ruleset can be compared against a live one as is
+TCP_SYN = '--tcp-flags FIN,SYN,RST,ACK SYN'
+
+# toro2's rules in built-in chains (FORWARD drops while the VPN is up) are
+# tagged, so those of interfaces gone since are found in the live ruleset
+OWNED_COMMENT = '-m comment --comment toro2'
+
+
+def normalize_net(net):
+    return str(ipaddress.ip_network(net, strict=False))
+
+
+class FirewallSpec:
+    def __init__(self, tor_uid, trans_port, dns_port, ignore_tor=(), resv_iana=(), out_ifaces=(),
+                 vpn_iface=None, virtual_addr_network='10.192.0.0/10', vpn_up=None, trans_ports=None):
+        self.tor_uid = int(tor_uid)
+        # several tor instances => new flows are spread over all their TransPorts
+        self.trans_ports = [int(p) for p in trans_ports] if trans_ports else [int(trans_port)]
+        self.trans_port = self.trans_ports[0]
+        self.dns_port = int(dns_port)
+        self.ignore_tor = [normalize_net(n) for n in ignore_tor]
+        self.resv_iana = [normalize_net(n) for n in resv_iana]
+        self.out_ifaces = list(out_ifaces)
+        self.vpn_iface = vpn_iface
+        self.virtual_addr_network = normalize_net(virtual_addr_network)
+
+        if vpn_up is None:
+            vpn_up = bool(vpn_iface) and os.path.exists(f'/sys/class/net/{vpn_iface}')
+        self.vpn_up = vpn_up
+
+    @property
+    def bypass_nets(self):
+        return self.ignore_tor + [normalize_net(n) for n in LOCAL_NETS]
+
+
+def _trans_redirect(match, spec):
+    # nat sees only the first packet of a flow, so nth over those rules
+    # spreads flows (not packets) evenly across the TransPorts
+    ports = spec.trans_ports
+    rules = [f'{match} -m statistic --mode nth --every {len(ports) - i} --packet 0 -j REDIRECT --to-ports {port}'
+             for i, port in enumerate(ports[:-1])]
+    rules.append(f'{match} -j REDIRECT --to-ports {ports[-1]}')
+    return rules
+
+
+def nat_rules(spec):
+    rules = _trans_redirect(f'-d {spec.virtual_addr_network} -p tcp -m tcp {TCP_SYN}', spec)
+    rules += [
+        # nat DNS requests
+        f'-d 127.0.0.1/32 -p udp -m udp --dport 53 -j REDIRECT --to-ports {spec.dns_port}',
+        f'-p tcp -m tcp --dport 53 -j REDIRECT --to-ports {spec.dns_port}',
+        f'-p udp -m udp --dport 53 -j REDIRECT --to-ports {spec.dns_port}',
+        '-m state --state RELATED,ESTABLISHED -j RETURN',
+        # ICMP echo-request to Tor
+        f'-p icmp -m icmp --icmp-type 8 -j REDIRECT --to-ports {spec.trans_port}',
+        # Don't nat the Tor process, the loopback, or the local network
+        f'-m owner --uid-owner {spec.tor_uid} -j RETURN',
+        '-o lo -j RETURN',
+    ]
+    rules += [f'-d {net} -j RETURN' for net in spec.bypass_nets + spec.resv_iana]
+    # Redirect all other output to Tor's TransPort
+    rules += _trans_redirect(f'-p tcp -m tcp {TCP_SYN}', spec)
+    rules += _trans_redirect('-p tcp -m tcp', spec)
+    rules += _trans_redirect('-p udp -m udp', spec)
+
+    return [('TORO2CHAIN_OUTPUT', r) for r in rules]
+
+
+def filter_rules(spec):
+    tor_syn = f'-p tcp -m owner --uid-owner {spec.tor_uid} -m tcp {TCP_SYN} -m state --state NEW -j ACCEPT'
+
+    rules = [
+        ('TORO2CHAIN_INPUT', '-p icmp -m icmp --icmp-type 0 -j ACCEPT'),
+        ('TORO2CHAIN_INPUT', '-m state --state INVALID -j DROP'),
+    ]
+    # Grant yourself ssh access from remote machines before the DROP
+    rules += [('TORO2CHAIN_INPUT', f'-i {oi} -p tcp -m tcp --dport 22 -m state --state NEW -j ACCEPT')
+              for oi in spec.out_ifaces]
+    rules += [
+        ('TORO2CHAIN_INPUT', '-m state --state RELATED,ESTABLISHED -j ACCEPT'),
+        ('TORO2CHAIN_INPUT', '-i lo -j ACCEPT'),
+    ]
+    rules += [('TORO2CHAIN_INPUT', f'-d {net} -j ACCEPT') for net in spec.bypass_nets]
+
+    rules += [
+        ('TORO2CHAIN_OUTPUT', '-m state --state INVALID -j DROP'),
+        ('TORO2CHAIN_OUTPUT', '-m state --state RELATED,ESTABLISHED -j ACCEPT'),
+    ]
+    if spec.vpn_up:
+        rules.append(('TORO2CHAIN_OUTPUT', f'-o {spec.vpn_iface} {tor_syn}'))
+        for oi in spec.out_ifaces:
+            rules.append(('TORO2CHAIN_OUTPUT', f'-o {oi} -j DROP'))
+            rules.append(('FORWARD', f'-o {oi} {OWNED_COMMENT} -j DROP'))
+    else:
+        rules += [('TORO2CHAIN_OUTPUT', f'-o {oi} {tor_syn}') for oi in spec.out_ifaces]
+
+    rules.append(('TORO2CHAIN_OUTPUT', '-d 127.0.0.1/32 -o lo -j ACCEPT'))
+    # Tor transproxy magic
+    rules += [('TORO2CHAIN_OUTPUT', f'-d 127.0.0.1/32 -p tcp -m tcp --dport {port} {TCP_SYN} -j ACCEPT')
+              for port in spec.trans_ports]
+    rules += [('TORO2CHAIN_OUTPUT', f'-d {net} -j ACCEPT') for net in spec.bypass_nets]
+    rules.append(('TORO2CHAIN_OUTPUT', '-j DROP'))
+
+    return rules
+
+
+_counters_re = re.compile(r'^\[(\d+):(\d+)\]\s+')
+
+
+def parse_save(text):
+    # iptables-save [-c] output => {table: {'chains': {name: policy}, 'rules': [(chain, spec, counters)]}}
+    tables = {}
+    table = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line == 'COMMIT':
+            continue
+
+        if line.startswith('*'):
+            table = tables.setdefault(line[1:], {'chains': {}, 'rules': []})
+        elif line.startswith(':') and table is not None:
+            name, policy = line[1:].split()[:2]
+            table['chains'][name] = policy
+        elif table is not None:
+            counters = None
+            m = _counters_re.match(line)
+            if m:
+                counters = (int(m.group(1)), int(m.group(2)))
+                line = line[m.end():]
+            if line.startswith('-A '):
+                chain, _, spec = line[3:].partition(' ')
+                table['rules'].append((chain, spec.strip(), counters))
+
+    return tables
+
+
+def _has_rule(live, table, chain, spec):
+    return any(c == chain and s == spec for c, s, _ in live.get(table, {}).get('rules', []))
+
+
+def ipv4_ruleset(spec, live=None):
+    # Single iptables-restore --noflush transaction adding the TORO2 rules.
+    # Declaring TORO2CHAIN_* flushes them if they already exist, jumps
+    # from the built-in chains are inserted only once.
+    live = live or {}
+    out = []
+
+    for table, rules in (('filter', filter_rules(spec)), ('nat', nat_rules(spec))):
+        out.append(f'*{table}')
+        if table == 'filter':
+            out += [':FORWARD DROP [0:0]', ':OUTPUT DROP [0:0]']
+        out += [f':{chain} - [0:0]' for chain in TORO2_CHAINS[table]]
+
+        for builtin, chain in TORO2_JUMPS[table]:
+            if not _has_rule(live, table, builtin, f'-j {chain}'):
+                out.append(f'-I {builtin} 1 -j {chain}')
+
+        out += [f'-A {chain} {rule}' for chain, rule in rules if chain in TORO2_CHAINS[table]]
+        tdata = live.get(table, {'chains': {}, 'rules': []})
+        out += _builtin_rules_diff(spec, tdata, [(c, r) for c, r in rules if c not in TORO2_CHAINS[table]])[0]
+        out.append('COMMIT')
+
+    return '\n'.join(out) + '\n'
+
+
+def ipv6_ruleset():
+    return '*filter\n:INPUT DROP [0:0]\n:FORWARD DROP [0:0]\n:OUTPUT DROP [0:0]\nCOMMIT\n'
+
+
+def ipv4_teardown(live):
+    # Remove jumps & TORO2CHAIN_* present in the live ruleset and set the
+    # filter policies back, everything in one transaction
+    out = []
+
+    for table in ('filter', 'nat'):
+        out.append(f'*{table}')
+        if table == 'filter':
+            out += [':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT DROP [0:0]']
+
+        tdata = live.get(table, {'chains': {}, 'rules': []})
+        for builtin, chain in TORO2_JUMPS[table]:
+            for c, s, _ in tdata['rules']:
+                if c == builtin and s == f'-j {chain}':
+                    out.append(f'-D {builtin} -j {chain}')
+
+        for chain in TORO2_CHAINS[table]:
+            if chain in tdata['chains']:
+                out += [f'-F {chain}', f'-X {chain}']
+        out.append('COMMIT')
+
+    return '\n'.join(out) + '\n'
+
+
+def _chain_diff(chain, live_rules, desired):
+    # restore commands turning the live rules of a chain into the desired
+    # ones, touching only the rules that differ. Last changes come first so
+    # the positions of the earlier ones are still those of the live chain.
+    import difflib
+
+    live_specs = [s for s, _ in live_rules]
+    out = []
+    changes = {'added': 0, 'deleted': 0, 'replaced': 0}
+
+    opcodes = difflib.SequenceMatcher(None, live_specs, desired, autojunk=False).get_opcodes()
+    for tag, i1, i2, j1, j2 in reversed(opcodes):
+        if tag == 'equal':
+            continue
+
+        if tag == 'replace' and i2 - i1 == j2 - j1:
+            # same slot, new rule: it keeps the slot's counters
+            for k in range(i2 - i1):
+                counters = live_rules[i1 + k][1] or (0, 0)
+                out.append(f'[{counters[0]}:{counters[1]}] -R {chain} {i1 + k + 1} {desired[j1 + k]}')
+            changes['replaced'] += i2 - i1
+            continue
+
+        out += [f'-D {chain} {pos}' for pos in range(i2, i1, -1)]
+        out += [f'-I {chain} {i1 + k + 1} {rule}' for k, rule in enumerate(desired[j1:j2])]
+        changes['deleted'] += i2 - i1
+        changes['added'] += j2 - j1
+
+    return out, changes
+
+
+_forward_drop_re = re.compile(r'^-o (\S+) (?:' + re.escape(OWNED_COMMENT) + r' )?-j DROP$')
+
+
+def _owned_builtin_rules(spec, tdata):
+    # toro2's rules in the live built-in chains: the tagged FORWARD drops of
+    # any interface, and the untagged ones an older toro2 wrote for out_ifaces
+    owned = []
+    for chain, rule, _ in tdata['rules']:
+        m = _forward_drop_re.match(rule) if chain == 'FORWARD' else None
+        if m and (OWNED_COMMENT in rule or m.group(1) in spec.out_ifaces):
+            owned.append((chain, rule))
+    return owned
+
+
+def _builtin_rules_diff(spec, tdata, desired):
+    # => (restore lines, added, deleted): the desired built-in chain rules
+    # appended once, every other rule of toro2's there (or a duplicate) deleted
+    lines, added, deleted = [], 0, 0
+    kept = set()
+    for chain, rule in _owned_builtin_rules(spec, tdata):
+        if (chain, rule) in desired and (chain, rule) not in kept:
+            kept.add((chain, rule))
+        else:
+            lines.append(f'-D {chain} {rule}')
+            deleted += 1
+    for chain, rule in desired:
+        if (chain, rule) not in kept:
+            lines.append(f'-A {chain} {rule}')
+            added += 1
+    return lines, added, deleted
+
+
+def reconcile(spec, live):
+    # Incremental counterpart of ipv4_ruleset: live is parse_save() of
+    # 'iptables-save -c'. Only the rules that differ are inserted, deleted
+    # or replaced; TORO2CHAIN_* are never flushed, so the rules in use (and
+    # their counters) stay and established flows keep matching. One
+    # 'iptables-restore --noflush --counters' transaction.
+    # => (ruleset, '' if already in sync; {added, deleted, replaced, kept})
+    out = []
+    changes = {'added': 0, 'deleted': 0, 'replaced': 0, 'kept': 0}
+
+    for table, rules in (('filter', filter_rules(spec)), ('nat', nat_rules(spec))):
+        tdata = live.get(table, {'chains': {}, 'rules': []})
+        lines = []
+
+        if table == 'filter':
+            lines += [f':{chain} DROP [0:0]' for chain in ('FORWARD', 'OUTPUT')
+                      if tdata['chains'].get(chain) != 'DROP']
+
+        # declaring a chain with --noflush flushes it: only the missing ones
+        lines += [f':{chain} - [0:0]' for chain in TORO2_CHAINS[table] if chain not in tdata['chains']]
+
+        for builtin, chain in TORO2_JUMPS[table]:
+            if not _has_rule({table: tdata}, table, builtin, f'-j {chain}'):
+                lines.append(f'-I {builtin} 1 -j {chain}')
+
+        for chain in TORO2_CHAINS[table]:
+            live_rules = [(s, counters) for c, s, counters in tdata['rules'] if c == chain]
+            desired = [r for c, r in rules if c == chain]
+            diff, chain_changes = _chain_diff(chain, live_rules, desired)
+            lines += diff
+            for k, v in chain_changes.items():
+                changes[k] += v
+            changes['kept'] += len(desired) - chain_changes['added'] - chain_changes['replaced']
+
+        diff, added, deleted = _builtin_rules_diff(spec, tdata, [(c, r) for c, r in rules
+                                                                 if c not in TORO2_CHAINS[table]])
+        lines += diff
+        changes['added'] += added
+        changes['deleted'] += deleted
+
+        if lines:
+            out += [f'*{table}', *lines, 'COMMIT']
+
+    return ('\n'.join(out) + '\n' if out else ''), changes
+
+
+def ipv6_reconcile(live):
+    # ipv6_ruleset, only for the policies that aren't DROP yet
+    chains = live.get('filter', {}).get('chains', {})
+    lines = [f':{chain} DROP [0:0]' for chain in ('INPUT', 'FORWARD', 'OUTPUT') if chains.get(chain) != 'DROP']
+    if not lines:
+        return ''
+    return '\n'.join(['*filter', *lines, 'COMMIT']) + '\n'
+
+
+# 'toro2 traffic': what each TORO2 rule is for, from the way the rules above
+# are written (a rule of an older toro2.conf still gets its meaning), with
+# the jumps into the chains counting everything that went through them
+TRAFFIC_CATEGORIES = ['entered', 'established', 'tor uid', 'dns redirect', 'onion redirect', 'transport redirect',
+                      'icmp redirect', 'loopback', 'transport accept', 'lan bypass', 'reserved bypass',
+                      'ssh accept', 'icmp accept', 'invalid drop', 'vpn leak drop', 'drop', 'other']
+
+
+def rule_category(chain, rule, resv_iana=()):
+    # chain & rule as iptables-save prints them => one of TRAFFIC_CATEGORIES
+    words = rule.split()
+    target = words[words.index('-j') + 1] if '-j' in words[:-1] else None
+    dest = words[words.index('-d') + 1] if '-d' in words[:-1] else None
+
+    if target in TORO2_CHAINS['filter'] + TORO2_CHAINS['nat']:
+        return 'entered'
+    if 'RELATED,ESTABLISHED' in words:
+        return 'established'
+    if 'INVALID' in words:
+        return 'invalid drop'
+    if '--uid-owner' in words:
+        return 'tor uid'
+
+    if target == 'REDIRECT':
+        if '53' in words and '--dport' in words:
+            return 'dns redirect'
+        if '--icmp-type' in words:
+            return 'icmp redirect'
+        if dest is not None:
+            # only virtual_addr_network (AutomapHostsOnResolve: .onion & friends) is redirected by address
+            return 'onion redirect'
+        return 'transport redirect'
+
+    if ('-o' in words or '-i' in words) and 'lo' in words:
+        return 'loopback'
+    if '--icmp-type' in words:
+        return 'icmp accept'
+    if '--dport' in words and '22' in words:
+        return 'ssh accept'
+    if dest == '127.0.0.1/32' and '--dport' in words:
+        return 'transport accept'
+    if dest is not None and target in ('RETURN', 'ACCEPT'):
+        return 'reserved bypass' if dest in resv_iana else 'lan bypass'
+    if target == 'DROP':
+        # the last rule of TORO2CHAIN_OUTPUT, or what is dropped per interface while the VPN is up
+        return 'vpn leak drop' if '-o' in words else 'drop'
+    return 'other'
+
+
+def traffic(live, resv_iana=()):
+    # parse_save() of 'iptables-save -c' => [{table, chain, pos, rule, category, packets, bytes}]
+    # for the TORO2CHAIN_* rules & the jumps into them, as ordered in the ruleset
+    resv_iana = [normalize_net(n) for n in resv_iana]
+    rows = []
+    for table in ('filter', 'nat'):
+        positions = {}
+        for chain, rule, counters in live.get(table, {}).get('rules', []):
+            positions[chain] = positions.get(chain, 0) + 1
+            jump = rule.startswith('-j ') and (chain, rule[3:]) in TORO2_JUMPS[table]
+            if chain not in TORO2_CHAINS[table] and not jump:
+                continue
+            packets, nbytes = counters or (0, 0)
+            rows.append({'table': table, 'chain': chain, 'pos': positions[chain], 'rule': rule,
+                         'category': rule_category(chain, rule, resv_iana), 'packets': packets, 'bytes': nbytes})
+    return rows
+
+
+def traffic_rates(prev, rows, elapsed):
+    # per-second packets & bytes of every rule since prev (rows of an
+    # earlier traffic()), None where the rule is new or its counters went
+    # back (rules reloaded, counters zeroed)
+    before = {}
+    for r in prev or []:
+        before.setdefault((r['table'], r['chain'], r['rule']), []).append(r)
+
+    for r in rows:
+        earlier = before.get((r['table'], r['chain'], r['rule']))
+        p = earlier.pop(0) if earlier else None
+        if p is None or elapsed <= 0 or r['packets'] < p['packets'] or r['bytes'] < p['bytes']:
+            r['pps'] = r['bps'] = None
+        else:
+            r['pps'] = (r['packets'] - p['packets']) / elapsed
+            r['bps'] = (r['bytes'] - p['bytes']) / elapsed
+    return rows
+
+
+def traffic_by_category(rows):
+    # => {(table, category): {packets, bytes, pps, bps}}, in TRAFFIC_CATEGORIES order
+    totals = {}
+    for r in sorted(rows, key=lambda r: (r['table'], TRAFFIC_CATEGORIES.index(r['category']))):
+        # what entered each chain: the jump's target
+        category = f'entered {r["rule"][3:]}' if r['category'] == 'entered' else r['category']
+        key = (r['table'], category)
+        t = totals.setdefault(key, {'packets': 0, 'bytes': 0, 'pps': 0.0, 'bps': 0.0})
+        t['packets'] += r['packets']
+        t['bytes'] += r['bytes']
+        for rate in ('pps', 'bps'):
+            if t[rate] is not None and r.get(rate) is not None:
+                t[rate] += r[rate]
+            else:
+                t[rate] = None
+    return totals
+
+
+# nftables backend: one 'inet toro2' table, bypass/reserved networks live in
+# interval sets and per-interface verdicts in a verdict map, so each of them
+# is a single lookup instead of a linear walk over -d/-o rules
+
+# privhelper.NFT_TABLE (the helper's allow-list) names it too
+NFT_TABLE = 'inet toro2'
+NFT_SYN = 'tcp flags & (fin|syn|rst|ack) == syn'
+
+
+def _nft_elements(items, quote=False):
+    if quote:
+        items = [f'"{i}"' for i in items]
+    return f'elements = {{ {", ".join(items)} }}'
+
+
+def _nft_set(name, stype, items, interval=False, quote=False):
+    body = [f'type {stype};']
+    if interval:
+        body.append('flags interval; auto-merge;')
+    if items:
+        body.append(_nft_elements(items, quote=quote) + ';')
+    return f'    set {name} {{ {" ".join(body)} }}'
+
+
+def _nft_replace(body):
+    # 'table; delete table; table {...}' is the atomic replace idiom for nft -f
+    return f'table {NFT_TABLE}\ndelete table {NFT_TABLE}\ntable {NFT_TABLE} {{\n{body}\n}}\n'
+
+
+def _nft_trans_redirect(spec):
+    if len(spec.trans_ports) == 1:
+        return f'redirect to :{spec.trans_port}'
+    # per-flow hash over the TransPorts of all tor instances
+    port_map = ', '.join(f'{i} : {port}' for i, port in enumerate(spec.trans_ports))
+    return f'redirect to :jhash ip saddr . th sport mod {len(spec.trans_ports)} map {{ {port_map} }}'
+
+
+def _nft_tor_oif_elements(spec):
+    # interfaces tor may open connections through
+    if spec.vpn_up:
+        tor_oif = {spec.vpn_iface: 'accept'}
+    else:
+        tor_oif = {oi: 'accept' for oi in spec.out_ifaces}
+    return [f'"{k}" : {v}' for k, v in tor_oif.items()]
+
+
+def nft_ruleset(spec):
+    trans_redirect = _nft_trans_redirect(spec)
+    tor_oif_elements = _nft_tor_oif_elements(spec)
+
+    tor_oif_map = '    map tor_oif { type ifname : verdict;'
+    if tor_oif_elements:
+        tor_oif_map += f' {_nft_elements(tor_oif_elements)};'
+    tor_oif_map += ' }'
+
+    out = [
+        _nft_set('bypass_v4', 'ipv4_addr', spec.bypass_nets, interval=True),
+        _nft_set('reserved_v4', 'ipv4_addr', spec.resv_iana, interval=True),
+        _nft_set('out_ifaces', 'ifname', spec.out_ifaces, quote=True),
+        tor_oif_map,
+        '',
+        '    chain nat_output {',
+        '        type nat hook output priority -100; policy accept;',
+        f'        ip daddr {spec.virtual_addr_network} {NFT_SYN} {trans_redirect}',
+        f'        ip daddr 127.0.0.1 udp dport 53 redirect to :{spec.dns_port}',
+        f'        meta l4proto {{ tcp, udp }} th dport 53 redirect to :{spec.dns_port}',
+        '        ct state established,related return',
+        '        icmp type echo-request redirect',
+        f'        meta skuid {spec.tor_uid} return',
+        '        oifname "lo" return',
+        '        ip daddr @bypass_v4 return',
+        '        ip daddr @reserved_v4 return',
+        f'        meta l4proto {{ tcp, udp }} {trans_redirect}',
+        '    }',
+        '',
+        '    chain input {',
+        '        type filter hook input priority 0; policy accept;',
+        '        meta nfproto ipv6 drop',
+        '        icmp type echo-reply accept',
+        '        ct state invalid drop',
+        '        iifname @out_ifaces tcp dport 22 ct state new accept',
+        '        ct state established,related accept',
+        '        iifname "lo" accept',
+        '        ip daddr @bypass_v4 accept',
+        '    }',
+        '',
+        '    chain forward {',
+        '        type filter hook forward priority 0; policy drop;',
+        '    }',
+        '',
+        '    chain output {',
+        '        type filter hook output priority 0; policy drop;',
+        '        meta nfproto ipv6 drop',
+        '        ct state invalid drop',
+        '        ct state established,related accept',
+        f'        meta skuid {spec.tor_uid} {NFT_SYN} ct state new oifname vmap @tor_oif',
+    ]
+    if spec.vpn_up:
+        out.append('        oifname @out_ifaces drop')
+    out += [
+        '        ip daddr 127.0.0.1 oifname "lo" accept',
+        f'        ip daddr 127.0.0.1 tcp dport {{ {", ".join(map(str, spec.trans_ports))} }} {NFT_SYN} accept',
+        '        ip daddr @bypass_v4 accept',
+        '    }',
+    ]
+
+    return _nft_replace('\n'.join(out))
+
+
+def nft_ifaces_update(prev, spec):
+    # interfaces changed: refill the out_ifaces set & tor_oif map of the live
+    # table in one transaction, rules untouched. None when the VPN came up
+    # or went down: the rules differ then, replace the whole table.
+    if prev.vpn_up != spec.vpn_up:
+        return None
+
+    out = [f'flush set {NFT_TABLE} out_ifaces', f'flush map {NFT_TABLE} tor_oif']
+    if spec.out_ifaces:
+        quoted = [f'"{oi}"' for oi in spec.out_ifaces]
+        out.append(f'add element {NFT_TABLE} out_ifaces {{ {", ".join(quoted)} }}')
+    tor_oif_elements = _nft_tor_oif_elements(spec)
+    if tor_oif_elements:
+        out.append(f'add element {NFT_TABLE} tor_oif {{ {", ".join(tor_oif_elements)} }}')
+    return '\n'.join(out) + '\n'
+
+
+def nft_killswitch():
+    # What stays after stop: same as iptablesD leaving OUTPUT & IPv6 policies on DROP
+    return _nft_replace('\n'.join([
+        '    chain input {',
+        '        type filter hook input priority 0; policy accept;',
+        '        meta nfproto ipv6 drop',
+        '    }',
+        '    chain forward {',
+        '        type filter hook forward priority 0; policy drop;',
+        '    }',
+        '    chain output {',
+        '        type filter hook output priority 0; policy drop;',
+        '    }',
+    ]))
+
+
+def nft_output_policy(listing):
+    # 'nft list chain inet toro2 output' => policy of the output hook
+    m = re.search(r'policy\s+(\w+)\s*;', listing)
+    return m.group(1).upper() if m else None
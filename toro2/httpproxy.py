@@ -0,0 +1,553 @@
+import asyncio
+import secrets
+import signal
+import socket
+import struct
+import time
+from urllib.parse import urlsplit
+
+
+# HTTP proxy forwarding to tor's SocksPort, a lighter stand-in for privoxy
+# when nothing is to be filtered: CONNECT is tunneled, plain HTTP requests
+# are forwarded with their bodies streamed through, never parsed or
+# buffered whole. Reads go straight into one preallocated buffer per
+# direction (sock_recv_into), writes send slices of it (memoryview): no
+# per-chunk copies or allocations.
+#
+# Opening a stream through tor costs a round trip to the exit, so the
+# upstream connection of a plain HTTP request is kept open afterwards (up
+# to `keepalive` seconds) and reused by the next request to the same
+# destination, and a new one sends the SOCKS5 greeting, authentication &
+# CONNECT in one write: one round trip to tor instead of three.
+#
+# With isolate='destination' each destination host is a different SOCKS
+# username, i.e. its own circuit (tor's IsolateSOCKSAuth, on by default):
+# sites can't be linked to each other by the exit they see.
+
+BUFSIZE = 65536
+HEAD_LIMIT = 65536
+
+ISOLATION = ('none', 'destination')
+
+# dropped from what is forwarded, with whatever Connection lists
+HOP_BY_HOP = {b'connection', b'keep-alive', b'proxy-connection', b'proxy-authorization',
+              b'proxy-authenticate', b'te', b'trailer', b'upgrade'}
+
+SOCKS5_REPLIES = {1: 'general failure', 2: 'not allowed by ruleset', 3: 'network unreachable',
+                  4: 'host unreachable', 5: 'connection refused', 6: 'TTL expired',
+                  7: 'command not supported', 8: 'address type not supported'}
+
+REASONS = {400: 'Bad Request', 431: 'Request Header Fields Too Large', 502: 'Bad Gateway',
+           504: 'Gateway Timeout'}
+
+
+class ProxyError(Exception):
+    # => an error response to the client
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class _Stream:
+    # A non-blocking socket & the bytes read past what its user consumed
+    # (the rest of a packet a head was in): they are served first.
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self.ahead = bytearray()
+
+    async def recv_into(self, view):
+        if self.ahead:
+            n = min(len(view), len(self.ahead))
+            view[:n] = self.ahead[:n]
+            del self.ahead[:n]
+            return n
+        return await self.loop.sock_recv_into(self.sock, view)
+
+    async def read_until(self, sep, limit=HEAD_LIMIT):
+        # => bytes up to & with sep, b'' when closed before anything came
+        buf = self.ahead
+        searched = 0
+        while True:
+            i = buf.find(sep, max(0, searched - len(sep) + 1))
+            if i >= 0:
+                out = bytes(buf[:i + len(sep)])
+                del buf[:i + len(sep)]
+                return out
+            if len(buf) > limit:
+                raise ProxyError(431, 'header too large')
+            searched = len(buf)
+            chunk = await self.loop.sock_recv(self.sock, BUFSIZE)
+            if not chunk:
+                if buf:
+                    raise ConnectionError('connection closed in the middle of a header')
+                return b''
+            buf += chunk
+
+    async def read_exact(self, n):
+        while len(self.ahead) < n:
+            chunk = await self.loop.sock_recv(self.sock, BUFSIZE)
+            if not chunk:
+                raise ConnectionError('connection closed')
+            self.ahead += chunk
+        out = bytes(self.ahead[:n])
+        del self.ahead[:n]
+        return out
+
+    async def send(self, data):
+        await self.loop.sock_sendall(self.sock, data)
+
+    def alive(self):
+        # idle upstream still usable: open & nothing unasked for to read
+        if self.ahead:
+            return False
+        try:
+            # b'' (closed) or data: either way not a stream to send a request on
+            self.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def close(self):
+        self.sock.close()
+
+
+async def _copy(src, dst, buf, n=None):
+    # n bytes (None: until src closes) from src to dst => bytes copied
+    view = memoryview(buf)
+    copied = 0
+    while n is None or copied < n:
+        got = await src.recv_into(view if n is None else view[:min(len(view), n - copied)])
+        if not got:
+            if n is None:
+                break
+            raise ConnectionError('connection closed in the middle of a body')
+        await dst.send(view[:got])
+        copied += got
+    return copied
+
+
+async def _copy_chunked(src, dst, buf):
+    # a chunked body, passed on as it is (sizes, extensions, trailers)
+    while True:
+        line = await src.read_until(b'\r\n', 4096)
+        if not line:
+            raise ConnectionError('connection closed in the middle of a body')
+        await dst.send(line)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise ConnectionError(f'bad chunk size {line[:32]!r}')
+        if size == 0:
+            break
+        await _copy(src, dst, buf, size + 2)
+
+    while True:
+        line = await src.read_until(b'\r\n', 4096)
+        if not line:
+            raise ConnectionError('connection closed in the middle of a body')
+        await dst.send(line)
+        if line == b'\r\n':
+            return
+
+
+def parse_head(head):
+    # request/status head => (first line as 3 parts, [(name, value)])
+    lines = head.split(b'\r\n')
+    first = lines[0].split(b' ', 2)
+    if len(first) != 3:
+        raise ProxyError(400, f'bad first line {lines[0][:64]!r}')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(b':')
+        if not sep or not name or name != name.strip():
+            raise ProxyError(400, f'bad header {line[:64]!r}')
+        headers.append((name, value.strip()))
+    return first, headers
+
+
+def _get(headers, name):
+    values = [v for n, v in headers if n.lower() == name]
+    return b', '.join(values) if values else None
+
+
+def _tokens(value):
+    return {t.strip().lower() for t in value.split(b',')} if value else set()
+
+
+def _parse_response(head):
+    # what the destination sent is no fault of the client's
+    try:
+        return parse_head(head)
+    except ProxyError as e:
+        raise ProxyError(502, f'bad response: {e}')
+
+
+def _body_framing(headers, status=400):
+    # => 'chunked' | content length | None (no body, or until close)
+    if b'chunked' in _tokens(_get(headers, b'transfer-encoding')):
+        return 'chunked'
+    length = _get(headers, b'content-length')
+    if length is not None:
+        try:
+            return int(length.split(b',')[0])
+        except ValueError:
+            raise ProxyError(status, f'bad Content-Length {length[:32]!r}')
+    return None
+
+
+def _keep_alive(version, headers):
+    connection = _tokens(_get(headers, b'connection')) | _tokens(_get(headers, b'proxy-connection'))
+    if version == b'HTTP/1.0':
+        return b'keep-alive' in connection
+    return b'close' not in connection
+
+
+def _forwarded_headers(headers):
+    drop = HOP_BY_HOP | _tokens(_get(headers, b'connection'))
+    return [(n, v) for n, v in headers if n.lower() not in drop]
+
+
+def _head(first, headers, connection):
+    return b'\r\n'.join([b' '.join(first)] + [n + b': ' + v for n, v in headers] +
+                        [b'Connection: ' + connection, b'', b''])
+
+
+def _split_hostport(value, default_port):
+    if value.startswith('['):
+        host, _, rest = value[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+    else:
+        host, _, port = value.partition(':') if value.count(':') == 1 else (value, '', '')
+    if not host:
+        raise ProxyError(400, f'no host in {value!r}')
+    try:
+        return host, int(port) if port else default_port
+    except ValueError:
+        raise ProxyError(400, f'bad port in {value!r}')
+
+
+class _Pool:
+    # Upstream streams idle between requests, per (isolation, host, port),
+    # the most recently used first; gone after `idle` seconds
+
+    def __init__(self, idle, per_key=4):
+        self.idle = idle
+        self.per_key = per_key
+        self._free = {}
+
+    def get(self, key):
+        conns = self._free.get(key)
+        now = time.monotonic()
+        while conns:
+            stream, since = conns.pop()
+            if now - since < self.idle and stream.alive():
+                return stream
+            stream.close()
+        return None
+
+    def put(self, key, stream):
+        if self.idle <= 0:
+            stream.close()
+            return
+        conns = self._free.setdefault(key, [])
+        conns.append((stream, time.monotonic()))
+        if len(conns) > self.per_key:
+            conns.pop(0)[0].close()
+
+    def expire(self):
+        now = time.monotonic()
+        for key, conns in list(self._free.items()):
+            for stream, since in conns:
+                if now - since >= self.idle:
+                    stream.close()
+            conns[:] = [(s, t) for s, t in conns if now - t < self.idle]
+            if not conns:
+                del self._free[key]
+
+    def __len__(self):
+        return sum(len(c) for c in self._free.values())
+
+    def close(self):
+        for conns in self._free.values():
+            for stream, _ in conns:
+                stream.close()
+        self._free.clear()
+
+
+class HttpProxy:
+    def __init__(self, listen=('127.0.0.1', 8118), socks=('127.0.0.1', 9050), isolate='destination', keepalive=5,
+                 connect_timeout=60, log=None):
+        if isolate not in ISOLATION:
+            raise ValueError(f'unknown isolation {isolate!r} (one of {", ".join(ISOLATION)})')
+        self.listen = listen
+        self.socks = socks
+        self.isolate = isolate
+        self.keepalive = float(keepalive)
+        self.connect_timeout = connect_timeout
+        self.log = log or (lambda msg: None)
+        self.address = None
+        self.stats = {'clients': 0, 'requests': 0, 'connects': 0, 'opened': 0, 'reused': 0, 'errors': 0}
+        # streams of one toro2 run never share circuits with other SOCKS clients
+        self._password = secrets.token_hex(8).encode()
+        self._pool = _Pool(self.keepalive)
+        self._loop = None
+        self._stop = None
+        self._tasks = set()
+
+    def _isolation(self, host):
+        return host.lower().encode('idna')[:255] if self.isolate == 'destination' else None
+
+    async def _socks_open(self, host, port, user):
+        # => _Stream of a SOCKS5 CONNECT to host:port, the whole handshake in one write
+        loop = self._loop
+        sock = socket.socket(socket.AF_INET6 if ':' in self.socks[0] else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = _Stream(loop, sock)
+        try:
+            await loop.sock_connect(sock, self.socks)
+
+            name = host.encode('idna')
+            connect = b'\x05\x01\x00\x03' + bytes([len(name)]) + name + struct.pack('!H', port)
+            if user:
+                await stream.send(b'\x05\x01\x02' + b'\x01' + bytes([len(user)]) + user +
+                                  bytes([len(self._password)]) + self._password + connect)
+            else:
+                await stream.send(b'\x05\x01\x00' + connect)
+
+            _, method = await stream.read_exact(2)
+            if method != (0x02 if user else 0x00):
+                raise ProxyError(502, f'SOCKS5 method {method} refused')
+            if user and (await stream.read_exact(2))[1] != 0:
+                raise ProxyError(502, 'SOCKS5 authentication refused')
+
+            reply = await stream.read_exact(4)
+            if reply[1] != 0:
+                raise ProxyError(502, f'{host}:{port}: {SOCKS5_REPLIES.get(reply[1], f"SOCKS5 reply {reply[1]}")}')
+            # bound address, unused
+            atyp = reply[3]
+            await stream.read_exact(4 + 2 if atyp == 1 else 16 + 2 if atyp == 4 else
+                                    (await stream.read_exact(1))[0] + 2)
+            self.stats['opened'] += 1
+            return stream
+
+        except BaseException:
+            stream.close()
+            raise
+
+    async def _open(self, host, port, user):
+        try:
+            return await asyncio.wait_for(self._socks_open(host, port, user), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise ProxyError(504, f'{host}:{port}: no connection through tor within {self.connect_timeout}s')
+        except (ConnectionError, OSError) as e:
+            raise ProxyError(502, f'tor SocksPort {self.socks[0]}:{self.socks[1]}: {e}')
+
+    async def _tunnel(self, client, first):
+        # CONNECT host:port => bytes both ways until both sides are done
+        host, port = _split_hostport(first[1].decode('latin-1'), 443)
+        upstream = await self._open(host, port, self._isolation(host))
+        self.stats['connects'] += 1
+
+        async def pipe(src, dst):
+            try:
+                await _copy(src, dst, bytearray(BUFSIZE))
+                dst.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                # one side reset: the other one goes too
+                src.sock.close()
+                dst.sock.close()
+
+        try:
+            await client.send(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            await asyncio.gather(pipe(client, upstream), pipe(upstream, client))
+        finally:
+            upstream.close()
+
+    async def _forward(self, client, first, headers, buf):
+        # one plain HTTP request & its response => client connection reusable
+        method, target, version = first
+        u = urlsplit(target.decode('latin-1'))
+        if u.scheme != 'http' or not u.netloc:
+            raise ProxyError(400, f'not a proxy request: {target[:64]!r} (https goes through CONNECT)')
+        host, port = _split_hostport(u.netloc.rpartition('@')[2], 80)
+        path = (u.path or '/') + (f'?{u.query}' if u.query else '')
+
+        client_keep = _keep_alive(version, headers)
+        framing = _body_framing(headers)
+        out = _forwarded_headers(headers)
+        if _get(out, b'host') is None:
+            out.insert(0, (b'Host', u.netloc.rpartition('@')[2].encode('latin-1')))
+        request = _head([method, path.encode('latin-1'), version], out, b'keep-alive')
+
+        key = (self._isolation(host), host, port)
+        upstream = self._pool.get(key)
+        reused = upstream is not None
+        if not reused:
+            upstream = await self._open(host, port, key[0])
+
+        try:
+            while True:
+                try:
+                    await upstream.send(request)
+                    if framing == 'chunked':
+                        await _copy_chunked(client, upstream, buf)
+                    elif framing:
+                        await _copy(client, upstream, buf, framing)
+                    status_head = await upstream.read_until(b'\r\n\r\n')
+                    if not status_head:
+                        raise ConnectionError('upstream closed')
+                    break
+                except (ConnectionError, OSError):
+                    # the kept-alive stream was closed at the other end meanwhile:
+                    # once more on a new one, if nothing of the body was consumed
+                    if not reused or framing:
+                        raise
+                    upstream.close()
+                    upstream = await self._open(host, port, key[0])
+                    reused = False
+            self.stats['reused'] += 1 if reused else 0
+
+            (rversion, status, reason), rheaders = _parse_response(status_head)
+            while status.startswith(b'1') and status != b'101':
+                # 100 Continue & co: passed on, the real response follows
+                await client.send(status_head)
+                status_head = await upstream.read_until(b'\r\n\r\n')
+                if not status_head:
+                    raise ConnectionError('upstream closed')
+                (rversion, status, reason), rheaders = _parse_response(status_head)
+
+            if method == b'HEAD' or status in (b'204', b'304'):
+                rframing = 0
+            else:
+                rframing = _body_framing(rheaders, 502)
+            # a body ending when the connection does: the client can't tell
+            # where it ends on a kept-alive connection
+            delimited = rframing is not None
+            upstream_keep = delimited and _keep_alive(rversion, rheaders)
+            client_keep = client_keep and delimited
+
+            await client.send(_head([rversion, status, reason], _forwarded_headers(rheaders),
+                                    b'keep-alive' if client_keep else b'close'))
+            if rframing == 'chunked':
+                await _copy_chunked(upstream, client, buf)
+            elif rframing:
+                await _copy(upstream, client, buf, rframing)
+            elif rframing is None:
+                await _copy(upstream, client, buf)
+
+        except BaseException:
+            upstream.close()
+            raise
+
+        if upstream_keep:
+            self._pool.put(key, upstream)
+        else:
+            upstream.close()
+        return client_keep
+
+    async def _client(self, sock):
+        loop = self._loop
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = _Stream(loop, sock)
+        buf = bytearray(BUFSIZE)
+        self.stats['clients'] += 1
+        first_request = True
+        try:
+            while True:
+                try:
+                    # between requests the client has `keepalive` seconds to send the next one
+                    head = await asyncio.wait_for(client.read_until(b'\r\n\r\n'),
+                                                  None if first_request else self.keepalive or None)
+                except asyncio.TimeoutError:
+                    return
+                if not head:
+                    return
+                first_request = False
+
+                try:
+                    first, headers = parse_head(head)
+                    self.stats['requests'] += 1
+                    if first[0] == b'CONNECT':
+                        await self._tunnel(client, first)
+                        return
+                    if not await self._forward(client, first, headers, buf):
+                        return
+                except ProxyError as e:
+                    self.stats['errors'] += 1
+                    self.log(f'{e.status} {e}')
+                    reason = REASONS.get(e.status, 'Error')
+                    body = f'{e.status} {reason}: {e}\n'.encode()
+                    await client.send(f'HTTP/1.1 {e.status} {reason}\r\nContent-Type: text/plain\r\n'
+                                      f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+                    return
+
+        except (ConnectionError, OSError) as e:
+            # the client or the destination went away in the middle of something
+            self.stats['errors'] += 1
+            self.log(f'connection dropped: {e}')
+
+        finally:
+            client.close()
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(max(self.keepalive, 1))
+            self._pool.expire()
+
+    async def serve(self, ready=None):
+        # until close(); `ready` (threading.Event) is set once listening
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+
+        family = socket.AF_INET6 if ':' in self.listen[0] else socket.AF_INET
+        server = socket.socket(family, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.listen)
+        server.listen(512)
+        server.setblocking(False)
+        self.address = server.getsockname()[:2]
+
+        async def accept():
+            while True:
+                sock, _ = await self._loop.sock_accept(server)
+                task = self._loop.create_task(self._client(sock))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+        acceptor = self._loop.create_task(accept())
+        expirer = self._loop.create_task(self._expire())
+        if ready is not None:
+            ready.set()
+        try:
+            await self._stop.wait()
+        finally:
+            acceptor.cancel()
+            expirer.cancel()
+            server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(acceptor, expirer, *self._tasks, return_exceptions=True)
+            self._pool.close()
+
+    def close(self):
+        # from any thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def run(self):
+        # in the foreground until SIGINT/SIGTERM
+        async def main():
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.close)
+            await self.serve()
+
+        asyncio.run(main())
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sysops
+
+
+# What install & upgrade put in place, driven by a manifest of the shipped
+# files: each file is hashed, compared with what the last install left
+# (install.manifest.json: hash & stat of every file it wrote) & copied only
+# when it differs, in parallel, in the kernel (copy_file_range) & atomically
+# (os.replace), then read back & checked. A file installed before whose
+# stat hasn't changed since is not even read.
+#
+# Kinds of files:
+#   app      toro2 itself: must match what is shipped, local changes are undone
+#   system   /etc files of the services: replaced when what is shipped
+#            changed since the last install, local edits are kept otherwise
+#   config   installed when missing, never overwritten (toro2.conf, ...)
+
+KINDS = ('app', 'system', 'config')
+
+MANIFEST = 'install.manifest.json'
+
+
+class FileEntry:
+    def __init__(self, src, dst, kind='app', mode=None, backup=False):
+        if kind not in KINDS:
+            raise ValueError(f'unknown kind {kind!r} (one of {", ".join(KINDS)})')
+        self.src = src
+        self.dst = dst
+        self.kind = kind
+        # None: the source's mode for a new file, an existing one keeps its own
+        self.mode = mode
+        # keep what is replaced as dst.bak
+        self.backup = backup
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stat_key(st):
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def tree(src, dst, excludes=(), kind='app', config=()):
+    # entries for every file under src, to the same place under dst; names
+    # in excludes are skipped at any depth, relative paths in config are
+    # installed as config files
+    entries = []
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        dirs[:] = sorted(d for d in dirs if d not in excludes and d != '__pycache__'
+                         and os.path.normpath(os.path.join(rel_root, d)) not in excludes)
+        for name in sorted(files):
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if name in excludes or rel in excludes or name.endswith('.pyc'):
+                continue
+            entries.append(FileEntry(os.path.join(root, name), os.path.join(dst, rel),
+                                     kind='config' if rel in config else kind))
+    return entries
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # first install, or one from before manifests: every file is looked at
+        return {'files': {}}
+
+
+def _plan(entry, previous):
+    # => (entry, source hash, what to do: 'copy' | 'unchanged' | 'kept', dst stat)
+    digest = file_hash(entry.src)
+    try:
+        st = os.stat(entry.dst)
+    except FileNotFoundError:
+        return entry, digest, 'copy', None
+
+    rec = previous.get(entry.dst)
+    if entry.kind == 'config':
+        return entry, digest, 'kept', st
+    if entry.kind == 'system' and rec and rec['hash'] == digest:
+        # same as what was installed last time: edited locally or not, leave it
+        return entry, digest, 'kept', st
+    if rec and rec['hash'] == digest and rec['stat'] == _stat_key(st):
+        return entry, digest, 'unchanged', st
+    if stat.S_ISREG(st.st_mode) and file_hash(entry.dst) == digest:
+        return entry, digest, 'unchanged', st
+    return entry, digest, 'copy', st
+
+
+def _put(entry, digest, st):
+    # => stat of the installed file; raises when it doesn't read back as digest
+    os.makedirs(os.path.dirname(entry.dst), exist_ok=True)
+    if entry.backup and st is not None:
+        sysops.copy(entry.dst, f'{entry.dst}.bak')
+    sysops.copy(entry.src, entry.dst)
+    if entry.mode is not None:
+        os.chmod(entry.dst, entry.mode)
+
+    if file_hash(entry.dst) != digest:
+        raise OSError(f'{entry.dst}: content differs from {entry.src} after copy')
+    return os.stat(entry.dst)
+
+
+def install(entries, manifest_path, workers=8):
+    # => {'copied', 'unchanged', 'kept', 'removed', 'failed': [(dst, error)], 'took'}
+    t0 = time.monotonic()
+    previous = load_manifest(manifest_path)['files']
+    result = {'copied': [], 'unchanged': 0, 'kept': [], 'removed': [], 'failed': []}
+    files = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        plans = list(pool.map(lambda e: _plan(e, previous), entries))
+
+        todo = []
+        for entry, digest, action, st in plans:
+            rec = {'src': entry.src, 'kind': entry.kind, 'hash': digest}
+            if action == 'copy':
+                todo.append((entry, digest, st, rec))
+                continue
+            if action == 'unchanged':
+                result['unchanged'] += 1
+                if entry.mode is not None and stat.S_IMODE(st.st_mode) != entry.mode:
+                    os.chmod(entry.dst, entry.mode)
+                rec['stat'] = _stat_key(st)
+            else:
+                result['kept'].append(entry.dst)
+                # what was installed is still what is shipped: remember it as such
+                if entry.dst in previous:
+                    rec = dict(previous[entry.dst], src=entry.src, kind=entry.kind)
+                else:
+                    rec['stat'] = None
+            files[entry.dst] = rec
+
+        futures = [(entry, rec, pool.submit(_put, entry, digest, st)) for entry, digest, st, rec in todo]
+        for entry, rec, future in futures:
+            try:
+                rec['stat'] = _stat_key(future.result())
+                files[entry.dst] = rec
+                result['copied'].append(entry.dst)
+            except Exception as e:
+                result['failed'].append((entry.dst, e))
+                if entry.dst in previous:
+                    files[entry.dst] = previous[entry.dst]
+
+    # app files shipped before & not any more (a module gone, renamed)
+    for dst, rec in previous.items():
+        if dst not in files and rec.get('kind', 'app') == 'app':
+            try:
+                sysops.remove(dst)
+                result['removed'].append(dst)
+            except Exception as e:
+                result['failed'].append((dst, e))
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp = f'{manifest_path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump({'installed': time.time(), 'files': files}, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+    result['took'] = time.monotonic() - t0
+    return result
@@ -0,0 +1,390 @@
+import bisect
+import calendar
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+import torcontrol
+
+
+# Tor health & throughput for Prometheus, from control port events: BW
+# (bytes read/written each second), CIRC (launched, built, failed, closed),
+# STREAM, CIRC_BW (bytes per circuit), STATUS_CLIENT (bootstrap) & SIGNAL
+# (NEWNYM). Events are folded into counters, gauges & fixed-bucket
+# histograms as they arrive; what is kept per circuit or stream lives only
+# while tor has it open (and is capped at MAX_TRACKED), so memory stays flat
+# however long the exporter runs.
+
+EVENTS = ['BW', 'CIRC', 'STREAM', 'CIRC_BW', 'STATUS_CLIENT', 'SIGNAL']
+
+# seconds from launch to built (tor gives up at 60 by default)
+BUILD_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 60)
+# bytes a circuit carried in its life: 1KiB .. 1GiB
+CIRCUIT_BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# BW events (one a second) the bytes/s gauges are averaged over
+RATE_WINDOW = 10
+# open circuits, circuits being built & open streams kept track of, each
+MAX_TRACKED = 8192
+# distinct reasons a failures counter keeps, the rest count as "other"
+MAX_REASONS = 32
+
+PREFIX = 'toro2_tor_'
+
+# name, type, help: the order families are exported in
+FAMILIES = [
+    ('up', 'gauge', 'Control port connection to tor established (1) or not (0)'),
+    ('bootstrap_percent', 'gauge', 'Bootstrap progress reported by tor'),
+    ('read_bytes_total', 'counter', 'Bytes read by tor (BW events)'),
+    ('written_bytes_total', 'counter', 'Bytes written by tor (BW events)'),
+    ('read_bytes_per_second', 'gauge', f'Bytes read per second, over the last {RATE_WINDOW}s'),
+    ('written_bytes_per_second', 'gauge', f'Bytes written per second, over the last {RATE_WINDOW}s'),
+    ('circuit_read_bytes_total', 'counter', 'Bytes read on circuits (CIRC_BW events)'),
+    ('circuit_written_bytes_total', 'counter', 'Bytes written on circuits (CIRC_BW events)'),
+    ('circuit_build_seconds', 'histogram', 'Time from circuit launch to built'),
+    ('circuit_bytes', 'histogram', 'Bytes a circuit carried, observed when it closes'),
+    ('circuit_failures_total', 'counter', 'Circuits failed, by reason'),
+    ('circuits_open', 'gauge', 'Circuits built & not closed'),
+    ('streams_open', 'gauge', 'Streams not closed'),
+    ('streams_succeeded_total', 'counter', 'Streams connected'),
+    ('stream_failures_total', 'counter', 'Streams failed, by reason'),
+    ('newnym_total', 'counter', 'NEWNYM signals tor received'),
+    ('events_total', 'counter', 'Control port events processed'),
+    ('untracked_total', 'counter', f'Circuits or streams no longer followed, past {MAX_TRACKED} open'),
+]
+
+
+class Histogram:
+    # Prometheus histogram with fixed buckets: constant size
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        # buckets are upper bounds, inclusive (le)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        cumulative = 0
+        out = []
+        for le, n in zip(self.buckets, self.counts):
+            cumulative += n
+            out.append(('_bucket', {'le': _number(le)}, cumulative))
+        cumulative += self.counts[-1]
+        out += [('_bucket', {'le': '+Inf'}, cumulative), ('_sum', {}, self.sum), ('_count', {}, cumulative)]
+        return out
+
+
+class Reasons:
+    # counter by reason, at most MAX_REASONS of them
+
+    def __init__(self):
+        self.counts = {}
+
+    def inc(self, reason):
+        reason = reason or 'NONE'
+        if reason not in self.counts and len(self.counts) >= MAX_REASONS:
+            reason = 'other'
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+
+    def samples(self):
+        return [('', {'reason': r}, n) for r, n in sorted(self.counts.items())]
+
+
+def parse_time_created(value):
+    # TIME_CREATED=2025-08-04T12:34:56.789012 (UTC) => epoch seconds
+    try:
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')) + float(value[19:] or 0)
+    except ValueError:
+        return None
+
+
+class TorMetrics:
+    # what one tor is doing; on_event() from the collector, samples() from
+    # whoever exports, both under self.lock
+
+    def __init__(self, instance='tor'):
+        self.instance = instance
+        self.lock = threading.Lock()
+        self.up = 0
+        self.bootstrap = 0
+        self.read_total = 0
+        self.written_total = 0
+        self._bw = deque(maxlen=RATE_WINDOW)
+        self.circuit_read_total = 0
+        self.circuit_written_total = 0
+        self.build = Histogram(BUILD_BUCKETS)
+        self.circuit_bytes = Histogram(CIRCUIT_BYTES_BUCKETS)
+        self.circuit_failures = Reasons()
+        self.streams_succeeded = 0
+        self.stream_failures = Reasons()
+        self.newnym = 0
+        self.events = 0
+        self.untracked = 0
+        # circ id => time.monotonic() launched, for circuits built with no TIME_CREATED
+        self._launched = {}
+        # circ id => bytes carried so far, built circuits not closed yet
+        self._circuits = {}
+        # stream ids not closed yet (dict: insertion ordered, oldest dropped first)
+        self._streams = {}
+
+    def _track(self, table, key, value):
+        if key not in table and len(table) >= MAX_TRACKED:
+            del table[next(iter(table))]
+            self.untracked += 1
+        table[key] = value
+
+    def sync(self, ctl):
+        # (re)connected: open circuits, streams & bootstrap as tor has them now
+        info = {}
+        for key in ('status/bootstrap-phase', 'circuit-status', 'stream-status'):
+            try:
+                info.update(ctl.getinfo(key))
+            except torcontrol.TorControlError:
+                # not known to this tor
+                pass
+
+        with self.lock:
+            self.up = 1
+            self._launched.clear()
+            self._circuits.clear()
+            self._streams.clear()
+
+            progress = torcontrol.parse_kv(info.get('status/bootstrap-phase', '')).get('PROGRESS')
+            if progress is not None:
+                self.bootstrap = int(progress)
+
+            for line in info.get('circuit-status', '').splitlines():
+                parts = line.split()
+                # the ones being built are timed by their TIME_CREATED, if at all
+                if len(parts) >= 2 and parts[1] == 'BUILT':
+                    self._track(self._circuits, parts[0], 0)
+
+            for line in info.get('stream-status', '').splitlines():
+                parts = line.split()
+                if parts:
+                    self._track(self._streams, parts[0], None)
+
+    def down(self):
+        with self.lock:
+            self.up = 0
+            self._bw.clear()
+
+    def on_event(self, event):
+        kind, _, rest = event.partition(' ')
+        handler = self._handlers.get(kind)
+        with self.lock:
+            self.events += 1
+            if handler is not None:
+                try:
+                    handler(self, rest)
+                except (ValueError, IndexError):
+                    # malformed: counted, ignored
+                    pass
+
+    def _on_bw(self, rest):
+        # BW <read> <written>: the last second
+        parts = rest.split()
+        read, written = int(parts[0]), int(parts[1])
+        self.read_total += read
+        self.written_total += written
+        self._bw.append((read, written))
+
+    def _on_circ(self, rest):
+        # CIRC <id> <status> [path] [KEY=VALUE ...]
+        parts = rest.split(' ', 2)
+        if len(parts) < 2:
+            return
+        circ_id, status = parts[0], parts[1]
+
+        if status == 'LAUNCHED':
+            self._track(self._launched, circ_id, time.monotonic())
+
+        elif status == 'BUILT':
+            launched = self._launched.pop(circ_id, None)
+            created = parse_time_created(torcontrol.parse_kv(rest).get('TIME_CREATED', ''))
+            if created is not None:
+                self.build.observe(max(0.0, time.time() - created))
+            elif launched is not None:
+                self.build.observe(time.monotonic() - launched)
+            self._track(self._circuits, circ_id, 0)
+
+        elif status == 'FAILED':
+            self._launched.pop(circ_id, None)
+            self.circuit_failures.inc(torcontrol.parse_kv(rest).get('REASON'))
+
+        elif status == 'CLOSED':
+            self._launched.pop(circ_id, None)
+            carried = self._circuits.pop(circ_id, None)
+            if carried is not None:
+                self.circuit_bytes.observe(carried)
+
+    def _on_circ_bw(self, rest):
+        # CIRC_BW ID=<id> READ=<bytes> WRITTEN=<bytes> ...: since the last one
+        kv = torcontrol.parse_kv(rest)
+        try:
+            read, written = int(kv.get('READ', 0)), int(kv.get('WRITTEN', 0))
+        except ValueError:
+            return
+        self.circuit_read_total += read
+        self.circuit_written_total += written
+        circ_id = kv.get('ID')
+        if circ_id in self._circuits:
+            self._circuits[circ_id] += read + written
+
+    def _on_stream(self, rest):
+        # STREAM <id> <status> <circ id> <target> [KEY=VALUE ...]
+        parts = rest.split(' ', 2)
+        if len(parts) < 2:
+            return
+        stream_id, status = parts[0], parts[1]
+
+        if status in ('CLOSED', 'FAILED'):
+            self._streams.pop(stream_id, None)
+            if status == 'FAILED':
+                self.stream_failures.inc(torcontrol.parse_kv(rest).get('REASON'))
+        else:
+            if status == 'SUCCEEDED':
+                self.streams_succeeded += 1
+            self._track(self._streams, stream_id, None)
+
+    def _on_status_client(self, rest):
+        # STATUS_CLIENT NOTICE BOOTSTRAP PROGRESS=.. TAG=.. SUMMARY=".."
+        if 'BOOTSTRAP' in rest:
+            progress = torcontrol.parse_kv(rest).get('PROGRESS')
+            if progress is not None:
+                self.bootstrap = int(progress)
+
+    def _on_signal(self, rest):
+        if rest.strip() == 'NEWNYM':
+            self.newnym += 1
+
+    _handlers = {'BW': _on_bw, 'CIRC': _on_circ, 'CIRC_BW': _on_circ_bw, 'STREAM': _on_stream,
+                 'STATUS_CLIENT': _on_status_client, 'SIGNAL': _on_signal}
+
+    def samples(self):
+        # => {family: [(suffix, labels, value)]}
+        with self.lock:
+            window = len(self._bw) or 1
+            return {
+                'up': [('', {}, self.up)],
+                'bootstrap_percent': [('', {}, self.bootstrap)],
+                'read_bytes_total': [('', {}, self.read_total)],
+                'written_bytes_total': [('', {}, self.written_total)],
+                'read_bytes_per_second': [('', {}, sum(r for r, _ in self._bw) / window)],
+                'written_bytes_per_second': [('', {}, sum(w for _, w in self._bw) / window)],
+                'circuit_read_bytes_total': [('', {}, self.circuit_read_total)],
+                'circuit_written_bytes_total': [('', {}, self.circuit_written_total)],
+                'circuit_build_seconds': self.build.samples(),
+                'circuit_bytes': self.circuit_bytes.samples(),
+                'circuit_failures_total': self.circuit_failures.samples(),
+                'circuits_open': [('', {}, len(self._circuits))],
+                'streams_open': [('', {}, len(self._streams))],
+                'streams_succeeded_total': [('', {}, self.streams_succeeded)],
+                'stream_failures_total': self.stream_failures.samples(),
+                'newnym_total': [('', {}, self.newnym)],
+                'events_total': [('', {}, self.events)],
+                'untracked_total': [('', {}, self.untracked)],
+            }
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(metrics):
+    # Prometheus text format (0.0.4) for any number of tors, one family at a time
+    collected = [(m.instance, m.samples()) for m in metrics]
+    lines = []
+    for name, kind, help_text in FAMILIES:
+        lines.append(f'# HELP {PREFIX}{name} {help_text}')
+        lines.append(f'# TYPE {PREFIX}{name} {kind}')
+        for instance, samples in collected:
+            for suffix, labels, value in samples.get(name, []):
+                labels = {'instance': instance, **labels}
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f'{PREFIX}{name}{suffix}{{{label_text}}} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class Collector:
+    # Follows one tor: connects, subscribes to EVENTS, feeds them to its
+    # TorMetrics; connects again every `retry` seconds while tor is away
+
+    def __init__(self, connect, metrics, retry=5, log=None):
+        # connect() -> torcontrol.TorController, not connected yet
+        self.connect = connect
+        self.metrics = metrics
+        self.retry = retry
+        self.log = log or (lambda msg: None)
+
+    def run(self, stop=None):
+        # stop() -> True ends the loop
+        was_up = None
+        while not (stop and stop()):
+            try:
+                with self.connect() as ctl:
+                    self.metrics.sync(ctl)
+                    ctl.setevents(*EVENTS)
+                    if was_up is not True:
+                        self.log(f'{self.metrics.instance}: following control port events')
+                    was_up = True
+
+                    while not (stop and stop()):
+                        event = ctl.read_event(timeout=1)
+                        if event:
+                            self.metrics.on_event(event)
+
+            except (OSError, torcontrol.TorControlError) as e:
+                self.metrics.down()
+                if was_up is not False:
+                    self.log(f'{self.metrics.instance}: control port unusable ({e}), retrying every {self.retry}s')
+                was_up = False
+                time.sleep(self.retry)
+
+
+def write_textfile(path, metrics):
+    # node_exporter textfile collector: replaced atomically, never read half written
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(render(metrics))
+    os.replace(tmp, path)
+
+
+def serve(listen, metrics):
+    # GET /metrics on listen (host, port), in a thread of its own => server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render(metrics).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        address_family = socket.AF_INET6 if ':' in listen[0] else socket.AF_INET
+        daemon_threads = True
+
+    server = Server(listen, Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -0,0 +1,129 @@
+import os
+import select
+import socket
+import struct
+import time
+
+
+# rtnetlink(7): link & address changes are multicast to whoever joined
+# these groups, no privileges needed to listen
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+
+EVENTS = {RTM_NEWLINK: 'new-link', RTM_DELLINK: 'del-link', RTM_NEWADDR: 'new-addr', RTM_DELADDR: 'del-addr'}
+
+IFLA_IFNAME = 3
+IFA_LABEL = 3
+
+_nlmsghdr = struct.Struct('=IHHII')
+_ifinfomsg = struct.Struct('=BxHiII')
+_ifaddrmsg = struct.Struct('=BBBBi')
+_rtattr = struct.Struct('=HH')
+
+
+def interfaces():
+    # => names of the network interfaces there are right now
+    try:
+        return sorted(os.listdir('/sys/class/net'))
+    except OSError:
+        return []
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def _attrs(data, off, end):
+    # rtattr list => {type: payload}
+    attrs = {}
+    while off + _rtattr.size <= end:
+        length, atype = _rtattr.unpack_from(data, off)
+        if length < _rtattr.size:
+            break
+        attrs[atype] = data[off + _rtattr.size:off + length]
+        off += _align(length)
+    return attrs
+
+
+def _name(attrs, key, index):
+    if key in attrs:
+        return attrs[key].rstrip(b'\0').decode('utf-8', 'replace')
+    try:
+        return socket.if_indextoname(index)
+    except OSError:
+        # gone already, an address event of a deleted link
+        return None
+
+
+def parse(data):
+    # netlink datagram => [(event, interface name)]
+    events = []
+    off = 0
+    while off + _nlmsghdr.size <= len(data):
+        length, mtype, _, _, _ = _nlmsghdr.unpack_from(data, off)
+        if length < _nlmsghdr.size:
+            break
+        body = off + _nlmsghdr.size
+        end = off + length
+
+        if mtype in (RTM_NEWLINK, RTM_DELLINK):
+            _, _, index, _, _ = _ifinfomsg.unpack_from(data, body)
+            name = _name(_attrs(data, body + _ifinfomsg.size, end), IFLA_IFNAME, index)
+            events.append((EVENTS[mtype], name))
+        elif mtype in (RTM_NEWADDR, RTM_DELADDR):
+            _, _, _, _, index = _ifaddrmsg.unpack_from(data, body)
+            name = _name(_attrs(data, body + _align(_ifaddrmsg.size), end), IFA_LABEL, index)
+            events.append((EVENTS[mtype], name))
+
+        off += _align(length)
+    return events
+
+
+class LinkMonitor:
+    # Interfaces coming & going, addresses added & removed, as the kernel
+    # announces them (no polling)
+
+    def __init__(self, groups=RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self._sock.bind((0, groups))
+        self._sock.setblocking(False)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def read(self):
+        events = []
+        try:
+            while True:
+                events += parse(self._sock.recv(65536))
+        except BlockingIOError:
+            pass
+        except OSError:
+            # ENOBUFS: events were lost, the caller has to look again anyway
+            events.append(('overrun', None))
+        return events
+
+    def wait(self, timeout=None, settle=0.2):
+        # => events, [] on timeout; what follows within `settle` seconds
+        # (a link, then its addresses) comes along
+        events = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([self._sock], [], [], left)
+            if not readable:
+                return events
+
+            first = not events
+            events += self.read()
+            if first and events:
+                deadline = time.monotonic() + settle
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,150 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import runner
+
+
+class Step:
+    def __init__(self, name, action, rollback=None, after=()):
+        # action() -> truthy on success; False or an exception fails the run
+        self.name = name
+        self.action = action
+        self.rollback = rollback
+        self.after = list(after)
+        self.started = None
+        self.finished = None
+        self.ok = None
+        self.error = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class Orchestrator:
+    # Runs a dependency graph of steps, each one as soon as everything it
+    # depends on succeeded. On the first failure nothing new is scheduled,
+    # the running steps are awaited and the succeeded ones rolled back in
+    # reverse dependency order. With keep_going=True (teardown) a failure
+    # only skips the steps depending on it and nothing is rolled back.
+
+    def __init__(self, steps, max_workers=None, keep_going=False):
+        self.steps = {s.name: s for s in steps}
+        self.order = [s.name for s in steps]
+        self.max_workers = max_workers or len(steps) or 1
+        self.keep_going = keep_going
+        self.started = None
+        self.finished = None
+        self.failed = []
+        self.rolled_back = []
+        self._check()
+
+    def _check(self):
+        for s in self.steps.values():
+            for dep in s.after:
+                if dep not in self.steps:
+                    raise ValueError(f'step "{s.name}" depends on unknown step "{dep}"')
+
+        # Kahn's algorithm, only to reject cycles up front
+        indegree = {n: len(s.after) for n, s in self.steps.items()}
+        ready = [n for n, d in indegree.items() if d == 0]
+        seen = 0
+        while ready:
+            n = ready.pop()
+            seen += 1
+            for m, s in self.steps.items():
+                if n in s.after:
+                    indegree[m] -= 1
+                    if indegree[m] == 0:
+                        ready.append(m)
+        if seen != len(self.steps):
+            raise ValueError('steps dependency graph has a cycle')
+
+    @staticmethod
+    def _run_step(step):
+        step.started = time.perf_counter()
+        try:
+            with runner.span(step.name):
+                step.ok = bool(step.action())
+        except Exception as e:
+            step.ok = False
+            step.error = e
+        step.finished = time.perf_counter()
+        return step
+
+    def run(self):
+        self.started = time.perf_counter()
+        pending = list(self.order)
+        done = []
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if self.keep_going or not self.failed:
+                    for name in list(pending):
+                        step = self.steps[name]
+                        if all(self.steps[d].ok for d in step.after):
+                            pending.remove(name)
+                            # in the caller's context: what the step prints goes where the caller's does
+                            ctx = contextvars.copy_context()
+                            running[pool.submit(ctx.run, self._run_step, step)] = name
+
+                if not running:
+                    # failed, or the rest depends on something that failed
+                    break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    step = fut.result()
+                    del running[fut]
+                    if step.ok:
+                        done.append(step.name)
+                    else:
+                        self.failed.append(step.name)
+
+        if self.failed and not self.keep_going:
+            self._rollback(done)
+
+        self.finished = time.perf_counter()
+        return not self.failed
+
+    def _rollback(self, done):
+        # A step always finishes after its dependencies, so reverse
+        # completion order undoes dependants before what they depend on
+        for name in reversed(done):
+            step = self.steps[name]
+            if step.rollback is None:
+                continue
+            try:
+                with runner.span(f'{name} rollback'):
+                    step.rollback()
+            except Exception as e:
+                step.error = e
+            self.rolled_back.append(name)
+
+    @property
+    def wall_time(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def critical_path(self):
+        # Walk back from the last step to finish through the dependency
+        # that finished last: that chain is what bounded the wall time
+        ran = [s for s in self.steps.values() if s.finished is not None]
+        if not ran:
+            return []
+
+        step = max(ran, key=lambda s: s.finished)
+        path = [step]
+        while step.after:
+            deps = [self.steps[d] for d in step.after if self.steps[d].finished is not None]
+            if not deps:
+                break
+            step = max(deps, key=lambda s: s.finished)
+            path.append(step)
+
+        return list(reversed(path))
@@ -0,0 +1,96 @@
+import time
+
+import torcontrol
+
+
+class CircuitPool:
+    # Keeps `size` built, never used (clean) general circuits around.
+    # NEWNYM only makes circuits that already carried streams unusable, clean
+    # ones stay, so after a rotation new streams attach to a warm circuit at
+    # once instead of waiting for tor to build one.
+
+    def __init__(self, ctl, size=3, rotate_interval=0, stamp_file=None, log=None):
+        self.ctl = ctl
+        self.size = int(size)
+        self.rotate_interval = int(rotate_interval or 0)
+        self.stamp_file = stamp_file
+        self.log = log or (lambda msg: None)
+        self.warm = set()
+        self.pending = set()
+        self.used = set()
+        self.rotations = 0
+        self.last_rotation = time.monotonic()
+
+    def sync(self):
+        # circuits existing before we started: carrying streams => used,
+        # the rest can't be told apart from dirty ones, don't count them
+        streams = self.ctl.getinfo('stream-status').get('stream-status', '')
+        for line in streams.splitlines():
+            parts = line.split()
+            if len(parts) >= 3 and parts[2] != '0':
+                self.used.add(parts[2])
+
+    def top_up(self):
+        missing = self.size - len(self.warm) - len(self.pending)
+        for _ in range(max(0, missing)):
+            try:
+                self.pending.add(self.ctl.extend_circuit(purpose='general'))
+            except torcontrol.TorControlError as e:
+                self.log(f'unable to extend circuit: {e}')
+                break
+
+    def on_event(self, event):
+        parts = event.split()
+        if len(parts) < 3:
+            return
+
+        if parts[0] == 'CIRC':
+            circ_id, status = parts[1], parts[2]
+            if status == 'BUILT' and circ_id in self.pending:
+                self.pending.discard(circ_id)
+                if circ_id not in self.used:
+                    self.warm.add(circ_id)
+            elif status in ('FAILED', 'CLOSED'):
+                self.pending.discard(circ_id)
+                self.warm.discard(circ_id)
+                self.used.discard(circ_id)
+
+        elif parts[0] == 'STREAM' and len(parts) >= 4:
+            # STREAM <id> <status> <circ id> <target>
+            circ_id = parts[3]
+            if parts[2] in ('SENTCONNECT', 'SENTRESOLVE', 'SUCCEEDED') and circ_id != '0':
+                self.used.add(circ_id)
+                if circ_id in self.warm:
+                    self.warm.discard(circ_id)
+
+    def rotate(self):
+        t0 = time.monotonic()
+        self.ctl.newnym(stamp_file=self.stamp_file)
+        # used circuits are unusable for new streams from now on
+        self.used.clear()
+        self.rotations += 1
+        self.last_rotation = time.monotonic()
+        self.top_up()
+        return time.monotonic() - t0
+
+    def due(self):
+        return self.rotate_interval > 0 and time.monotonic() - self.last_rotation >= self.rotate_interval
+
+    def run(self, stop=None):
+        # stop() -> True ends the loop
+        self.ctl.setevents('CIRC', 'STREAM')
+        self.sync()
+        self.top_up()
+
+        while not (stop and stop()):
+            event = self.ctl.read_event(timeout=1)
+            if event:
+                had = len(self.warm)
+                self.on_event(event)
+                if len(self.warm) != had:
+                    self.log(f'warm circuits: {len(self.warm)}/{self.size}')
+            self.top_up()
+
+            if self.due():
+                took = self.rotate()
+                self.log(f'NEWNYM #{self.rotations} ({took:.2f}s), {len(self.warm)} warm circuit(s) ready')
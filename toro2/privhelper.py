@@ -0,0 +1,425 @@
+import json
+import os
+import queue
+import re
+import socket
+import stat
+import subprocess
+import sys
+import threading
+
+
+# A root helper started once per toro2 process (one sudo, one PAM session)
+# instead of one sudo per privileged command. It reads batches of commands
+# as JSON lines from a socketpair on its stdin/stdout, runs each that the
+# allow-list below lets through and streams one result line back per
+# command as it completes. The allow-list is the whole privilege surface:
+# firewall loads & dumps, OUTPUT policy, systemctl actions on the units
+# toro2 manages, chattr/rm/cp of the files toro2 owns (resolv.conf,
+# pidfile, locks) and signals to tor. Anything else runs through sudo as
+# before (runner.run): the helper never does more than toro2 already did.
+#
+# The allow-list is built root-side from the toro2.conf installed next to
+# this script, which only root may change: nothing on the command line or
+# from toro2 decides what the helper may do. toro2 builds the same one from
+# its config only to know what to send here.
+#
+# Runs as a script under 'python3 -I -S': the standard library only.
+#
+#   request  {"id": 1, "check": true, "ops": [{"argv": [...], "input": "...", "timeout": 3}, ...]}
+#   results  {"id": 1, "i": 0, "returncode": 0, "stdout": "...", "stderr": "..."}  one per op, in order
+#            {"id": 1, "i": 1, "denied": "reason"} / {"id": 1, "i": 1, "timeout": true, ...}
+#            {"id": 1, "done": true}
+#
+# Bytes travel as latin-1 strings. With check a batch stops at the first
+# command failing, denied or timed out.
+
+# toro2.conf keys the allow-list is made of & their defaults (toro2.py's)
+CONF_DEFAULTS = {
+    'toro2_homedir': '/etc/toro2', 'resolv_conf': '/etc/resolv.conf', 'pidfile': '/tmp/toro2.pid',
+    'required_services': ['privoxy', 'dnscrypt-proxy'],
+    'iptables': '/usr/bin/iptables', 'ip6tables': '/usr/bin/ip6tables', 'iptables_save': '/usr/bin/iptables-save',
+    'ip6tables_save': '/usr/bin/ip6tables-save', 'iptables_restore': '/usr/bin/iptables-restore',
+    'ip6tables_restore': '/usr/bin/ip6tables-restore', 'nft': '/usr/sbin/nft', 'systemctl': '/usr/bin/systemctl',
+    'chattr': '/usr/bin/chattr',
+}
+ROLES = ('iptables', 'ip6tables', 'iptables-save', 'ip6tables-save', 'iptables-restore', 'ip6tables-restore',
+         'nft', 'systemctl', 'chattr')
+# as firewall.NFT_TABLE
+NFT_TABLE = 'inet toro2'
+
+CHAINS = ('INPUT', 'OUTPUT', 'FORWARD')
+POLICIES = ('ACCEPT', 'DROP')
+SYSTEMCTL_ACTIONS = ('start', 'stop', 'restart', 'reload', 'enable', 'disable')
+# SIGHUP (tor reloads), SIGINT, SIGKILL, SIGTERM
+SIGNALS = (1, 2, 9, 15)
+
+_UNIT_RE = re.compile(r'^[A-Za-z0-9@_.:-]+$')
+
+
+def unit_name(srv):
+    return srv if '.' in srv else f'{srv}.service'
+
+
+def policy(conf, uid):
+    # what the helper may do, from toro2.conf values (CONF_DEFAULTS keys);
+    # uid: the user toro2 runs as
+    conf = {**CONF_DEFAULTS, **conf}
+    homedir = conf['toro2_homedir']
+    paths = [conf['resolv_conf'], conf['pidfile'], f'{homedir}/iptables.superbak.lock',
+             f'{homedir}/ip6tables.superbak.lock']
+    return {'programs': {role: str(conf[role.replace('-', '_')]) for role in ROLES if conf[role.replace('-', '_')]},
+            'units': sorted({unit_name(u) for u in [*conf['required_services'], 'tor']}),
+            'paths': sorted({str(p) for p in paths}), 'signal': ['tor'], 'nft_table': NFT_TABLE, 'uid': uid}
+
+
+def check(argv, policy):
+    # => None when argv (sudo left out) is allowed, else why not
+    if not argv:
+        return 'empty command'
+    prog, args = argv[0], list(argv[1:])
+
+    if prog == 'kill':
+        ok = len(args) == 2 and args[0][:1] == '-' and args[0][1:].isdigit() and \
+            int(args[0][1:]) in SIGNALS and args[1].isdigit()
+        return None if ok else f'kill {" ".join(args)}'
+    if prog == 'rm':
+        ok = len(args) == 2 and args[0] == '-f' and args[1] in policy['paths']
+        return None if ok else f'rm {" ".join(args)}'
+    if prog == 'cp':
+        ok = len(args) == 3 and args[0] == '-f' and args[2] in policy['paths']
+        return None if ok else f'cp {" ".join(args)}'
+
+    roles = [role for role, path in policy['programs'].items() if path == prog]
+    if not roles:
+        return f'{prog}: not an allowed program'
+
+    for role in roles:
+        if role in ('iptables-restore', 'ip6tables-restore'):
+            ok = set(args) <= {'--noflush', '--counters'}
+        elif role in ('iptables-save', 'ip6tables-save'):
+            ok = set(args) <= {'--counters'}
+        elif role in ('iptables', 'ip6tables'):
+            ok = (len(args) == 3 and args[0] == '-P' and args[1] in CHAINS and args[2] in POLICIES) or \
+                (len(args) == 3 and args[0] == '-L' and args[1] in CHAINS and args[2] == '-n')
+        elif role == 'nft':
+            table = policy['nft_table'].split()
+            ok = args == ['-f', '-'] or args == ['delete', 'table', *table] or \
+                (len(args) == 5 and args[:4] == ['list', 'chain', *table] and bool(_UNIT_RE.match(args[4])))
+        elif role == 'systemctl':
+            ok = args == ['daemon-reload'] or \
+                (len(args) > 1 and args[0] in SYSTEMCTL_ACTIONS and all(u in policy['units'] for u in args[1:]))
+        elif role == 'chattr':
+            ok = len(args) == 2 and args[0] in ('+i', '-i') and args[1] in policy['paths']
+        else:
+            ok = False
+        if ok:
+            return None
+
+    return f'{os.path.basename(prog)} {" ".join(args)}'
+
+
+# root side
+
+def _trusted(st):
+    # root's (or the helper's own user's) & nobody else may change it; a
+    # sticky directory (/tmp) only lets others change what is theirs
+    return st.st_uid in (0, os.geteuid()) and \
+        (not st.st_mode & 0o022 or (stat.S_ISDIR(st.st_mode) and st.st_mode & stat.S_ISVTX))
+
+
+def read_conf(path):
+    # toro2.conf as toro2 reads it (key=value, [lists] as literals) => {key:
+    # value}; it & every directory above it must be trusted. No file: the
+    # defaults, as for toro2
+    import ast
+
+    directory = os.path.dirname(path)
+    while True:
+        if not _trusted(os.stat(directory)):
+            raise PermissionError(f'{directory}: may be changed by others than root')
+        if directory == os.path.dirname(directory):
+            break
+        directory = os.path.dirname(directory)
+
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return {}
+    with os.fdopen(fd) as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or not _trusted(st):
+            raise PermissionError(f'{path}: may be changed by others than root')
+        conf = {}
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition('=')
+            conf[key] = ast.literal_eval(value.strip()) if '[' in value else value
+    return {key: value for key, value in conf.items() if key in CONF_DEFAULTS}
+
+
+def _proc_names(pid):
+    # what pidof matches (as sysops): the command name & the base name of argv[0]
+    with open(f'/proc/{pid}/comm', 'rb') as f:
+        comm = f.read().rstrip(b'\n').decode('utf-8', 'replace')
+    with open(f'/proc/{pid}/cmdline', 'rb') as f:
+        argv0 = os.path.basename(f.read().split(b'\0', 1)[0].decode('utf-8', 'replace'))
+    return comm, argv0
+
+
+def _in_process(argv, policy):
+    # kill, rm & cp are done here, not forked: => (returncode, stderr)
+    prog, args = argv[0], argv[1:]
+    try:
+        if prog == 'kill':
+            pid = int(args[1])
+            if not set(_proc_names(pid)) & set(policy['signal']):
+                return 1, f'kill: ({pid}) - not {" or ".join(policy["signal"])}\n'
+            os.kill(pid, int(args[0][1:]))
+        elif prog == 'rm':
+            try:
+                os.unlink(args[1])
+            except FileNotFoundError:
+                pass
+        elif prog == 'cp':
+            # only what the user toro2 runs as may read itself is copied
+            with open(args[1], 'rb') as src:
+                st = os.fstat(src.fileno())
+                readable = (st.st_uid == policy['uid'] and st.st_mode & stat.S_IRUSR) or st.st_mode & stat.S_IROTH
+                if not readable:
+                    return 1, f'cp: {args[1]}: not readable by uid {policy["uid"]}\n'
+                _replace(args[2], src.read(), st.st_mode & 0o777)
+    except (OSError, ValueError) as e:
+        return 1, f'{prog}: {e}\n'
+    return 0, ''
+
+
+def _replace(dst, data, mode):
+    # as sysops.copy: dst replaced by a complete file or left alone, an
+    # existing one keeping its owner & mode. The tmp file is created anew
+    # (O_EXCL) & never through a symlink: dst may be in a world-writable /tmp.
+    try:
+        st = os.stat(dst)
+    except FileNotFoundError:
+        st = None
+
+    tmp = f'{dst}.toro2.{os.getpid()}.{threading.get_native_id()}'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC, mode)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if st is not None:
+                os.fchmod(fd, st.st_mode & 0o7777)
+                os.fchown(fd, st.st_uid, st.st_gid)
+        finally:
+            os.close(fd)
+        os.replace(tmp, dst)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _execute(op, policy):
+    argv = [str(a) for a in op.get('argv') or []]
+    denied = check(argv, policy)
+    if denied is not None:
+        return {'denied': denied}
+
+    if argv[0] in ('kill', 'rm', 'cp'):
+        code, stderr = _in_process(argv, policy)
+        return {'returncode': code, 'stdout': '', 'stderr': stderr}
+
+    data = op.get('input')
+    try:
+        done = subprocess.run(argv, input=None if data is None else data.encode('latin-1'), capture_output=True,
+                              timeout=op.get('timeout'), stdin=subprocess.DEVNULL if data is None else None)
+    except subprocess.TimeoutExpired as e:
+        return {'timeout': True, 'stdout': (e.stdout or b'').decode('latin-1'),
+                'stderr': (e.stderr or b'').decode('latin-1')}
+    except OSError as e:
+        return {'returncode': 127, 'stdout': '', 'stderr': f'{argv[0]}: {e}\n'}
+    return {'returncode': done.returncode, 'stdout': done.stdout.decode('latin-1'),
+            'stderr': done.stderr.decode('latin-1')}
+
+
+def serve(policy, rfile, wfile):
+    # batches run each in a thread of its own, their ops in order
+    lock = threading.Lock()
+
+    def reply(msg):
+        with lock:
+            wfile.write(json.dumps(msg).encode('utf-8') + b'\n')
+            wfile.flush()
+
+    def run_batch(req):
+        rid = req.get('id')
+        try:
+            for i, op in enumerate(req.get('ops') or []):
+                result = _execute(op, policy)
+                reply({'id': rid, 'i': i, **result})
+                failed = 'denied' in result or 'timeout' in result or result['returncode'] != 0
+                if failed and req.get('check', True):
+                    break
+            reply({'id': rid, 'done': True})
+        except (OSError, ValueError):
+            # toro2 went away
+            pass
+
+    reply({'ready': True, 'pid': os.getpid()})
+    workers = []
+    for line in rfile:
+        try:
+            req = json.loads(line)
+            if not isinstance(req, dict):
+                raise ValueError(line)
+        except ValueError:
+            reply({'id': None, 'error': 'bad request'})
+            continue
+        t = threading.Thread(target=run_batch, args=(req,), name=f'batch-{req.get("id")}')
+        t.start()
+        workers = [w for w in workers if w.is_alive()] + [t]
+
+    # EOF: toro2 exited or closed us; what is running completes
+    for t in workers:
+        t.join()
+
+
+# toro2 side
+
+class Helper:
+    # Started on the first batch (runner.run of a sudo command accepts()
+    # lets through), lives as long as the toro2 process. Batches from any
+    # thread, each waiting for its own results. If it can't be started or
+    # dies, accepts() turns False and sudo is run per command again.
+
+    def __init__(self, python3, policy):
+        self.python3 = python3
+        self.policy = policy
+        self._proc = None
+        self._sock = None
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._next_id = 0
+        self._dead = False
+
+    def accepts(self, argv):
+        return not self._dead and check(argv, self.policy) is None
+
+    def _start(self):
+        import runner
+
+        parent, child = socket.socketpair()
+        try:
+            self._proc = runner.spawn(['sudo', self.python3, '-I', '-S', os.path.abspath(__file__)],
+                                      stdin=child, stdout=child)
+        except OSError as e:
+            print(f'Privileged helper not started ({e}): sudo per command', file=sys.stderr)
+            parent.close()
+            return False
+        finally:
+            child.close()
+
+        rfile = parent.makefile('rb')
+        try:
+            hello = json.loads(rfile.readline() or b'{}')
+        except ValueError:
+            hello = {}
+        if not hello.get('ready'):
+            print(f'Privileged helper not started ({hello.get("error") or "sudo failed?"}): sudo per command',
+                  file=sys.stderr)
+            rfile.close()
+            parent.close()
+            self._proc.wait()
+            return False
+
+        self._sock = parent
+        threading.Thread(target=self._read, args=(rfile,), name='privhelper', daemon=True).start()
+        return True
+
+    def _read(self, rfile):
+        for line in rfile:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            q = self._waiting.get(result.get('id'))
+            if q is not None:
+                q.put(result)
+
+        # EOF: the helper is gone, whoever waits gets an error
+        with self._lock:
+            self._dead = True
+            for q in self._waiting.values():
+                q.put(None)
+
+    def submit(self, ops, check=True):
+        # ops [{argv (no sudo), input (latin-1 str or None), timeout}] => an
+        # iterator over their results as they come, None when there's no helper
+        with self._lock:
+            if self._sock is None and not self._dead:
+                self._dead = not self._start()
+            if self._dead:
+                return None
+
+            self._next_id += 1
+            rid = self._next_id
+            q = self._waiting[rid] = queue.Queue()
+            try:
+                self._sock.sendall(json.dumps({'id': rid, 'check': check, 'ops': ops}).encode('utf-8') + b'\n')
+            except OSError:
+                self._dead = True
+                del self._waiting[rid]
+                return None
+
+        return self._results(rid, q)
+
+    def _results(self, rid, q):
+        try:
+            while True:
+                result = q.get()
+                if result is None:
+                    raise ConnectionError('privileged helper exited')
+                if result.get('done'):
+                    return
+                yield result
+        finally:
+            with self._lock:
+                self._waiting.pop(rid, None)
+
+    def close(self):
+        # no more batches: the helper completes what it has & exits
+        with self._lock:
+            sock, self._sock, self._dead = self._sock, None, True
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_WR)
+            self._proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        finally:
+            sock.close()
+
+
+def main():
+    # the policy from the toro2.conf beside this script & the user sudo ran
+    # us for: nothing from argv
+    conf_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toro2.conf')
+    try:
+        allowed = policy(read_conf(conf_path), uid=int(os.environ.get('SUDO_UID', os.getuid())))
+    except (OSError, ValueError, SyntaxError) as e:
+        sys.stdout.buffer.write(json.dumps({'ready': False, 'error': str(e)}).encode('utf-8') + b'\n')
+        sys.stdout.buffer.flush()
+        sys.exit(1)
+    serve(allowed, sys.stdin.buffer, sys.stdout.buffer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+import collections
+import contextlib
+import errno
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+# Every external command toro2 runs goes through run() or spawn(): one place
+# deciding how long a program may take (TIMEOUTS, command_timeouts in
+# toro2.conf) and recording what ran, when, for how long and how it ended.
+# The last KEEP_CALLS calls are kept in memory. With trace() on (toro2
+# --trace out.json <verb>) every call, orchestrator step and tor bootstrap
+# phase of the run is kept and written at exit as a Chrome trace (Trace Event
+# Format: chrome://tracing, ui.perfetto.dev).
+#
+# With a privileged helper set (set_helper, privhelper.Helper) the sudo
+# commands it accepts are sent to it instead, run_all() ones as one batch:
+# one sudo for the whole process. They're recorded the same way.
+
+DEFAULT_TIMEOUT = 3
+
+# program (base name, sudo skipped) => seconds it may take
+TIMEOUTS = {
+    'systemctl': 5,
+}
+
+KEEP_CALLS = 256
+
+# ts 0 of the trace: toro2 imports this module at startup
+_t0 = time.monotonic()
+
+calls = collections.deque(maxlen=KEEP_CALLS)
+_lock = threading.Lock()
+_trace = None
+_helper = None
+
+
+class Call:
+    # one external command; sizes are None for output not captured (inherited, a file, DEVNULL)
+
+    __slots__ = ('argv', 'timeout', 'started', 'finished', 'returncode', 'pid', 'stdout_bytes',
+                 'stderr_bytes', 'error', 'tid')
+
+    def __init__(self, argv, timeout):
+        self.argv = [str(a) for a in argv]
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.finished = None
+        self.returncode = None
+        self.pid = None
+        self.stdout_bytes = None
+        self.stderr_bytes = None
+        self.error = None
+        self.tid = threading.get_native_id()
+
+    @property
+    def duration(self):
+        if self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def finish(self, returncode=None, stdout=None, stderr=None, error=None):
+        self.finished = time.monotonic()
+        self.returncode = returncode
+        if isinstance(stdout, bytes):
+            self.stdout_bytes = len(stdout)
+        if isinstance(stderr, bytes):
+            self.stderr_bytes = len(stderr)
+        self.error = error
+
+        with _lock:
+            calls.append(self)
+            if _trace is not None:
+                _record(self._event())
+
+    def _event(self):
+        args = {'argv': self.argv, 'returncode': self.returncode, 'timeout': self.timeout,
+                'stdout_bytes': self.stdout_bytes, 'stderr_bytes': self.stderr_bytes}
+        if self.pid is not None:
+            args['pid'] = self.pid
+        if self.error is not None:
+            args['error'] = self.error
+        return _complete(self.name, 'command', self.started, self.finished, self.tid, args)
+
+    @property
+    def name(self):
+        # sudo iptables-restore --noflush: binaries by base name, the first arguments
+        i = 2 if len(self.argv) > 1 and os.path.basename(self.argv[0]) == 'sudo' else 1
+        return ' '.join([*map(os.path.basename, self.argv[:i]), *self.argv[i:i + 3]])
+
+
+def program(argv):
+    # what TIMEOUTS is keyed on: the base name of the binary, under sudo too
+    i = 1 if len(argv) > 1 and os.path.basename(str(argv[0])) == 'sudo' else 0
+    return os.path.basename(str(argv[i]))
+
+
+def timeout_for(argv):
+    return TIMEOUTS.get(program(argv), DEFAULT_TIMEOUT)
+
+
+def set_timeouts(per_program=None, default=None):
+    # command_timeouts from toro2.conf: [("systemctl", 10), ...] or a dict
+    global DEFAULT_TIMEOUT
+    if default is not None:
+        DEFAULT_TIMEOUT = float(default)
+    for prog, seconds in dict(per_program or {}).items():
+        TIMEOUTS[prog] = float(seconds)
+
+
+def set_helper(helper):
+    # privhelper.Helper (None: sudo per command); closed at exit
+    import atexit
+
+    global _helper
+    _helper = helper
+    if helper is not None:
+        atexit.register(helper.close)
+
+
+def helped(argv):
+    # the helper, if argv is a sudo command it runs
+    helper = _helper
+    if helper is not None and len(argv) > 1 and str(argv[0]) == 'sudo' and \
+            helper.accepts([str(a) for a in argv[1:]]):
+        return helper
+    return None
+
+
+def _deliver(data, target, stream):
+    # a helper's output where subprocess.run would have put it => what CompletedProcess gets
+    if target == subprocess.PIPE:
+        return data
+    if target is None and data:
+        stream.write(data.decode('utf-8', 'replace'))
+        stream.flush()
+    return None
+
+
+def _run_helped(helper, commands, capture, check, timeout, kwargs):
+    # => [CompletedProcess] of the commands run, None when the helper isn't there
+    timeouts = [timeout_for(argv) if timeout is None else timeout for argv, _ in commands]
+    ops = [{'argv': [str(a) for a in argv[1:]], 'input': None if data is None else data.decode('latin-1'),
+            'timeout': t} for (argv, data), t in zip(commands, timeouts)]
+    results = helper.submit(ops, check=check)
+    if results is None:
+        return None
+
+    completed = []
+    started = time.monotonic()
+    for r in results:
+        argv, t = commands[r['i']][0], timeouts[r['i']]
+        call = Call(argv, t)
+        call.started = started
+        stdout, stderr = (r.get(k, '').encode('latin-1') for k in ('stdout', 'stderr'))
+        if 'denied' in r:
+            call.finish(error=f'denied: {r["denied"]}')
+            raise PermissionError(errno.EPERM, f'privileged helper refused {r["denied"]}')
+        if r.get('timeout'):
+            call.finish(stdout=stdout, stderr=stderr, error=f'timed out after {t}s')
+            raise subprocess.TimeoutExpired(argv, t, stdout, stderr)
+
+        call.finish(r['returncode'], stdout, stderr)
+        started = call.finished
+        out = _deliver(stdout, subprocess.PIPE if capture else kwargs.get('stdout'), sys.stdout)
+        err = _deliver(stderr, subprocess.PIPE if capture else kwargs.get('stderr'), sys.stderr)
+        completed.append(subprocess.CompletedProcess(argv, r['returncode'], out, err))
+        if check:
+            completed[-1].check_returncode()
+    return completed
+
+
+def run(argv, input=None, capture=False, check=True, timeout=None, **kwargs):
+    # subprocess.run, timeout from the policy unless given. capture: stdout &
+    # stderr come back as bytes (& are measured); else stdout/stderr kwargs apply.
+    # Raises what subprocess.run raises (CalledProcessError with check).
+    helper = helped(argv)
+    if helper is not None:
+        completed = _run_helped(helper, [(argv, input)], capture, check, timeout, kwargs)
+        if completed is not None:
+            return completed[0]
+
+    if timeout is None:
+        timeout = timeout_for(argv)
+
+    call = Call(argv, timeout)
+    try:
+        completed = subprocess.run(argv, input=input, capture_output=capture, timeout=timeout, shell=False,
+                                   **kwargs)
+    except subprocess.TimeoutExpired as e:
+        call.finish(stdout=e.stdout, stderr=e.stderr, error=f'timed out after {timeout}s')
+        raise
+    except BaseException as e:
+        call.finish(error=f'{type(e).__name__}: {e}')
+        raise
+
+    call.finish(completed.returncode, completed.stdout, completed.stderr)
+    if check:
+        completed.check_returncode()
+    return completed
+
+
+def run_all(commands, capture=False, check=True, timeout=None, **kwargs):
+    # [(argv, input)] one after the other => [CompletedProcess]; with check
+    # the first failing raises & the rest don't run. Sudo commands all go to
+    # the helper as one batch when it accepts every one of them.
+    if commands and all(helped(argv) for argv, _ in commands):
+        completed = _run_helped(_helper, commands, capture, check, timeout, kwargs)
+        if completed is not None:
+            return completed
+    return [run(argv, input=data, capture=capture, check=check, timeout=timeout, **kwargs)
+            for argv, data in commands]
+
+
+def spawn(argv, **kwargs):
+    # subprocess.Popen for what keeps running (tor): the call recorded is the
+    # spawn itself, the process is the caller's to watch
+    call = Call(argv, None)
+    try:
+        proc = subprocess.Popen(argv, shell=False, **kwargs)
+    except BaseException as e:
+        call.finish(error=f'{type(e).__name__}: {e}')
+        raise
+
+    call.pid = proc.pid
+    call.finish()
+    return proc
+
+
+def _complete(name, cat, started, finished, tid, args=None):
+    # Trace Event Format "complete" event, times in µs from _t0
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': round((started - _t0) * 1e6),
+             'dur': round((finished - started) * 1e6), 'pid': os.getpid(), 'tid': tid}
+    if args:
+        event['args'] = args
+    return event
+
+
+def _record(event):
+    # under _lock, from the thread the event happened in (worker threads are gone by exit)
+    _trace['events'].append(event)
+    _trace['threads'].setdefault(event['tid'], threading.current_thread().name)
+
+
+def add_span(name, started, finished, cat='step', args=None):
+    # something timed elsewhere (time.monotonic()), on the trace only
+    if _trace is None:
+        return
+    event = _complete(name, cat, started, finished, threading.get_native_id(), args)
+    with _lock:
+        if _trace is not None:
+            _record(event)
+
+
+@contextlib.contextmanager
+def span(name, cat='step', args=None):
+    if _trace is None:
+        yield
+        return
+
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        add_span(name, started, time.monotonic(), cat, args)
+
+
+def trace(path, name='toro2'):
+    # keep every event from now on, write them to path when toro2 exits
+    import atexit
+
+    global _trace
+    _trace = {'path': path, 'name': name, 'events': [], 'threads': {}}
+    atexit.register(write_trace)
+
+
+def write_trace():
+    global _trace
+    import json
+
+    if _trace is None:
+        return
+    with _lock:
+        events = list(_trace['events'])
+        path, name, names = _trace['path'], _trace['name'], _trace['threads']
+        _trace = None
+
+    pid = os.getpid()
+    main_tid = threading.main_thread().native_id
+    names[main_tid] = 'main'
+    tids = {e['tid'] for e in events} | {main_tid}
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': name}}]
+    meta += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+              'args': {'name': names.get(tid, str(tid))}} for tid in sorted(tids)]
+
+    # the whole run, from startup to now
+    events.insert(0, _complete(name, 'run', _t0, time.monotonic(), main_tid))
+
+    try:
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': meta + events, 'displayTimeUnit': 'ms'}, f)
+        commands = sum(1 for e in events if e['cat'] == 'command')
+        print(f'Trace of {name} ({commands} commands, {len(events)} events) written to {path}', file=sys.stderr)
+    except OSError as e:
+        print(f'Unable to write trace to {path}: {e}', file=sys.stderr)
@@ -0,0 +1,104 @@
+import subprocess
+import threading
+
+import runner
+
+
+SHOW_PROPERTIES = ['ActiveState', 'SubState', 'MainPID']
+
+
+def unit_name(srv):
+    return srv if '.' in srv else f'{srv}.service'
+
+
+class ServiceManager:
+    # One systemctl call per action for any number of units, one
+    # 'systemctl show' for the states of all of them. States are cached
+    # for the lifetime of the object (i.e. one toro2 command) and dropped
+    # for the units an action was run on.
+
+    def __init__(self, systemctl, sudo=True, timeout=None):
+        # timeout None: runner's policy for systemctl
+        self.systemctl = systemctl
+        self.sudo = sudo
+        self.timeout = timeout
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def act(self, action, srvs, sudo=None):
+        srvs = list(srvs)
+        if not srvs:
+            return True
+
+        command = [f'{self.systemctl}', f'{action}', *[unit_name(s) for s in srvs]]
+        if self.sudo if sudo is None else sudo:
+            command = ['sudo'] + command
+
+        try:
+            runner.run(command, timeout=self.timeout, stdout=subprocess.DEVNULL)
+        finally:
+            self.invalidate(srvs)
+
+        return True
+
+    def daemon_reload(self, sudo=None):
+        # unit files were added or changed
+        command = [f'{self.systemctl}', 'daemon-reload']
+        if self.sudo if sudo is None else sudo:
+            command = ['sudo'] + command
+        runner.run(command, timeout=self.timeout, stdout=subprocess.DEVNULL)
+        return True
+
+    def invalidate(self, srvs=None):
+        with self._lock:
+            if srvs is None:
+                self._states.clear()
+            else:
+                for s in srvs:
+                    self._states.pop(s, None)
+
+    def states(self, srvs):
+        srvs = list(srvs)
+        with self._lock:
+            missing = [s for s in srvs if s not in self._states]
+
+        if missing:
+            # reading states needs no root
+            command = [f'{self.systemctl}', 'show', '-p', ','.join(SHOW_PROPERTIES),
+                       *[unit_name(s) for s in missing]]
+            out = runner.run(command, capture=True, check=False, timeout=self.timeout)
+            parsed = parse_show(out.stdout.decode('utf-8'))
+
+            with self._lock:
+                # 'systemctl show' prints one block per unit, in the order asked
+                for srv, props in zip(missing, parsed):
+                    self._states[srv] = props
+
+        with self._lock:
+            return {s: self._states.get(s, {}) for s in srvs}
+
+    def is_active(self, srv):
+        return self.states([srv])[srv].get('ActiveState') == 'active'
+
+
+def parse_show(text):
+    blocks = []
+    current = {}
+    for line in text.splitlines():
+        if not line.strip():
+            if current:
+                blocks.append(current)
+                current = {}
+            continue
+        key, _, value = line.partition('=')
+        if key == 'MainPID':
+            try:
+                value = int(value)
+            except ValueError:
+                value = 0
+        current[key] = value
+
+    if current:
+        blocks.append(current)
+
+    return blocks
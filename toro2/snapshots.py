@@ -0,0 +1,316 @@
+import gzip
+import hashlib
+import json
+import os
+import stat
+import time
+
+
+# Content-addressed store for backups of system files:
+#   objects/ab/abcdef...[.gz|.zst]   file contents, keyed by sha256, stored once
+#   backup.N.json                    manifest: path => hash, size, mode, owner, mtime
+#   backup.N/                        (compress=none) the files, hardlinks to their objects
+# backup.0 is the newest. Rotating renames manifests (& trees), an unchanged
+# file costs neither a copy nor a read (its stat matches the last manifest),
+# objects nobody refers to any more are dropped.
+
+CODECS = ('none', 'gzip', 'zstd')
+_SUFFIX = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstd():
+    # => (compress, decompress) or None: compression.zstd (3.14+), else the zstandard package
+    try:
+        from compression import zstd
+        return zstd.compress, zstd.decompress
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _walk(paths):
+    # files, dirs & symlinks under paths, dirs first
+    for top in paths:
+        if os.path.isdir(top) and not os.path.islink(top):
+            for root, dirs, files in os.walk(top):
+                yield root
+                for name in sorted(dirs):
+                    if os.path.islink(os.path.join(root, name)):
+                        yield os.path.join(root, name)
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        elif os.path.lexists(top):
+            yield top
+
+
+class SnapshotStore:
+    def __init__(self, root, keep=2, compress='none'):
+        if compress not in CODECS:
+            raise ValueError(f'unknown compression {compress!r} (one of {", ".join(CODECS)})')
+        if compress == 'zstd' and _zstd() is None:
+            # no zstd on this system: next best
+            compress = 'gzip'
+        self.root = root
+        self.keep = max(1, int(keep))
+        self.compress = compress
+
+    def _manifest_path(self, n):
+        return os.path.join(self.root, f'backup.{n}.json')
+
+    def _tree_path(self, n):
+        return os.path.join(self.root, f'backup.{n}')
+
+    def _object_path(self, digest, codec):
+        return os.path.join(self.root, 'objects', digest[:2], digest + _SUFFIX[codec])
+
+    def snapshots(self):
+        # => [(n, manifest)], newest first
+        out = []
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return out
+        for name in names:
+            parts = name.split('.')
+            if len(parts) == 3 and parts[0] == 'backup' and parts[1].isdigit() and parts[2] == 'json':
+                out.append((int(parts[1]), self.manifest(int(parts[1]))))
+        return sorted(out, key=lambda s: s[0])
+
+    def manifest(self, n):
+        with open(self._manifest_path(n)) as f:
+            return json.load(f)
+
+    def _find_object(self, digest):
+        # => (path, codec) of the object, stored with whatever codec it was
+        for codec in CODECS:
+            path = self._object_path(digest, codec)
+            if os.path.exists(path):
+                return path, codec
+        return None, None
+
+    def _put(self, digest, data):
+        # => bytes written (0: already stored)
+        if self._find_object(digest)[0] is not None:
+            return 0
+
+        if self.compress == 'gzip':
+            data = gzip.compress(data, mtime=0)
+        elif self.compress == 'zstd':
+            data = _zstd()[0](data)
+
+        path = self._object_path(digest, self.compress)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        # read-only: a tree hardlink must not be a way to change the backup
+        os.chmod(tmp, 0o400)
+        os.replace(tmp, path)
+        return len(data)
+
+    def read(self, entry):
+        path, codec = self._find_object(entry['hash'])
+        if path is None:
+            raise FileNotFoundError(f'object {entry["hash"]} missing from {self.root}')
+        with open(path, 'rb') as f:
+            data = f.read()
+        if codec == 'gzip':
+            return gzip.decompress(data)
+        if codec == 'zstd':
+            zstd = _zstd()
+            if zstd is None:
+                raise RuntimeError('object is zstd compressed, no zstd available')
+            return zstd[1](data)
+        return data
+
+    def scan(self, paths, previous=None):
+        # current state of paths as manifest entries; a file whose stat
+        # matches previous (same inode, size & mtime) takes its hash from
+        # there instead of being read
+        previous = previous or {}
+        files = {}
+        for path in _walk(paths):
+            st = os.lstat(path)
+            entry = {'mode': stat.S_IMODE(st.st_mode), 'uid': st.st_uid, 'gid': st.st_gid,
+                     'mtime_ns': st.st_mtime_ns}
+            if stat.S_ISLNK(st.st_mode):
+                entry.update(type='symlink', target=os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry.update(type='dir')
+            elif stat.S_ISREG(st.st_mode):
+                entry.update(type='file', size=st.st_size, ino=st.st_ino)
+                prev = previous.get(path)
+                if prev and prev.get('type') == 'file' and \
+                        [prev.get('ino'), prev.get('size'), prev.get('mtime_ns')] == \
+                        [st.st_ino, st.st_size, st.st_mtime_ns]:
+                    entry['hash'] = prev['hash']
+                else:
+                    entry['hash'] = _file_hash(path)
+            else:
+                # sockets, fifos, devices: nothing to back up
+                continue
+            files[path] = entry
+        return files
+
+    def _rotate(self):
+        # backup.N => backup.N+1, the oldest ones beyond keep go
+        for n, _ in reversed(self.snapshots()):
+            if n + 1 >= self.keep:
+                os.unlink(self._manifest_path(n))
+                self._drop_tree(n)
+                continue
+            os.rename(self._manifest_path(n), self._manifest_path(n + 1))
+            if os.path.isdir(self._tree_path(n)):
+                os.rename(self._tree_path(n), self._tree_path(n + 1))
+
+    def _drop_tree(self, n):
+        tree = self._tree_path(n)
+        if not os.path.isdir(tree):
+            return
+        for root, dirs, files in os.walk(tree, topdown=False):
+            for name in files:
+                os.unlink(os.path.join(root, name))
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+        os.rmdir(tree)
+
+    def _link_tree(self, n, files):
+        # browsable copy of the snapshot at no cost: hardlinks to the objects
+        tree = self._tree_path(n)
+        for path, entry in files.items():
+            if entry['type'] != 'file':
+                continue
+            obj, codec = self._find_object(entry['hash'])
+            if codec != 'none':
+                continue
+            dst = os.path.join(tree, path.lstrip('/'))
+            os.makedirs(os.path.dirname(dst), mode=0o700, exist_ok=True)
+            try:
+                os.link(obj, dst)
+            except OSError:
+                # e.g. too many links to one object: the tree is only a convenience
+                pass
+
+    def gc(self):
+        # => bytes freed by dropping objects no manifest refers to
+        used = {e['hash'] for _, m in self.snapshots() for e in m['files'].values() if 'hash' in e}
+        freed = 0
+        objects = os.path.join(self.root, 'objects')
+        for root, _, names in os.walk(objects):
+            for name in names:
+                if name.split('.')[0] not in used:
+                    path = os.path.join(root, name)
+                    freed += os.path.getsize(path)
+                    os.unlink(path)
+        return freed
+
+    def create(self, paths, extra=None):
+        # snapshot of paths (+ extra {name: bytes}, e.g. command output)
+        # as backup.0 => {'files', 'new', 'stored', 'freed'}
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        snaps = self.snapshots()
+        previous = snaps[0][1]['files'] if snaps else {}
+
+        files = self.scan(paths, previous)
+        new = stored = 0
+        for path, entry in files.items():
+            if entry['type'] == 'file' and self._find_object(entry['hash'])[0] is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # changed between scan & read: store what was read
+                entry['hash'] = hashlib.sha256(data).hexdigest()
+                entry['size'] = len(data)
+                written = self._put(entry['hash'], data)
+                new += 1 if written else 0
+                stored += written
+
+        for name, data in (extra or {}).items():
+            digest = hashlib.sha256(data).hexdigest()
+            written = self._put(digest, data)
+            new += 1 if written else 0
+            stored += written
+            files[name] = {'type': 'file', 'hash': digest, 'size': len(data), 'mode': 0o600}
+
+        self._rotate()
+        manifest = {'created': time.time(), 'compress': self.compress, 'files': files}
+        tmp = f'{self._manifest_path(0)}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._manifest_path(0))
+
+        if self.compress == 'none':
+            self._link_tree(0, files)
+
+        return {'files': len(files), 'new': new, 'stored': stored, 'freed': self.gc()}
+
+    def diff(self, n, m=None, paths=None):
+        # snapshot n against snapshot m, or against what is on disk now
+        # => [(path, 'added' | 'removed' | 'changed', old entry, new entry)]
+        old = self.manifest(n)['files']
+        if m is None:
+            new = self.scan(paths or [p for p in old if p.startswith('/')], old)
+            # command output (iptables.bak, ...) has no current state to compare with
+            old = {p: e for p, e in old.items() if p.startswith('/')}
+        else:
+            new = self.manifest(m)['files']
+
+        out = []
+        for path in sorted(set(old) | set(new)):
+            a, b = old.get(path), new.get(path)
+            if a is None:
+                out.append((path, 'added', a, b))
+            elif b is None:
+                out.append((path, 'removed', a, b))
+            elif (a.get('type'), a.get('hash'), a.get('target'), a.get('mode')) != \
+                    (b.get('type'), b.get('hash'), b.get('target'), b.get('mode')):
+                out.append((path, 'changed', a, b))
+        return out
+
+    def restore(self, n, paths=None, outdir='.'):
+        # files of snapshot n put back in place, atomically each, with their
+        # mode & owner; entries without an absolute path (command output)
+        # are written to outdir. => [(path, where it went)]
+        files = self.manifest(n)['files']
+        chosen = [p for p in files if not paths or any(p == q or p.startswith(q.rstrip('/') + '/') for q in paths)]
+        done = []
+
+        for path in sorted(chosen):
+            entry = files[path]
+            dst = path if path.startswith('/') else os.path.join(outdir, path)
+
+            if entry['type'] == 'dir':
+                os.makedirs(dst, exist_ok=True)
+                os.chmod(dst, entry['mode'])
+                continue
+
+            os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+            tmp = f'{dst}.toro2.{os.getpid()}'
+            if entry['type'] == 'symlink':
+                os.symlink(entry['target'], tmp)
+            else:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.read(entry))
+                os.chmod(tmp, entry['mode'])
+            if 'uid' in entry and os.getuid() == 0:
+                os.lchown(tmp, entry['uid'], entry['gid'])
+            os.replace(tmp, dst)
+            done.append((path, dst))
+
+        return done
@@ -0,0 +1,195 @@
+import errno
+import fcntl
+import os
+import signal
+import struct
+import threading
+
+import runner
+
+
+# What toro2 used to fork lsattr/chattr, pidof/killall, kill, cp & rm for,
+# done in-process. What needs rights we lack (chattr on /etc/resolv.conf,
+# signalling tor run as another user, writing to /etc) is retried through
+# sudo with the same binary as before, so failures are reported the same
+# way: CalledProcessError, or OSError when the sudo fallback doesn't apply.
+
+# linux/fs.h (the kernel reads & writes an int whatever the size in the number)
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_IMMUTABLE_FL = 0x00000010
+
+_flags = struct.Struct('i')
+
+# errors an unprivileged try fails with & sudo may get past
+_PRIVILEGE_ERRNOS = (errno.EPERM, errno.EACCES, errno.EROFS)
+
+
+def _sudo(command, timeout=None):
+    runner.run(['sudo', *command], timeout=timeout)
+
+
+def get_flags(path):
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        return _flags.unpack(fcntl.ioctl(fd, FS_IOC_GETFLAGS, _flags.pack(0)))[0]
+    finally:
+        os.close(fd)
+
+
+def is_immutable(path):
+    return bool(get_flags(path) & FS_IMMUTABLE_FL)
+
+
+def set_immutable(path, immutable=True, chattr='chattr'):
+    # chattr +i/-i; needs CAP_LINUX_IMMUTABLE, sudo chattr otherwise
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            flags = _flags.unpack(fcntl.ioctl(fd, FS_IOC_GETFLAGS, _flags.pack(0)))[0]
+            wanted = flags | FS_IMMUTABLE_FL if immutable else flags & ~FS_IMMUTABLE_FL
+            if wanted != flags:
+                fcntl.ioctl(fd, FS_IOC_SETFLAGS, _flags.pack(wanted))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        if e.errno not in _PRIVILEGE_ERRNOS:
+            raise
+        _sudo([chattr, '+i' if immutable else '-i', path])
+
+
+# pid => process name, read from /proc once and kept until invalidate():
+# a command looking processes up several times scans /proc once
+_procs = None
+_procs_lock = threading.Lock()
+
+
+def _proc_name(pid):
+    # what pidof matches: the command name or the base name of argv[0]
+    try:
+        with open(f'/proc/{pid}/comm', 'rb') as f:
+            comm = f.read().rstrip(b'\n').decode('utf-8', 'replace')
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            argv0 = os.path.basename(f.read().split(b'\0', 1)[0].decode('utf-8', 'replace'))
+    except OSError:
+        # exited meanwhile
+        return None
+    return comm, argv0
+
+
+def _scan():
+    global _procs
+    with _procs_lock:
+        if _procs is None:
+            procs = {}
+            for entry in os.listdir('/proc'):
+                if entry.isdigit():
+                    name = _proc_name(entry)
+                    if name is not None:
+                        procs[int(entry)] = name
+            _procs = procs
+        return _procs
+
+
+def invalidate():
+    # processes may have come & gone: rescan on next lookup
+    global _procs
+    with _procs_lock:
+        _procs = None
+
+
+def pidof(name):
+    # => pids of the processes called `name`, newest first (as pidof)
+    return sorted((pid for pid, names in _scan().items() if name in names), reverse=True)
+
+
+def kill(pid, sig=signal.SIGTERM):
+    # sudo kill when the process isn't ours
+    try:
+        os.kill(pid, sig)
+    except PermissionError:
+        _sudo(['kill', f'-{int(sig)}', str(pid)])
+    finally:
+        invalidate()
+
+
+def killall(name, sig=signal.SIGTERM):
+    # never signal from a stale table
+    invalidate()
+    pids = pidof(name)
+    if not pids:
+        raise ProcessLookupError(errno.ESRCH, f'{name}: no process found')
+    for pid in pids:
+        try:
+            kill(pid, sig)
+        except ProcessLookupError:
+            # gone already
+            pass
+    return pids
+
+
+def remove(path):
+    # rm -f
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        if e.errno not in _PRIVILEGE_ERRNOS:
+            raise
+        _sudo(['rm', '-f', path])
+
+
+def _copy_data(src_fd, dst_fd):
+    # in the kernel (copy_file_range), plain read/write where the
+    # filesystems or kernel don't support it
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(src_fd, dst_fd, 1 << 30):
+                pass
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+
+    while True:
+        chunk = os.read(src_fd, 1 << 20)
+        if not chunk:
+            return
+        os.write(dst_fd, chunk)
+
+
+def copy(src, dst):
+    # cp -f, but atomic: dst is replaced by a complete copy or left alone.
+    # An existing dst keeps its owner & mode.
+    try:
+        st = os.stat(dst)
+    except FileNotFoundError:
+        st = None
+
+    tmp = f'{dst}.toro2.{os.getpid()}'
+    try:
+        with open(src, 'rb') as fsrc:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
+                         os.fstat(fsrc.fileno()).st_mode & 0o7777)
+            try:
+                _copy_data(fsrc.fileno(), fd)
+                if st is not None:
+                    os.fchmod(fd, st.st_mode & 0o7777)
+                    if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                        os.fchown(fd, st.st_uid, st.st_gid)
+            finally:
+                os.close(fd)
+        os.replace(tmp, dst)
+
+    except OSError as e:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        if e.errno not in _PRIVILEGE_ERRNOS:
+            raise
+        _sudo(['cp', '-f', src, dst])
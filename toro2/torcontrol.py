@@ -0,0 +1,355 @@
+import binascii
+import hashlib
+import hmac
+import os
+import re
+import select
+import socket
+import time
+
+
+# tor refuses to act on NEWNYM more often than this
+NEWNYM_RATE_LIMIT = 10
+
+SAFECOOKIE_SERVER_KEY = b'Tor safe cookie authentication server-to-controller hash'
+SAFECOOKIE_CLIENT_KEY = b'Tor safe cookie authentication controller-to-server hash'
+
+
+class TorControlError(Exception):
+    pass
+
+
+def _quote(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def parse_kv(line):
+    # KEY=VALUE KEY="quoted value" ... => dict
+    return {m.group(1): m.group(2) if m.group(2) is not None else m.group(3)
+            for m in re.finditer(r'([A-Za-z_/\-]+)=(?:"((?:[^"\\]|\\.)*)"|(\S*))', line)}
+
+
+class TorController:
+    # Minimal tor control-protocol client (control-spec.txt): replies are
+    # read synchronously, asynchronous 650 events met on the way are queued
+    # for read_event()
+
+    def __init__(self, host='127.0.0.1', port=9051, password=None, cookie_file=None, timeout=10):
+        self.host = host
+        self.port = int(port)
+        self.password = password or None
+        self.cookie_file = cookie_file or None
+        self.timeout = timeout
+        self._sock = None
+        self._buf = b''
+        self._events = []
+
+    def __enter__(self):
+        self.connect()
+        self.authenticate()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._buf = b''
+
+    def close(self):
+        try:
+            if self._sock is not None:
+                self._sock.sendall(b'QUIT\r\n')
+        except OSError:
+            pass
+        finally:
+            if self._sock is not None:
+                self._sock.close()
+            self._sock = None
+
+    def _readline(self):
+        while b'\n' not in self._buf:
+            chunk = self._sock.recv(4096)
+            if not chunk:
+                raise TorControlError('control connection closed')
+            self._buf += chunk
+
+        line, self._buf = self._buf.split(b'\n', 1)
+        return line.decode('utf-8', 'replace').rstrip('\r')
+
+    def _read_message(self):
+        # one reply or one event => (status, [lines]); "250+key=" data blocks
+        # are folded into their line
+        lines = []
+        while True:
+            line = self._readline()
+            status, sep, rest = line[:3], line[3:4], line[4:]
+            if sep == '+':
+                rest = rest + '\n' + '\n'.join(self._read_data())
+            lines.append(rest)
+            if sep == ' ':
+                return status, lines
+
+    def _read_reply(self):
+        while True:
+            status, lines = self._read_message()
+            if status != '650':
+                return status, lines
+            self._events.append(' '.join(lines))
+
+    def _read_data(self):
+        data = []
+        while True:
+            line = self._readline()
+            if line == '.':
+                return data
+            data.append(line[1:] if line.startswith('..') else line)
+
+    def command(self, line):
+        self._sock.sendall(line.encode('utf-8') + b'\r\n')
+        status, lines = self._read_reply()
+        if not status.startswith('2'):
+            raise TorControlError(f'{line.split()[0]}: {status} {" ".join(lines)}')
+        return lines
+
+    def authenticate(self):
+        info = ' '.join(self.command('PROTOCOLINFO 1'))
+        methods = parse_kv(info).get('METHODS', '').split(',')
+        cookie_file = self.cookie_file or parse_kv(info).get('COOKIEFILE')
+
+        if 'NULL' in methods:
+            self.command('AUTHENTICATE')
+        elif 'HASHEDPASSWORD' in methods and self.password:
+            self.command(f'AUTHENTICATE {_quote(self.password)}')
+        elif 'SAFECOOKIE' in methods and cookie_file:
+            self._auth_safecookie(cookie_file)
+        elif 'COOKIE' in methods and cookie_file:
+            with open(cookie_file, 'rb') as f:
+                self.command(f'AUTHENTICATE {binascii.hexlify(f.read()).decode()}')
+        else:
+            raise TorControlError(f'no usable authentication method (tor offers {",".join(methods)})')
+
+    def _auth_safecookie(self, cookie_file):
+        with open(cookie_file, 'rb') as f:
+            cookie = f.read()
+
+        client_nonce = os.urandom(32)
+        reply = parse_kv(' '.join(self.command(f'AUTHCHALLENGE SAFECOOKIE {client_nonce.hex()}')))
+        server_nonce = binascii.unhexlify(reply['SERVERNONCE'])
+
+        expected = hmac.new(SAFECOOKIE_SERVER_KEY, cookie + client_nonce + server_nonce, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, binascii.unhexlify(reply['SERVERHASH'])):
+            raise TorControlError('SAFECOOKIE: tor server hash mismatch')
+
+        client_hash = hmac.new(SAFECOOKIE_CLIENT_KEY, cookie + client_nonce + server_nonce, hashlib.sha256)
+        self.command(f'AUTHENTICATE {client_hash.hexdigest()}')
+
+    def getinfo(self, *keys):
+        info = {}
+        for line in self.command(f'GETINFO {" ".join(keys)}'):
+            key, sep, value = line.partition('=')
+            if sep:
+                info[key] = value.lstrip('\n')
+        return info
+
+    def signal(self, name):
+        self.command(f'SIGNAL {name}')
+
+    def setevents(self, *events):
+        self.command(' '.join(['SETEVENTS', *events]))
+
+    def setconf(self, options):
+        # {option: value or list of values}
+        args = []
+        for key, value in options.items():
+            for v in value if isinstance(value, (list, tuple)) else [value]:
+                args.append(f'{key}={_quote(str(v))}')
+        self.command(' '.join(['SETCONF', *args]))
+
+    def resetconf(self, *keys):
+        self.command(' '.join(['RESETCONF', *keys]))
+
+    def attach_stream(self, stream_id, circ_id=0):
+        # circ_id 0 => tor picks the circuit itself
+        self.command(f'ATTACHSTREAM {stream_id} {circ_id}')
+
+    def close_circuit(self, circ_id):
+        self.command(f'CLOSECIRCUIT {circ_id}')
+
+    def read_event(self, timeout=None):
+        # next queued/incoming 650 event or None on timeout
+        if self._events:
+            return self._events.pop(0)
+
+        if b'\n' not in self._buf:
+            readable, _, _ = select.select([self._sock], [], [], timeout)
+            if not readable:
+                return None
+
+        status, lines = self._read_message()
+        if status == '650':
+            return ' '.join(lines)
+        return None
+
+    def extend_circuit(self, path=None, purpose=None):
+        line = 'EXTENDCIRCUIT 0'
+        if path:
+            line += ' ' + ','.join(path)
+        if purpose:
+            line += f' purpose={purpose}'
+        reply = self.command(line)
+        # 250 EXTENDED <circid>
+        return reply[0].split()[1]
+
+    def wait_circuit_built(self, circ_id=None, timeout=60):
+        # CIRC events must be enabled; => (circ_id, event line)
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TorControlError(f'no circuit built within {timeout}s')
+
+            event = self.read_event(timeout=left)
+            if event is None:
+                continue
+
+            parts = event.split()
+            if len(parts) >= 3 and parts[0] == 'CIRC' and parts[2] == 'BUILT':
+                if circ_id is None or parts[1] == circ_id:
+                    return parts[1], event
+            elif len(parts) >= 3 and parts[0] == 'CIRC' and parts[2] == 'FAILED' and parts[1] == circ_id:
+                raise TorControlError(f'circuit {circ_id} failed: {event}')
+
+    def newnym(self, wait=False, stamp_file=None, timeout=60):
+        # SIGNAL NEWNYM honouring tor's rate limit; with wait=True block until
+        # a fresh circuit is built. => seconds it took
+        t0 = time.monotonic()
+
+        if stamp_file and os.path.exists(stamp_file):
+            since = time.time() - os.path.getmtime(stamp_file)
+            if since < NEWNYM_RATE_LIMIT:
+                time.sleep(NEWNYM_RATE_LIMIT - since)
+
+        if wait:
+            self.setevents('CIRC')
+
+        self.signal('NEWNYM')
+
+        if stamp_file:
+            with open(stamp_file, 'w') as f:
+                f.write(str(time.time()))
+
+        if wait:
+            # old circuits are dirty now, build a clean one right away
+            circ_id = self.extend_circuit()
+            self.wait_circuit_built(circ_id, timeout=timeout)
+            self.setevents()
+
+        return time.monotonic() - t0
+
+
+_bootstrap_log_re = re.compile(r'Bootstrapped (\d+)%(?: \(([\w-]+)\))?: (.*)')
+
+
+class BootstrapTracker:
+    # Bootstrap progress as reported by tor (control events or its log),
+    # with the time spent in each phase
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = []
+        self.progress = 0
+
+    def update(self, progress, tag, summary, at=None):
+        progress = int(progress)
+        if self.phases and self.phases[-1][1] == tag:
+            return
+        if progress < self.progress:
+            return
+        self.progress = progress
+        self.phases.append((progress, tag, summary, at or time.monotonic()))
+
+    def update_from_event(self, line):
+        # [STATUS_CLIENT] NOTICE BOOTSTRAP PROGRESS=.. TAG=.. SUMMARY=".."
+        if 'BOOTSTRAP' not in line:
+            return
+        kv = parse_kv(line)
+        if 'PROGRESS' in kv:
+            self.update(kv['PROGRESS'], kv.get('TAG', ''), kv.get('SUMMARY', ''))
+
+    def update_from_log(self, line):
+        m = _bootstrap_log_re.search(line)
+        if m:
+            self.update(m.group(1), m.group(2) or m.group(1), m.group(3).strip())
+
+    @property
+    def done(self):
+        return self.progress >= 100
+
+    @property
+    def elapsed(self):
+        if not self.phases:
+            return time.monotonic() - self.started
+        return self.phases[-1][3] - self.started
+
+    def breakdown(self):
+        # => [(progress, tag, summary, seconds spent before reaching the next phase)]
+        out = []
+        for i, (progress, tag, summary, at) in enumerate(self.phases):
+            nxt = self.phases[i + 1][3] if i + 1 < len(self.phases) else at
+            out.append((progress, tag, summary, nxt - at))
+        return out
+
+
+def wait_bootstrap(connect, log_file=None, alive=None, timeout=120, tracker=None):
+    # Follow bootstrap through the control port (STATUS_CLIENT events) and,
+    # until it accepts connections or if it never does, through tor's log.
+    # connect() -> authenticated TorController; alive() -> False once tor died.
+    tracker = tracker or BootstrapTracker()
+    deadline = time.monotonic() + timeout
+    ctl = None
+    log = None
+
+    try:
+        while not tracker.done:
+            if time.monotonic() > deadline:
+                raise TorControlError(f'tor not bootstrapped within {timeout}s ({tracker.progress}%)')
+            if alive is not None and not alive():
+                raise TorControlError(f'tor exited while bootstrapping ({tracker.progress}%)')
+
+            if ctl is None:
+                try:
+                    ctl = connect()
+                    ctl.setevents('STATUS_CLIENT')
+                    tracker.update_from_event(ctl.getinfo('status/bootstrap-phase').get('status/bootstrap-phase', ''))
+                    continue
+                except (OSError, TorControlError):
+                    ctl = None
+
+            if ctl is not None:
+                try:
+                    event = ctl.read_event(timeout=0.5)
+                    if event and event.startswith('STATUS_CLIENT'):
+                        tracker.update_from_event(event)
+                    continue
+                except (OSError, TorControlError):
+                    # connection dropped (or a partial line timed out): the log
+                    # meanwhile, a new connection on the next round
+                    ctl.close()
+                    ctl = None
+
+            if log_file:
+                if log is None and os.path.exists(log_file):
+                    log = open(log_file, 'r', errors='replace')
+                if log is not None:
+                    for line in log.readlines():
+                        tracker.update_from_log(line)
+            time.sleep(0.2)
+
+    finally:
+        if ctl is not None:
+            ctl.close()
+        if log is not None:
+            log.close()
+
+    return tracker
@@ -0,0 +1,106 @@
+import os
+import re
+
+
+# instance N listens on the instance 0 ports (toro2.torrc) + N * PORT_STRIDE,
+# far enough apart for SocksPort/ControlPort/TransPort/DNSPort not to collide
+PORT_STRIDE = 100
+
+PORT_OPTIONS = ['SocksPort', 'TransPort', 'ControlPort', 'DNSPort']
+
+
+def template_ports(torrc_text):
+    ports = {}
+    for opt in PORT_OPTIONS:
+        m = re.search(rf'^\s*{opt}\s+(?:[\d.]+:)?(\d+)', torrc_text, re.M)
+        if m:
+            ports[opt] = int(m.group(1))
+    return ports
+
+
+class TorInstance:
+    def __init__(self, index, torrc, datadir, pidfile, ports):
+        self.index = index
+        self.torrc = torrc
+        self.datadir = datadir
+        self.pidfile = pidfile
+        self.ports = ports
+
+    @property
+    def name(self):
+        return f'tor.{self.index}'
+
+    @property
+    def trans_port(self):
+        return self.ports.get('TransPort')
+
+    @property
+    def control_port(self):
+        return self.ports.get('ControlPort')
+
+    def pid(self):
+        try:
+            with open(self.pidfile) as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        return pid if os.path.exists(f'/proc/{pid}') else None
+
+
+def render_torrc(torrc_text, index, datadir, pidfile):
+    ports = template_ports(torrc_text)
+
+    def port_line(m):
+        opt, addr, port = m.group(1), m.group(2) or '', int(m.group(3))
+        return f'{opt} {addr}{port + index * PORT_STRIDE}'
+
+    out = re.sub(rf'^\s*({"|".join(PORT_OPTIONS)})\s+([\d.]+:)?(\d+)', port_line, torrc_text, flags=re.M)
+    out = re.sub(r'^\s*DataDirectory\b.*$', f'DataDirectory {datadir}', out, flags=re.M)
+    out = re.sub(r'^\s*PidFile\b.*\n?', '', out, flags=re.M)
+    out = out.rstrip('\n') + f'\nPidFile {pidfile}\n'
+
+    return out, {opt: port + index * PORT_STRIDE for opt, port in ports.items()}
+
+
+class TorPool:
+    # N tor processes generated from one torrc template, each with its own
+    # DataDirectory, ports and pidfile. Instance 0 keeps the template ports
+    # & libdir, instance N gets <libdir>.N next to it: tor owns (and chmods)
+    # a DataDirectory, one can't live inside another's.
+    # Pidfiles go to run_dir: DataDirectory is private to the tor user.
+
+    def __init__(self, torrc_template, instances_dir, libdir, run_dir='/tmp', count=1):
+        self.torrc_template = torrc_template
+        self.instances_dir = instances_dir
+        self.libdir = libdir
+        self.run_dir = run_dir
+        self.count = max(1, int(count))
+
+    def instances(self):
+        with open(self.torrc_template) as f:
+            template = f.read()
+
+        libdir = (self.libdir or '/var/lib/tor').rstrip('/')
+        out = []
+        for i in range(self.count):
+            datadir = libdir if i == 0 else f'{libdir}.{i}'
+            torrc = f'{self.instances_dir}/torrc.{i}'
+            pidfile = f'{self.run_dir}/toro2-tor.{i}.pid'
+            _, ports = render_torrc(template, i, datadir, pidfile)
+            out.append(TorInstance(i, torrc, datadir, pidfile, ports))
+        return out
+
+    def write(self):
+        with open(self.torrc_template) as f:
+            template = f.read()
+
+        os.makedirs(self.instances_dir, exist_ok=True)
+        instances = self.instances()
+        for inst in instances:
+            text, _ = render_torrc(template, inst.index, inst.datadir, inst.pidfile)
+            with open(inst.torrc, 'w') as f:
+                f.write(text)
+        return instances
+
+    def trans_ports(self):
+        return [inst.trans_port for inst in self.instances() if inst.trans_port]
@@ -0,0 +1,174 @@
+import ctypes
+import fnmatch
+import os
+import select
+import socket
+import struct
+import time
+from functools import partial
+
+
+# inotify(7)
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# a watched path changes when an entry of its directory is (re)written,
+# replaced, removed, or gets other attributes (chattr +i/-i)
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event {int wd; uint32 mask, cookie, len; char name[len]}
+_event = struct.Struct('iIII')
+
+# nftables ruleset changes are multicast on NFNLGRP_NFTABLES (also what
+# iptables-nft does); needs CAP_NET_ADMIN
+NETLINK_NETFILTER = 12
+NFNLGRP_NFTABLES = 7
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+
+# systemd keeps a /run/systemd/units/invocation:<unit> link while a unit
+# runs: started & stopped units show up as files there
+SYSTEMD_UNITS_DIR = '/run/systemd/units'
+
+
+def unit_path(unit):
+    return f'{SYSTEMD_UNITS_DIR}/invocation:{unit}'
+
+
+class Watcher:
+    # Waits until something toro2's state is made of may have changed,
+    # instead of polling it: paths (inotify on their directories, glob
+    # patterns allowed in the file name), the nftables ruleset (netlink)
+    # & processes (pidfd). A source the system doesn't offer is skipped:
+    # wait()'s timeout is the fallback.
+
+    def __init__(self, paths=(), netfilter=True):
+        self._fds = {}
+        self._dirs = {}
+        self._pidfds = {}
+        self._inotify = None
+        self._nl = None
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd >= 0:
+            self._inotify = fd
+            self._fds[fd] = self._read_inotify
+            for path in paths:
+                directory, pattern = os.path.split(os.path.abspath(path))
+                wd = libc.inotify_add_watch(fd, directory.encode(), WATCH_MASK)
+                if wd >= 0:
+                    self._dirs.setdefault(wd, (directory, []))[1].append(pattern)
+
+        if netfilter:
+            try:
+                nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+                nl.bind((0, 0))
+                nl.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, NFNLGRP_NFTABLES)
+                nl.setblocking(False)
+                self._nl = nl
+                self._fds[nl.fileno()] = self._read_netlink
+            except (OSError, AttributeError):
+                pass
+
+    @property
+    def sources(self):
+        # => what is actually watched, for the user to know
+        out = [os.path.join(d, p) for d, patterns in self._dirs.values() for p in patterns]
+        if self._nl is not None:
+            out.append('nftables')
+        out += [f'pid {pid}' for pid in self._pidfds]
+        return out
+
+    def set_pids(self, pids):
+        # watch these processes exiting (replaces the previous set)
+        for pid in list(self._pidfds):
+            if pid not in pids:
+                fd = self._pidfds.pop(pid)
+                self._fds.pop(fd, None)
+                os.close(fd)
+
+        for pid in pids:
+            if pid in self._pidfds or not hasattr(os, 'pidfd_open'):
+                continue
+            try:
+                fd = os.pidfd_open(pid)
+            except OSError:
+                continue
+            self._pidfds[pid] = fd
+            self._fds[fd] = partial(self._exited, pid)
+
+    @staticmethod
+    def _exited(pid, fd):
+        return {f'pid {pid} exited'}
+
+    def _read_inotify(self, fd):
+        reasons = set()
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return reasons
+
+        off = 0
+        while off + _event.size <= len(data):
+            wd, mask, _, length = _event.unpack_from(data, off)
+            name = data[off + _event.size:off + _event.size + length].rstrip(b'\0').decode('utf-8', 'replace')
+            off += _event.size + length
+            if wd not in self._dirs:
+                continue
+            directory, patterns = self._dirs[wd]
+            if any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                reasons.add(os.path.join(directory, name))
+        return reasons
+
+    def _read_netlink(self, fd):
+        try:
+            while self._nl.recv(65536):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        return {'nftables'}
+
+    def wait(self, timeout=None, settle=0.2):
+        # => set of what changed (paths, 'nftables', 'pid N exited'),
+        # empty on timeout. What else changes within `settle` seconds of
+        # the first change (a start, a restore) is reported along with it.
+        reasons = set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select(list(self._fds), [], [], left)
+            if not readable:
+                return reasons
+
+            first = not reasons
+            for fd in readable:
+                handler = self._fds.get(fd)
+                if handler is not None:
+                    reasons |= handler(fd)
+            if first and reasons:
+                deadline = time.monotonic() + settle
+
+            # a process watched exits once: stop watching it
+            for pid, fd in list(self._pidfds.items()):
+                if f'pid {pid} exited' in reasons:
+                    self._pidfds.pop(pid)
+                    self._fds.pop(fd, None)
+                    os.close(fd)
+
+    def close(self):
+        self.set_pids([])
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+        if self._nl is not None:
+            self._nl.close()
+            self._nl = None
+        self._fds.clear()